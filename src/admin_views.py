@@ -0,0 +1,86 @@
+"""Module giving in-memory views of admin units within a national raster, instead of writing a raster per admin unit"""
+from collections import namedtuple
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio import features, windows
+from extract_rasters import bounds_to_window
+
+AdminView = namedtuple('AdminView', ['name', 'window', 'mask'])
+
+class AdminViews:
+    """Pixel window and mask (True inside unit) of each admin unit on the grid of a national raster"""
+
+    def __init__(self, shp, transform, shape, name_field='ADM1', crs=None):
+        """Initialisation function
+        shp --> Shapefile of admin units
+        transform --> Affine transform of national raster
+        shape --> (rows, cols) of national raster
+        name_field --> Column holding admin unit names. Default is 'ADM1'
+        crs --> crs of national raster. Shapes are reprojected if it differs
+        """
+        self.shp = shp
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.name_field = name_field
+        self.gdf = gpd.read_file(str(self.shp))
+        if crs is not None and self.gdf.crs is not None:
+            self.gdf = self.gdf.to_crs(crs)
+        self.views = self.make_views()
+
+    @classmethod
+    def from_raster(cls, shp, raster, name_field='ADM1'):
+        """Returns AdminViews on the grid of raster"""
+        with rasterio.open(str(raster)) as src:
+            return cls(shp, src.transform, src.shape, name_field=name_field, crs=src.crs)
+
+    def __iter__(self):
+        """Iterates over AdminView of each unit"""
+        return iter(self.views.values())
+
+    def __len__(self):
+        """Number of admin units"""
+        return len(self.views)
+
+    def make_views(self):
+        """Returns dictionary of {name: AdminView}. Units falling outside the grid are left out"""
+        views = {}
+        for name, geometry in zip(self.gdf[self.name_field], self.gdf['geometry']):
+            minx, miny, maxx, maxy = geometry.bounds
+            bounding_box = {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
+            window = bounds_to_window(bounding_box, self.transform, self.shape[1], self.shape[0])
+            if window.width <= 0 or window.height <= 0:
+                continue
+            mask = features.geometry_mask([geometry],
+                                          out_shape=(window.height, window.width),
+                                          transform=windows.transform(window, self.transform),
+                                          invert=True)
+            views[name] = AdminView(name, window, mask)
+        return views
+
+    def read(self, array, name, nodata=-99999):
+        """Returns masked array of admin unit from national array (bands, rows, cols) or (rows, cols).
+        Pixels outside unit or equal to nodata are masked. No copy of the national array is made
+        """
+        view = self.views[name]
+        rows, cols = view.window.toslices()
+        data = array[..., rows, cols]
+        mask = np.broadcast_to(~view.mask, data.shape)
+        if nodata is not None:
+            mask = mask | (data == nodata)
+        return np.ma.masked_array(data, mask)
+
+    def zonal_stats(self, array, stats=('sum',), nodata=-99999):
+        """Returns DataFrame of stats ('sum', 'mean', 'std', 'count', 'min', 'max') for every unit of 2D array"""
+        rows = []
+        for view in self:
+            data = self.read(array, view.name, nodata).compressed().astype('float64')
+            row = {self.name_field: view.name}
+            for stat in stats:
+                if stat == 'count':
+                    row[stat] = data.size
+                else:
+                    row[stat] = getattr(data, stat)() if data.size else None
+            rows.append(row)
+        return pd.DataFrame(rows, columns=[self.name_field] + list(stats))
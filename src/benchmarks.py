@@ -0,0 +1,140 @@
+"""Benchmarks comparing processing engines on real VIIRS rasters
+
+python benchmarks.py clip TILE SHP --> gdalwarp subprocess against in-process rasterio clipping
+python benchmarks.py normalise COUNTRY_DIR SHP --> per admin unit rasters against in-memory views and label grid normalisation
+python benchmarks.py profiles RASTER [RASTER ...] --> write time, read time and size of each output profile preset
+"""
+from pathlib import Path
+import argparse
+import shutil
+import tempfile
+import time
+import geopandas as gpd
+import rasterio
+from admin_views import AdminViews
+from extract_rasters import ExtractFromTiles
+from label_grid import LabelGrid
+from output_profiles import PRESETS, output_profile, finalise
+from reclass_rasters import NormaliseAdminUnits, NormaliseAdminViews, NormaliseLabels
+
+def time_call(func, repeats=3):
+    """Returns best wall time in seconds of repeats calls to func"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark_clipping(tile, shp, repeats=3):
+    """Times clipping tile to shp with each ExtractFromTiles engine
+    Returns dictionary of {engine: seconds}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in ['gdalwarp', 'rasterio']:
+            out_raster = Path(tmp).joinpath(f'{engine}.tif')
+            def clip():
+                if out_raster.exists():
+                    out_raster.unlink()
+                ExtractFromTiles(tile, shp, out_raster, engine=engine)
+            results[engine] = time_call(clip, repeats)
+            print(f'{engine}: {results[engine]:.3f}s')
+    return results
+
+def benchmark_normalise(country_dir, shp, name_field='ADM1', raster_type='_rad_cap_smth.tif', repeats=1):
+    """Times temporal normalisation of admin units in shp (e.g. adm1 or adm4) three ways on a copy of country_dir:
+    per-unit (clip a raster per unit and month then NormaliseAdminUnits), views (NormaliseAdminViews) and labels (NormaliseLabels)
+    country_dir --> datain/{country} folder of month folders holding national rasters
+    Returns dictionary of {method: seconds}
+    """
+    country = Path(country_dir).name
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        months = []
+        for month in sorted(x for x in Path(country_dir).iterdir() if x.is_dir()):
+            months.append(Path(tmp).joinpath(month.name))
+            months[-1].mkdir()
+            raster = f'{country}_{month.name}{raster_type}'
+            shutil.copy(month.joinpath(raster), months[-1].joinpath(raster))
+        units_dir = Path(tmp).joinpath('adm_units')
+        units_dir.mkdir()
+        gdf = gpd.read_file(str(shp))
+        names = [str(x) for x in range(len(gdf))]
+        for name, (_, row) in zip(names, gdf.iterrows()):
+            gpd.GeoDataFrame([row], crs=gdf.crs).to_file(units_dir.joinpath(f'{name}.shp'))
+        first = months[0].joinpath(f'{country}_{months[0].name}{raster_type}')
+
+        def per_unit():
+            for month in months:
+                subnational = month.joinpath('subnational')
+                subnational.mkdir(exist_ok=True)
+                for name in names:
+                    ExtractFromTiles(month.joinpath(f'{country}_{month.name}{raster_type}'), units_dir.joinpath(f'{name}.shp'), subnational.joinpath(f'{name}_{month.name}_rad.tif'))
+            NormaliseAdminUnits(names, months, country)
+
+        def views():
+            NormaliseAdminViews(AdminViews.from_raster(shp, first, name_field), months, country, raster_type)
+
+        def labels():
+            NormaliseLabels(LabelGrid.from_raster(shp, first, name_field), months, country, raster_type)
+
+        for method, func in [('per-unit', per_unit), ('views', views), ('labels', labels)]:
+            results[method] = time_call(func, repeats)
+            print(f'{method}: {results[method]:.3f}s for {len(names)} units x {len(months)} months')
+    return results
+
+def benchmark_profiles(rasters, repeats=3):
+    """Times writing and reading each raster with every output profile preset and reports file size
+    Returns dictionary of {(raster name, preset): (write seconds, read seconds, MB)}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for raster in rasters:
+            with rasterio.open(str(raster)) as src:
+                data = src.read(1)
+                base_profile = src.profile
+            for preset in PRESETS:
+                out_raster = Path(tmp).joinpath(f'{preset}.tif')
+                profile = output_profile(base_profile, preset, nodata=base_profile['nodata'])
+                def write():
+                    with rasterio.open(str(out_raster), 'w', **profile) as dst:
+                        dst.write(data, 1)
+                    finalise(out_raster, preset)
+                def read():
+                    with rasterio.open(str(out_raster)) as src:
+                        src.read(1)
+                write_time = time_call(write, repeats)
+                read_time = time_call(read, repeats)
+                size = out_raster.stat().st_size / 1e6
+                results[(Path(raster).name, preset)] = (write_time, read_time, size)
+                print(f'{Path(raster).name} {preset}: write {write_time:.3f}s, read {read_time:.3f}s, {size:.2f} MB')
+    return results
+
+def main():
+    """Parse arguments and run chosen benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    clip = subparsers.add_parser('clip', help='Clip tile to shapefile')
+    clip.add_argument('tile', type=Path)
+    clip.add_argument('shp', type=Path)
+    clip.add_argument('--repeats', type=int, default=3)
+    normalise = subparsers.add_parser('normalise', help='Normalise admin units over time')
+    normalise.add_argument('country_dir', type=Path)
+    normalise.add_argument('shp', type=Path)
+    normalise.add_argument('--name-field', default='ADM1')
+    normalise.add_argument('--repeats', type=int, default=1)
+    profiles = subparsers.add_parser('profiles', help='Write and read rasters with each output profile preset')
+    profiles.add_argument('rasters', type=Path, nargs='+')
+    profiles.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    if args.benchmark == 'clip':
+        benchmark_clipping(args.tile, args.shp, args.repeats)
+    elif args.benchmark == 'normalise':
+        benchmark_normalise(args.country_dir, args.shp, args.name_field, repeats=args.repeats)
+    elif args.benchmark == 'profiles':
+        benchmark_profiles(args.rasters, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
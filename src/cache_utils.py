@@ -0,0 +1,113 @@
+"""Content hashes and small persistent caches, so results are reused only while their inputs are unchanged"""
+from contextlib import contextmanager
+from pathlib import Path
+import hashlib
+import json
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    #Windows
+    fcntl = None
+    import msvcrt
+
+BASEDIR = Path(__file__).resolve().parent.parent
+CACHE_DIR = BASEDIR.joinpath('datain/cache')
+
+class JSONCache:
+    """Dictionary of {key: JSON value} persisted to a file after every change. Safe to share between processes:
+    writes hold a lock file and merge entries other processes saved since this one last read the file
+    """
+
+    def __init__(self, path):
+        """
+        path --> json file holding the cache. Created on first write
+        """
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = self.read()
+
+    def read(self):
+        """Returns entries saved in the cache file, or an empty dictionary if there is none"""
+        if not self.path.exists():
+            return {}
+        with open(self.path) as src:
+            return json.load(src)
+
+    @staticmethod
+    def key(*parts):
+        """Returns sha256 hex digest of parts"""
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key, default=None):
+        """Returns cached value of key or default"""
+        return self.entries.get(key, default)
+
+    def set(self, key, value):
+        """Caches value under key and saves cache atomically, keeping entries saved meanwhile by other processes"""
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with file_lock(self.path.with_name(f'{self.path.name}.lock')):
+                entries = {**self.entries, **self.read(), key: value}
+                with tempfile.NamedTemporaryFile('w', dir=self.path.parent, prefix=f'{self.path.name}.', suffix='.tmp', delete=False) as dst:
+                    json.dump(entries, dst)
+                Path(dst.name).replace(self.path)
+                self.entries = entries
+
+    def get_or_compute(self, key, func):
+        """Returns cached value of key, calling func() and caching its result if missing"""
+        if key not in self.entries:
+            self.set(key, func())
+        return self.entries[key]
+
+@contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on file path (created if missing) while the with block runs.
+    Uses flock, or msvcrt.locking on Windows. Either lock is released by the system if the process dies
+    """
+    with open(path, 'a+') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        else:
+            lock.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.01)
+        try:
+            yield
+        finally:
+            if fcntl is None:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+_hashes = None
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Returns sha256 hex digest of file contents.
+    Digests are remembered by path, size and modification time so unchanged files are read only once
+    """
+    global _hashes
+    if _hashes is None:
+        _hashes = JSONCache(CACHE_DIR.joinpath('file_hashes.json'))
+    path = Path(path).resolve()
+    stat = path.stat()
+    key = JSONCache.key(str(path), stat.st_size, stat.st_mtime_ns)
+    def digest():
+        sha = hashlib.sha256()
+        with open(path, 'rb') as src:
+            for chunk in iter(lambda: src.read(chunk_size), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+    return _hashes.get_or_compute(key, digest)
+
+def geometry_hash(gdf):
+    """Returns sha256 hex digest of geometries and crs of GeoDataFrame"""
+    sha = hashlib.sha256(str(gdf.crs).encode())
+    for geometry in gdf['geometry']:
+        sha.update(geometry.wkb)
+    return sha.hexdigest()
@@ -0,0 +1,60 @@
+"""Maximum radiance in the capital region, read from the capital's window only and cached by raster contents and capital geometry"""
+import rasterio
+from rasterio.features import geometry_mask
+from extract_rasters import bounds_to_window, read_shapes
+from cache_utils import CACHE_DIR, JSONCache, file_hash, geometry_hash
+
+_cache = None
+
+def default_cache():
+    """Returns cache shared by all capital statistics (datain/cache/capital_max.json)"""
+    global _cache
+    if _cache is None:
+        _cache = JSONCache(CACHE_DIR.joinpath('capital_max.json'))
+    return _cache
+
+def read_capital_window(src, capital):
+    """Returns (data, outside, window) for capital's bounding window of src. outside is True for pixels whose centre is outside capital"""
+    if capital.crs is not None and src.crs is not None:
+        capital = capital.to_crs(src.crs)
+    minx, miny, maxx, maxy = capital.total_bounds
+    bounding_box = {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
+    window = bounds_to_window(bounding_box, src.transform, src.width, src.height)
+    data = src.read(1, window=window)
+    outside = geometry_mask(capital['geometry'], out_shape=data.shape, transform=src.window_transform(window))
+    return data, outside, window
+
+def compute_capital_max(raster, capital_shp, cvg=None, cvg_threshold=None, rad_threshold=None):
+    """Returns maximum of raster inside capital, or None if no pixel is valid. Nodata pixels are ignored.
+    If cvg is given, pixels with coverage below cvg_threshold or radiance below rad_threshold are ignored too
+    """
+    capital = read_shapes(capital_shp)
+    with rasterio.open(str(raster)) as src:
+        data, outside, window = read_capital_window(src, capital)
+        invalid = outside
+        if src.nodata is not None:
+            invalid = invalid | (data == src.nodata)
+        if cvg is not None:
+            with rasterio.open(str(cvg)) as cvg_src:
+                data_cvg = cvg_src.read(1, window=window)
+            invalid = invalid | (data_cvg < cvg_threshold) | (data < rad_threshold)
+    valid = data[~invalid]
+    if valid.size == 0:
+        return None
+    return float(valid.max())
+
+def capital_max(raster, capital_shp, cvg=None, cvg_threshold=None, rad_threshold=None, use_cache=True):
+    """Returns maximum of raster inside capital region (see compute_capital_max), reusing the cached value
+    while raster, cvg, capital geometry and thresholds are unchanged.
+    raster --> Radiance raster
+    capital_shp --> Shapefile of capital region
+    cvg --> Coverage raster. If given, thresholds are applied before taking the maximum. Default is None
+    cvg_threshold --> Pixels with coverage below this are ignored. Default is None
+    rad_threshold --> Pixels with radiance below this are ignored. Default is None
+    use_cache --> Default is True
+    """
+    if not use_cache:
+        return compute_capital_max(raster, capital_shp, cvg, cvg_threshold, rad_threshold)
+    key = JSONCache.key(file_hash(raster), geometry_hash(read_shapes(capital_shp)),
+                        file_hash(cvg) if cvg is not None else None, cvg_threshold, rad_threshold)
+    return default_cache().get_or_compute(key, lambda: compute_capital_max(raster, capital_shp, cvg, cvg_threshold, rad_threshold))
@@ -0,0 +1,129 @@
+"""Exact coverage fractions of raster pixels by admin polygons, kept as a sparse (zones x pixels) weight matrix
+
+Pixels wholly inside a polygon get weight 1 and pixels on its boundary get the fraction of their area it covers, so small
+admin units are neither under counted (pixel centres) nor over counted (all touched). Weights are computed once per
+shapefile and raster grid and cached, after which any weighted sum is one sparse matrix-vector product.
+"""
+import os
+import numpy as np
+import shapely
+from rasterio import windows
+from rasterio.features import geometry_mask, rasterize
+from scipy import ndimage, sparse
+from cache_utils import CACHE_DIR, JSONCache, geometry_hash
+from extract_rasters import bounds_to_window, read_shapes
+
+if int(shapely.__version__.split('.')[0]) < 2:
+    raise ImportError(f'coverage_weights needs the vectorised functions of shapely >= 2, found shapely {shapely.__version__}')
+
+def polygon_fractions(geometry, transform, width, height):
+    """Returns (pixel indices, coverage fractions) of pixels of grid overlapped by geometry. Pixel index is row * width + col.
+    Pixels the boundary does not touch are wholly inside or outside, so their centre decides. Only pixels the boundary
+    touches are intersected with geometry
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    window = bounds_to_window({'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}, transform, width, height)
+    if geometry.is_empty or window.width <= 0 or window.height <= 0:
+        return np.empty(0, dtype='int64'), np.empty(0)
+    shape = (window.height, window.width)
+    window_transform = windows.transform(window, transform)
+    fractions = geometry_mask([geometry], out_shape=shape, transform=window_transform, invert=True).astype('float64')
+    boundary = rasterize([geometry.boundary], out_shape=shape, transform=window_transform, all_touched=True).astype(bool)
+    rows, cols = np.nonzero(boundary)
+    left = window_transform.c + cols * window_transform.a
+    top = window_transform.f + rows * window_transform.e
+    right, bottom = left + window_transform.a, top + window_transform.e
+    boxes = shapely.box(np.minimum(left, right), np.minimum(top, bottom), np.maximum(left, right), np.maximum(top, bottom))
+    shapely.prepare(geometry)
+    fractions[rows, cols] = shapely.area(shapely.intersection(geometry, boxes)) / abs(transform.a * transform.e)
+    rows, cols = np.nonzero(fractions > 0)
+    return (rows + window.row_off) * width + cols + window.col_off, np.minimum(fractions[rows, cols], 1)
+
+class CoverageWeights:
+    """Sparse CSR matrix with one row per zone (shapefile row order) and one column per pixel of a raster grid"""
+
+    def __init__(self, shp, transform, shape, crs=None, cache_dir=None):
+        """Initialisation function
+        shp --> Shapefile of zones
+        transform --> Affine transform of raster grid
+        shape --> (rows, cols) of raster grid
+        crs --> crs of raster grid. Shapes are reprojected if it differs
+        cache_dir --> Folder of cached weight matrices (npz). Default is datain/cache/coverage
+        """
+        self.shp = shp
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.crs = crs
+        self.cache_dir = cache_dir or CACHE_DIR.joinpath('coverage')
+        self.gdf = read_shapes(self.shp)
+        if crs is not None and self.gdf.crs is not None:
+            self.gdf = self.gdf.to_crs(crs)
+        self.matrix = self.load_or_compute()
+
+    @classmethod
+    def from_src(cls, shp, src, cache_dir=None):
+        """Returns CoverageWeights on the grid of open raster src"""
+        return cls(shp, src.transform, src.shape, crs=src.crs, cache_dir=cache_dir)
+
+    def load_or_compute(self):
+        """Returns weight matrix from cache_dir, computing and caching it if missing"""
+        key = JSONCache.key(geometry_hash(self.gdf), tuple(self.transform), self.shape, str(self.crs))
+        cached = self.cache_dir.joinpath(f'{key}.npz')
+        if cached.exists():
+            return sparse.load_npz(str(cached)).tocsr()
+        matrix = self.compute()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached.with_suffix(f'.{os.getpid()}.tmp.npz')
+        sparse.save_npz(str(tmp_path), matrix)
+        tmp_path.replace(cached)
+        return matrix
+
+    def compute(self):
+        """Returns CSR weight matrix of coverage fractions of every pixel by every zone"""
+        height, width = self.shape
+        rows, cols, fractions = [], [], []
+        for zone, geometry in enumerate(self.gdf['geometry']):
+            pixels, zone_fractions = polygon_fractions(geometry, self.transform, width, height)
+            rows.append(np.full(pixels.size, zone, dtype='int64'))
+            cols.append(pixels)
+            fractions.append(zone_fractions)
+        return sparse.csr_matrix((np.concatenate(fractions), (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(len(self.gdf), height * width))
+
+    def reduce(self, data, nodata=None, stats=('count', 'sum', 'mean', 'std')):
+        """Returns dict of {stat: float64 array with one value per zone} of 2D data weighted by coverage.
+        count is the covered pixel area in pixels. Nodata and NaN pixels are ignored. Zones without valid pixels get NaN
+        (count 0). min and max are taken over pixels with any coverage
+        """
+        values = data.ravel().astype('float64')
+        valid = np.ones(values.shape, dtype=bool)
+        if nodata is not None:
+            valid &= values != nodata
+        valid &= ~np.isnan(values)
+        values = np.where(valid, values, 0)
+        count = self.matrix @ valid.astype('float64')
+        empty = count == 0
+        result = {}
+        coo = self.matrix.tocoo()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = self.matrix @ values
+            mean = total / count
+            if 'count' in stats:
+                result['count'] = count
+            if 'sum' in stats:
+                result['sum'] = np.where(empty, np.nan, total)
+            if 'mean' in stats:
+                result['mean'] = mean
+            if 'std' in stats:
+                #Squared deviations about each zone's mean, so large means do not cancel the variance away
+                deviations = coo.data * valid[coo.col] * (values[coo.col] - np.nan_to_num(mean)[coo.row]) ** 2
+                result['std'] = np.sqrt(np.bincount(coo.row, weights=deviations, minlength=self.matrix.shape[0]) / count)
+        if 'min' in stats or 'max' in stats:
+            covered = valid[coo.col]
+            zone, zone_values = coo.row[covered], values[coo.col[covered]]
+            index = np.arange(self.matrix.shape[0])
+            for stat, func in [('min', ndimage.minimum), ('max', ndimage.maximum)]:
+                if stat in stats:
+                    extreme = np.asarray(func(zone_values, zone, index), dtype='float64') if zone_values.size else np.zeros(len(index))
+                    result[stat] = np.where(empty, np.nan, extreme)
+        return {stat: result[stat] for stat in stats}
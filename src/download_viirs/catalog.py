@@ -0,0 +1,144 @@
+"""Persistent SQLite catalog of VIIRS composites listed on the NOAA download page"""
+
+from pathlib import Path
+import sqlite3
+import time
+import urllib3
+from bs4 import BeautifulSoup, SoupStrainer
+import certifi
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+NOOA_DOWNLOAD_PAGE = "https://ngdc.noaa.gov/eog/viirs/download_dnb_composites_iframe.html"
+
+def parse_href(href):
+	"""Returns dictionary of year, month, extent, product, config and annual flag parsed from tile url.
+	Month is None for annual composites. Product is the first token of the file name, e.g. SVDNB (day/night band)
+	"""
+	file_name = href.split('//')[-1]
+	date, config = file_name.split('/')[:2]
+	parts = file_name.split('/')[-1].split('_')
+	return {'year': int(date[:4]),
+			'month': int(date[4:6]) if len(date) > 4 else None,
+			'extent': parts[3],
+			'product': parts[0],
+			'config': config,
+			'annual': int(len(date) == 4),
+			'url': href}
+
+class NOAACatalog:
+	"""SQLite catalog of parsed tile records refreshed from the NOAA page when older than ttl"""
+
+	def __init__(self, catalog_path=None, ttl=7 * 24 * 3600, url=NOOA_DOWNLOAD_PAGE):
+		"""Initialisation function
+		catalog_path --> SQLite file. Default is datain/noaa_catalog.sqlite
+		ttl --> Seconds after which the NOAA page is fetched again. Default is one week
+		url --> NOAA page listing the composites
+		"""
+		if catalog_path is None:
+			catalog_path = BASE_DIR.joinpath('datain/noaa_catalog.sqlite')
+		self.catalog_path = Path(catalog_path)
+		self.catalog_path.parent.mkdir(parents=True, exist_ok=True)
+		self.ttl = ttl
+		self.url = url
+		self.conn = sqlite3.connect(str(self.catalog_path))
+		self.create_tables()
+
+	def __str__(self):
+		"""Docstring"""
+		return f'NOAACatalog at {self.catalog_path}'
+
+	def create_tables(self):
+		"""Creates tile and metadata tables with indexes used by query"""
+		with self.conn:
+			self.conn.executescript("""
+				CREATE TABLE IF NOT EXISTS tiles (
+					url TEXT PRIMARY KEY,
+					year INTEGER NOT NULL,
+					month INTEGER,
+					extent TEXT NOT NULL,
+					product TEXT NOT NULL,
+					config TEXT NOT NULL,
+					annual INTEGER NOT NULL,
+					first_seen REAL NOT NULL);
+				CREATE INDEX IF NOT EXISTS tiles_year ON tiles (year, annual);
+				CREATE INDEX IF NOT EXISTS tiles_extent ON tiles (extent, year);
+				CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+				""")
+			#Catalogs written when product held the configuration token of the file name
+			rows = self.conn.execute('SELECT url, product FROM tiles').fetchall()
+			records = [parse_href(url) for url, product in rows if parse_href(url)['product'] != product]
+			self.conn.executemany('UPDATE tiles SET product = :product WHERE url = :url', records)
+
+	def last_refresh(self):
+		"""Returns unix time of last refresh or None"""
+		row = self.conn.execute("SELECT value FROM meta WHERE key = 'last_refresh'").fetchone()
+		return row[0] if row else None
+
+	def is_stale(self):
+		"""Returns True if catalog is older than ttl"""
+		last_refresh = self.last_refresh()
+		return last_refresh is None or time.time() - last_refresh > self.ttl
+
+	def fetch_hrefs(self):
+		"""Fetches NOAA page and returns all tgz hrefs. Only anchors are parsed, with lxml"""
+		http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
+		page = http.request('GET', self.url)
+		nooa = BeautifulSoup(page.data, 'lxml', parse_only=SoupStrainer('a', href=True))
+		return [a['href'] for a in nooa.find_all('a', href=True) if a['href'].endswith('tgz')]
+
+	def refresh(self, force=False):
+		"""Adds tiles not yet in catalog. Skipped while catalog is younger than ttl unless force.
+		If NOAA can not be reached an existing catalog is used as is
+		Returns number of new tiles
+		"""
+		if not force and not self.is_stale():
+			return 0
+		try:
+			hrefs = self.fetch_hrefs()
+		except urllib3.exceptions.HTTPError as e:
+			if self.last_refresh() is None:
+				raise
+			print(f'Could not refresh catalog, using cached copy: {e}')
+			return 0
+		return self.add_hrefs(hrefs)
+
+	def add_hrefs(self, hrefs):
+		"""Inserts hrefs not yet in catalog and stamps refresh time
+		Returns number of new tiles
+		"""
+		known = {row[0] for row in self.conn.execute('SELECT url FROM tiles')}
+		now = time.time()
+		records = [dict(parse_href(href), first_seen=now) for href in hrefs if href not in known]
+		with self.conn:
+			self.conn.executemany("""
+				INSERT OR IGNORE INTO tiles (url, year, month, extent, product, config, annual, first_seen)
+				VALUES (:url, :year, :month, :extent, :product, :config, :annual, :first_seen)""", records)
+			self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_refresh', ?)", (now,))
+		return len(records)
+
+	def query(self, years=None, extents=None, annual_composites=False, exclude_configs=('vcmslcfg',)):
+		"""Returns list of tile urls
+		years --> List of years. Default (None) is all years
+		extents --> List of tile extents e.g. ['75N180W']. Default (None) is all extents
+		annual_composites --> Include annual composites. Default is False
+		exclude_configs --> Configurations to leave out. Default is stray-light corrected ('vcmslcfg')
+		"""
+		sql = 'SELECT url FROM tiles WHERE 1 = 1'
+		params = []
+		if years is not None:
+			sql += f' AND year IN ({",".join("?" * len(years))})'
+			params.extend(int(year) for year in years)
+		if extents:
+			sql += f' AND extent IN ({",".join("?" * len(extents))})'
+			params.extend(extents)
+		if not annual_composites:
+			sql += ' AND annual = 0'
+		if exclude_configs:
+			sql += f' AND config NOT IN ({",".join("?" * len(exclude_configs))})'
+			params.extend(exclude_configs)
+		sql += ' ORDER BY year, month, extent'
+		return [row[0] for row in self.conn.execute(sql, params)]
+
+	def close(self):
+		"""Closes SQLite connection"""
+		self.conn.close()
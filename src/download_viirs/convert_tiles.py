@@ -0,0 +1,67 @@
+"""Rewrites extracted VIIRS tiles as Cloud-Optimized GeoTIFFs so that windowed reads only decode the blocks they need"""
+
+from pathlib import Path
+import rasterio
+import rasterio.shutil
+
+COG_OPTIONS = {'compress': 'DEFLATE',
+               'level': 6,
+               'blocksize': 512,
+               'overview_resampling': 'average',
+               'bigtiff': 'IF_SAFER',
+               'num_threads': 'ALL_CPUS'}
+
+def cog_driver_available():
+    """Returns True if GDAL has the COG driver (GDAL >= 3.1)"""
+    with rasterio.Env() as env:
+        return 'COG' in env.drivers()
+
+class ConvertToCOG:
+    """Converts tiles in place to internally tiled, compressed GeoTIFF with overviews"""
+
+    def __init__(self, tiles, manifest=None, url=None, options=None):
+        """Initialisation function
+        tiles --> List of tif paths extracted from one tgz
+        manifest --> DownloadManifest in which conversion is recorded. Default is None
+        url --> Url of tgz the tiles came from, used as manifest key
+        options --> GDAL COG creation options. Default is COG_OPTIONS
+        """
+        self.tiles = [Path(x) for x in tiles]
+        self.manifest = manifest
+        self.url = url
+        self.options = dict(COG_OPTIONS, **(options or {}))
+
+    def __str__(self):
+        """Docstring"""
+        return f'ConvertToCOG object for {len(self.tiles)} tiles'
+
+    def is_converted(self):
+        """Returns True if manifest records tiles as converted"""
+        if self.manifest is None or self.url is None:
+            return False
+        entry = self.manifest.get(self.url)
+        return entry is not None and sorted(entry.get('cog', [])) == sorted(str(x) for x in self.tiles)
+
+    def convert_all(self):
+        """Converts every tile and records conversion in manifest
+        Returns list of converted tiles. Raises RuntimeError if GDAL has no COG driver
+        """
+        if self.is_converted():
+            print(f'{self.url} tiles already converted')
+            return self.tiles
+        if not cog_driver_available():
+            raise RuntimeError(f'GDAL {rasterio.__gdal_version__} has no COG driver. Converting tiles needs GDAL >= 3.1 (rasterio >= 1.2 wheels)')
+        for tile in self.tiles:
+            self.convert(tile)
+        if self.manifest is not None and self.url is not None:
+            self.manifest.update(self.url, cog=[str(x) for x in self.tiles], cog_options=self.options)
+        return self.tiles
+
+    def convert(self, tile):
+        """Writes tile as COG next to original then replaces original"""
+        tmp_tile = tile.with_suffix('.cog.tmp')
+        with rasterio.open(str(tile)) as src:
+            predictor = 3 if src.dtypes[0].startswith('float') else 2
+            rasterio.shutil.copy(src, str(tmp_tile), driver='COG', predictor=predictor, **self.options)
+        tmp_tile.replace(tile)
+        print(f'{tile} converted to COG')
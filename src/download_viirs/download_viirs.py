@@ -1,18 +1,38 @@
 """Docstring"""
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import shutil
 import tarfile
+import time
 import urllib3
 import certifi
+from manifest import DownloadManifest
+from convert_tiles import ConvertToCOG
 
 BASE_DIR = Path(__file__).resolve().parent.parent
+CHUNK_SIZE = 1024 * 1024
+PRODUCTS = ('avg_rade9h', 'cvg')
+#Annual composites name their products differently from monthly ones
+ANNUAL_PRODUCTS = {'avg_rade9h': 'avg_rade9'}
+
+def make_pool_manager(maxsize=1):
+    """Returns urllib3.PoolManager verifying certificates with certifi
+    maxsize --> Number of connections kept open per host
+    """
+    return urllib3.PoolManager(maxsize=maxsize,
+                               block=True,
+                               cert_reqs='CERT_REQUIRED',
+                               ca_certs=certifi.where())
 
 class DownloadViirs:
     """Docstring"""
 
-    def __init__(self, url):
-        """Docstring"""
+    def __init__(self, url, manifest=None, base_dir=BASE_DIR):
+        """Docstring
+        manifest --> DownloadManifest used to skip finished and resume partial downloads. Default is None
+        base_dir --> Folder containing datain. Default is BASE_DIR
+        """
         parts = url.split('//')
         self.download_zip_name = parts[-1].split('/')[-1]
         self.date = parts[-1].split('/')[0]
@@ -22,7 +42,9 @@ class DownloadViirs:
         else:
             self.month = f'ANNUAL_Composite_{self.year}'
         self.url = url
-        self.download_path = BASE_DIR.joinpath(f'datain/{self.year}/{self.month}')
+        self.manifest = manifest
+        self.extracted = []
+        self.download_path = Path(base_dir).joinpath(f'datain/{self.year}/{self.month}')
         self.create_folders()
 
 
@@ -35,21 +57,206 @@ class DownloadViirs:
         if not self.download_path.exists():
             self.download_path.mkdir(parents=True, exist_ok=True)
 
-    def download_rasters(self):
-        """Docstring"""
-        #path = BASE_DIR.joinpath(f'datain/{self.year}/{self.month}/{self.download_zip_name}')
+    def download_rasters(self, http=None):
+        """Streams tile to download_path with a single GET request.
+        Skips urls the manifest records as complete and resumes partial files with a Range request
+        http --> Shared urllib3.PoolManager. A new one is made if None
+        Returns number of bytes written
+        """
         file_loc = self.download_path.joinpath(self.download_zip_name)
+        if self.manifest is not None and self.manifest.is_complete(self.url):
+            print(f'{file_loc} already downloaded')
+            return 0
         print(file_loc)
-        http = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=certifi.where())
-        if http.request('GET', self.url, preload_content=False).status == 200:
-            with http.request('GET', self.url, preload_content=False) as src, open(file_loc, 'wb') as out_file:
-                shutil.copyfileobj(src, out_file)
-            #r.release_conn()
+        if http is None:
+            http = make_pool_manager()
+        offset = file_loc.stat().st_size if file_loc.exists() and self.manifest is not None else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        response = http.request('GET', self.url, headers=headers, preload_content=False)
+        if response.status == 416 and remote_size(http, self.url, response) != offset:
+            #Partial file is not a prefix of the remote file (e.g. the remote file was replaced), so download it all again
+            print(f'{file_loc} does not match remote size, downloading again')
+            response.release_conn()
+            offset = 0
+            response = http.request('GET', self.url, preload_content=False)
+        try:
+            if response.status == 416:
+                #Partial file already holds every byte
+                written = 0
+            elif response.status in (200, 206):
+                mode = 'ab' if response.status == 206 else 'wb'
+                if self.manifest is not None:
+                    self.manifest.update(self.url, file=str(file_loc), complete=False)
+                with open(file_loc, mode) as out_file:
+                    shutil.copyfileobj(response, out_file, CHUNK_SIZE)
+                written = file_loc.stat().st_size - (offset if mode == 'ab' else 0)
+            else:
+                raise urllib3.exceptions.HTTPError(f'{self.url} returned status {response.status}')
+        finally:
+            response.release_conn()
+        if self.manifest is not None:
+            self.manifest.mark_complete(self.url, file_loc)
+        return written
 
     def open_tgz(self):
-        """Docstring"""
+        """Extracts tgz to download_path and deletes it
+        Returns list of extracted tifs
+        """
         tar_url = self.download_path.joinpath(self.download_zip_name)
-        tar = tarfile.open(tar_url, 'r')
-        tar.extractall(self.download_path)
+        with tarfile.open(tar_url, 'r') as tar:
+            tar.extractall(self.download_path)
+            names = tar.getnames()
         self.download_path.joinpath(self.download_zip_name).unlink()
-        
\ No newline at end of file
+        return [self.download_path.joinpath(x) for x in names if x.endswith('.tif')]
+
+    def convert_to_cog(self, tiles):
+        """Rewrites extracted tiles as Cloud-Optimized GeoTIFFs and records it in the manifest
+        tiles --> List returned by open_tgz or stream_extract
+        """
+        return ConvertToCOG(tiles, manifest=self.manifest, url=self.url).convert_all()
+
+    def stream_extract(self, http=None, products=PRODUCTS, extents=None):
+        """Decompresses tgz as it downloads and writes only wanted members to download_path.
+        The archive itself is never written to disk. A broken transfer restarts from the beginning
+        http --> Shared urllib3.PoolManager. A new one is made if None
+        products --> Member products to keep e.g. 'avg_rade9h', 'cvg', 'cf_cvg'. 'avg_rade9h' also keeps annual avg_rade9. Default is PRODUCTS
+        extents --> List of tile extents to keep e.g. ['75N180W']. Default (None) keeps all
+        Returns number of compressed bytes read. Raises ValueError if no member was wanted
+        """
+        if self.manifest is not None and self.manifest.is_complete(self.url):
+            print(f'{self.url} already extracted')
+            return 0
+        if http is None:
+            http = make_pool_manager()
+        response = http.request('GET', self.url, preload_content=False)
+        extracted = []
+        try:
+            if response.status != 200:
+                raise urllib3.exceptions.HTTPError(f'{self.url} returned status {response.status}')
+            with tarfile.open(fileobj=response, mode='r|gz') as tar:
+                for member in tar:
+                    if not member.isfile() or not member_wanted(member.name, products, extents):
+                        continue
+                    out_file = self.download_path.joinpath(Path(member.name).name)
+                    tmp_file = out_file.with_suffix('.part')
+                    with tar.extractfile(member) as src, open(tmp_file, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                    tmp_file.replace(out_file)
+                    extracted.append(str(out_file))
+                    print(out_file)
+            response.drain_conn()
+            read = response.tell()
+        finally:
+            response.release_conn()
+        if not extracted:
+            raise ValueError(f'{self.url} has no members of products {products} within extents {extents}')
+        self.extracted = extracted
+        if self.manifest is not None:
+            self.manifest.update(self.url, file=None, size=read, members=extracted, complete=True)
+        return read
+
+def remote_size(http, url, response=None):
+    """Returns size in bytes of remote file, from Content-Range of a 416 response (bytes */size) or else from a HEAD request.
+    Returns None if the server gives neither
+    """
+    content_range = response.headers.get('Content-Range', '') if response is not None else ''
+    if content_range.startswith('bytes */'):
+        return int(content_range.split('/')[1])
+    length = http.request('HEAD', url).headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+def member_wanted(name, products=PRODUCTS, extents=None):
+    """Returns True if tar member name is one of products (e.g. name.avg_rade9h.tif, or name.avg_rade9.tif of annual composites) within extents"""
+    name = Path(name).name
+    if not name.endswith('.tif'):
+        return False
+    if name.split('.')[-2] not in set(products) | {ANNUAL_PRODUCTS[x] for x in products if x in ANNUAL_PRODUCTS}:
+        return False
+    if extents is not None and name.split('_')[3] not in extents:
+        return False
+    return True
+
+
+class BatchDownloadViirs:
+    """Downloads list of tile urls (e.g. GetNOOAUrls().hrefs) concurrently over one shared connection pool"""
+
+    def __init__(self, hrefs, workers=4, retries=3, backoff=2, extract=False, manifest_path=None, base_dir=BASE_DIR, stream_products=None, extents=None, cog=False):
+        """Initialisation function
+        hrefs --> List of tile urls
+        workers --> Number of tiles downloaded at the same time. Default is 4
+        retries --> Number of times a failed transfer is retried. Default is 3
+        backoff --> Base in seconds of exponential wait between retries. Default is 2
+        extract --> Open tgz after download. Default is False
+        manifest_path --> json manifest of finished downloads. Default is datain/download_manifest.json
+        base_dir --> Folder containing datain. Default is BASE_DIR
+        stream_products --> If given, extract only these products while downloading instead of saving tgz. Default is None
+        extents --> Tile extents kept when streaming. Default (None) keeps all
+        cog --> Convert extracted tiles to Cloud-Optimized GeoTIFF. Default is False
+        """
+        self.hrefs = hrefs
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.extract = extract
+        self.base_dir = base_dir
+        self.stream_products = stream_products
+        self.extents = extents
+        self.cog = cog
+        if manifest_path is None:
+            manifest_path = Path(base_dir).joinpath('datain/download_manifest.json')
+        self.manifest = DownloadManifest(manifest_path)
+        self.http = make_pool_manager(maxsize=self.workers)
+        self.failed = []
+
+    def __str__(self):
+        """Docstring"""
+        return f'BatchDownloadViirs object to download {len(self.hrefs)} tiles with {self.workers} workers'
+
+    def download_all(self):
+        """Downloads all hrefs. Failed urls are kept in self.failed
+        Returns dictionary of {url: (bytes, seconds)} for successful downloads
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.download_with_retries, url): url for url in self.hrefs}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    results[url] = future.result()
+                except (urllib3.exceptions.HTTPError, OSError, ValueError) as e:
+                    print(f'Failed to download {url}: {e}')
+                    self.failed.append(url)
+        return results
+
+    def download_with_retries(self, url):
+        """Downloads single tile, retrying with exponential backoff
+        Returns tuple of (bytes, seconds)
+        """
+        tile = DownloadViirs(url, manifest=self.manifest, base_dir=self.base_dir)
+        if self.manifest.is_complete(url):
+            if self.cog:
+                tile.convert_to_cog(self.manifest.get(url).get('members', []))
+            return 0, 0.0
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.perf_counter()
+                if self.stream_products:
+                    size = tile.stream_extract(self.http, self.stream_products, self.extents)
+                else:
+                    size = tile.download_rasters(self.http)
+                elapsed = time.perf_counter() - start
+                break
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                if attempt == self.retries:
+                    raise
+                wait = self.backoff ** attempt
+                print(f'Retrying {url} in {wait}s after error: {e}')
+                time.sleep(wait)
+        print(f'{tile.download_zip_name}: {size / 1e6:.1f} MB in {elapsed:.1f}s ({size / 1e6 / max(elapsed, 1e-9):.2f} MB/s)')
+        if self.extract and not self.stream_products:
+            tile.extracted = tile.open_tgz()
+            #The tgz is deleted once extracted, so the entry is verified by its members like a streamed one
+            self.manifest.update(url, file=None, members=[str(x) for x in tile.extracted])
+        if self.cog:
+            tile.convert_to_cog(tile.extracted)
+        return size, elapsed
@@ -6,13 +6,22 @@ from pathlib import Path
 
 from bs4 import BeautifulSoup
 import certifi
+from catalog import NOAACatalog
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 class GetNOOAUrls(object):
 	"""Class to get list of url from which to download VIIRS data"""
 
-	def __init__(self, years='all', annual_composites=False, extent='global'):
+	def __init__(self, years='all', annual_composites=False, extent='global', use_catalog=True, catalog_path=None, ttl=7 * 24 * 3600):
+		"""
+		years --> 'all', a year or list of years
+		annual_composites --> Include annual composites. Default is False
+		extent --> List of tile extents or 'global'
+		use_catalog --> Query the local NOAACatalog instead of parsing the NOAA page every time. Default is True
+		catalog_path --> SQLite catalog file. Default is datain/noaa_catalog.sqlite
+		ttl --> Seconds before the catalog is refreshed from NOAA. Default is one week
+		"""
 		__nooa_download_page = "https://ngdc.noaa.gov/eog/viirs/download_dnb_composites_iframe.html"
 		try:
 			self.years = years
@@ -34,9 +43,21 @@ class GetNOOAUrls(object):
 		else:
 			self.extent = []
 		self.annual_composites=annual_composites
-		self.hrefs = self.get_page()
-		if self.years != 'all':
-			self.hrefs = self.trim_years(self.hrefs, self.years)
+		if use_catalog:
+			self.hrefs = self.query_catalog(catalog_path, ttl)
+		else:
+			self.hrefs = self.get_page()
+			if self.years != 'all':
+				self.hrefs = self.trim_years(self.hrefs, self.years)
+
+	def query_catalog(self, catalog_path, ttl):
+		"""Returns wanted hrefs from local catalog, refreshing it from NOAA when older than ttl"""
+		catalog = NOAACatalog(catalog_path, ttl=ttl)
+		try:
+			catalog.refresh()
+			return catalog.query(self.years, self.extent, self.annual_composites)
+		finally:
+			catalog.close()
 
 
 	def get_page(self):
@@ -0,0 +1,88 @@
+"""Local record of downloaded tiles so that finished archives are not downloaded again"""
+
+from pathlib import Path
+import hashlib
+import json
+import threading
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Returns sha256 hex digest of file, read in chunks"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class DownloadManifest:
+    """JSON manifest of {url: {'file', 'size', 'sha256', 'complete'}} shared by download threads"""
+
+    def __init__(self, manifest_path=None):
+        """Initialisation function
+        manifest_path --> json file holding the manifest. Default is datain/download_manifest.json
+        """
+        if manifest_path is None:
+            manifest_path = BASE_DIR.joinpath('datain/download_manifest.json')
+        self.manifest_path = Path(manifest_path)
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def __str__(self):
+        """Docstring"""
+        return f'DownloadManifest with {len(self.entries)} entries at {self.manifest_path}'
+
+    def load(self):
+        """Returns manifest entries from disk or empty dictionary if there is no manifest yet"""
+        if not self.manifest_path.exists():
+            return {}
+        with open(self.manifest_path) as src:
+            return json.load(src)
+
+    def save(self):
+        """Writes manifest atomically so an interrupted run never leaves it half written"""
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as dst:
+            json.dump(self.entries, dst, indent=2, sort_keys=True)
+        tmp_path.replace(self.manifest_path)
+
+    def is_complete(self, url):
+        """Returns True if url was downloaded completely. Does not touch the network"""
+        entry = self.entries.get(url)
+        return entry is not None and entry['complete']
+
+    def get(self, url):
+        """Returns manifest entry of url or None"""
+        return self.entries.get(url)
+
+    def update(self, url, **fields):
+        """Updates manifest entry of url with fields and saves manifest"""
+        with self.lock:
+            entry = self.entries.setdefault(url, {'file': None, 'size': None, 'sha256': None, 'complete': False})
+            entry.update(fields)
+            self.save()
+
+    def mark_complete(self, url, file_loc):
+        """Records size and checksum of finished download"""
+        file_loc = Path(file_loc)
+        self.update(url,
+                    file=str(file_loc),
+                    size=file_loc.stat().st_size,
+                    sha256=file_sha256(file_loc),
+                    complete=True)
+
+    def verify(self, url):
+        """Returns True if file recorded for url still exists with same size and checksum.
+        Stream-extracted urls have no archive file, only members, which must all still exist (they may have been converted to COG since)
+        """
+        entry = self.entries.get(url)
+        if entry is None or not entry['complete']:
+            return False
+        if entry['file'] is None:
+            members = entry.get('members') or []
+            return bool(members) and all(Path(x).exists() for x in members)
+        file_loc = Path(entry['file'])
+        if not file_loc.exists() or file_loc.stat().st_size != entry['size']:
+            return False
+        return file_sha256(file_loc) == entry['sha256']
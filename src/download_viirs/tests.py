@@ -0,0 +1,283 @@
+"""Unittests for downloading VIIRS tiles against a local stand-in for the NOAA server"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import TestCase, main as testmain, mock
+import io
+import tarfile
+import tempfile
+import threading
+import time
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from download_viirs import BatchDownloadViirs, DownloadViirs, make_pool_manager
+from manifest import DownloadManifest, file_sha256
+from catalog import NOAACatalog, parse_href
+from convert_tiles import ConvertToCOG, cog_driver_available
+
+PAYLOAD = bytes(range(256)) * 4096 * 16
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD with Range support. Drops the connection halfway through while server.fail_once is set,
+    answers 503 to the next server.fail_requests requests and keeps the most requests served at once in server.max_active
+    """
+
+    def do_GET(self):
+        """Docstring"""
+        with self.server.lock:
+            self.server.requests.append(self.headers.get('Range'))
+            if self.server.fail_requests:
+                self.server.fail_requests -= 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            self.send_payload()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def send_payload(self):
+        """Sends payload from the start of the Range header"""
+        payload = self.server.payload
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+        if start >= len(payload):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(payload)}')
+            self.end_headers()
+            return
+        body = payload[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.fail_once:
+            self.server.fail_once = False
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep test output quiet"""
+        pass
+
+class ResumableDownloads(TestCase):
+    """Unittests for manifest-tracked, resumable downloads"""
+
+    def setUp(self):
+        """Start local server and temporary datain"""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.requests = []
+        self.server.fail_once = False
+        self.server.fail_requests = 0
+        self.server.payload = PAYLOAD
+        self.server.lock = threading.Lock()
+        self.server.active = 0
+        self.server.max_active = 0
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+        self.url = f'http://127.0.0.1:{port}//201601/vcmcfg/SVDNB_npp_20160101-20160131_75N180W_vcmcfg_v10_c201603132032.tgz'
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        """Stop server"""
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_resume_partial_download(self):
+        """Interrupted download continues from last byte with a Range request"""
+        manifest = DownloadManifest(self.base_dir.joinpath('manifest.json'))
+        tile = DownloadViirs(self.url, manifest=manifest, base_dir=self.base_dir)
+        self.server.fail_once = True
+        http = make_pool_manager()
+        with self.assertRaises(Exception):
+            tile.download_rasters(http)
+        self.assertFalse(manifest.is_complete(self.url))
+        tile.download_rasters(http)
+        file_loc = tile.download_path.joinpath(tile.download_zip_name)
+        self.assertEqual(file_loc.read_bytes(), PAYLOAD)
+        self.assertIsNotNone(self.server.requests[-1])
+        self.assertTrue(manifest.verify(self.url))
+
+    def test_stale_partial_file_downloaded_again(self):
+        """A 416 for a local file longer than the remote one downloads the whole file again instead of marking it complete"""
+        manifest = DownloadManifest(self.base_dir.joinpath('manifest.json'))
+        tile = DownloadViirs(self.url, manifest=manifest, base_dir=self.base_dir)
+        file_loc = tile.download_path.joinpath(tile.download_zip_name)
+        file_loc.write_bytes(PAYLOAD + b'stale')
+        self.assertEqual(tile.download_rasters(), len(PAYLOAD))
+        self.assertEqual(file_loc.read_bytes(), PAYLOAD)
+        self.assertEqual(self.server.requests, [f'bytes={len(PAYLOAD) + 5}-', None])
+        self.assertTrue(manifest.verify(self.url))
+
+    def test_retries_with_backoff(self):
+        """Failed requests are retried after waits growing by backoff, until the download succeeds or retries run out"""
+        manifest_path = self.base_dir.joinpath('manifest.json')
+        self.server.fail_requests = 2
+        with mock.patch('download_viirs.time.sleep') as sleep:
+            results = BatchDownloadViirs([self.url], workers=1, retries=3, backoff=2, manifest_path=manifest_path, base_dir=self.base_dir).download_all()
+        self.assertEqual(len(self.server.requests), 3)
+        #urllib3 also sleeps 0 between its own attempts
+        self.assertEqual([x.args[0] for x in sleep.call_args_list if x.args[0]], [1, 2])
+        self.assertEqual(results[self.url][0], len(PAYLOAD))
+        self.assertTrue(DownloadManifest(manifest_path).verify(self.url))
+        url = self.url.replace('75N180W', '00N060W')
+        self.server.fail_requests = 5
+        with mock.patch('download_viirs.time.sleep'):
+            batch = BatchDownloadViirs([url], workers=1, retries=1, manifest_path=manifest_path, base_dir=self.base_dir)
+            self.assertEqual(batch.download_all(), {})
+        self.assertEqual(batch.failed, [url])
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_bounded_concurrency(self):
+        """No more than workers tiles are downloaded at once"""
+        self.server.delay = 0.05
+        hrefs = [self.url.replace('75N180W', extent) for extent in ['75N180W', '75N060W', '75N060E', '00N180W', '00N060W', '00N060E']]
+        results = BatchDownloadViirs(hrefs, workers=2, manifest_path=self.base_dir.joinpath('manifest.json'), base_dir=self.base_dir).download_all()
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_skip_if_complete(self):
+        """Second run reads the manifest and never contacts the server"""
+        manifest_path = self.base_dir.joinpath('manifest.json')
+        BatchDownloadViirs([self.url], workers=2, backoff=0, manifest_path=manifest_path, base_dir=self.base_dir).download_all()
+        n_requests = len(self.server.requests)
+        results = BatchDownloadViirs([self.url], workers=2, manifest_path=manifest_path, base_dir=self.base_dir).download_all()
+        self.assertEqual(len(self.server.requests), n_requests)
+        self.assertEqual(results[self.url], (0, 0.0))
+        entry = DownloadManifest(manifest_path).get(self.url)
+        self.assertEqual(entry['size'], len(PAYLOAD))
+        self.assertEqual(entry['sha256'], file_sha256(entry['file']))
+
+    def serve_archive(self, products=('avg_rade9h', 'cf_cvg', 'cvg'), stem='SVDNB_npp_20160101-20160131_75N180W_vcmcfg_v10_c201603132032'):
+        """Makes server send a tgz of one member per product and returns the member name stem"""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for product in products:
+                info = tarfile.TarInfo(f'{stem}.{product}.tif')
+                info.size = len(PAYLOAD)
+                tar.addfile(info, io.BytesIO(PAYLOAD))
+        self.server.payload = archive.getvalue()
+        return stem
+
+    def test_extracted_archive_stays_complete(self):
+        """Deleting the tgz after extracting it leaves an entry that verifies, so the next run downloads nothing"""
+        stem = self.serve_archive()
+        manifest_path = self.base_dir.joinpath('manifest.json')
+        BatchDownloadViirs([self.url], extract=True, manifest_path=manifest_path, base_dir=self.base_dir).download_all()
+        manifest = DownloadManifest(manifest_path)
+        self.assertIsNone(manifest.get(self.url)['file'])
+        self.assertEqual(len(manifest.get(self.url)['members']), 3)
+        self.assertTrue(manifest.verify(self.url))
+        n_requests = len(self.server.requests)
+        results = BatchDownloadViirs([self.url], extract=True, manifest_path=manifest_path, base_dir=self.base_dir).download_all()
+        self.assertEqual(results[self.url], (0, 0.0))
+        self.assertEqual(len(self.server.requests), n_requests)
+        self.assertTrue(Path(manifest.get(self.url)['members'][0]).name.startswith(stem))
+
+    def test_stream_extract_keeps_wanted_members(self):
+        """Only wanted products are written and the tgz never lands on disk"""
+        stem = self.serve_archive()
+        manifest = DownloadManifest(self.base_dir.joinpath('manifest.json'))
+        tile = DownloadViirs(self.url, manifest=manifest, base_dir=self.base_dir)
+        tile.stream_extract(products=('avg_rade9h', 'cvg'))
+        written = sorted(x.name for x in tile.download_path.iterdir())
+        self.assertEqual(written, [f'{stem}.avg_rade9h.tif', f'{stem}.cvg.tif'])
+        self.assertEqual(tile.download_path.joinpath(f'{stem}.cvg.tif').read_bytes(), PAYLOAD)
+        self.assertEqual(len(manifest.get(self.url)['members']), 2)
+        self.assertTrue(manifest.verify(self.url))
+        tile.download_path.joinpath(f'{stem}.cvg.tif').unlink()
+        self.assertFalse(manifest.verify(self.url))
+
+    def test_stream_extract_annual_members(self):
+        """Default products keep the avg_rade9 members of annual composites, and an archive without wanted members raises"""
+        stem = self.serve_archive(('avg_rade9', 'cf_cvg', 'cvg'), 'SVDNB_npp_20160101-20161231_75N180W_vcm-orm-ntl_v10_c201807311200')
+        tile = DownloadViirs(self.url, base_dir=self.base_dir)
+        tile.stream_extract()
+        self.assertEqual(sorted(x.name for x in tile.download_path.iterdir()), [f'{stem}.avg_rade9.tif', f'{stem}.cvg.tif'])
+        self.serve_archive(('cf_cvg',))
+        with self.assertRaises(ValueError):
+            tile.stream_extract()
+
+
+class CogConversion(TestCase):
+    """Unittests for rewriting extracted tiles as Cloud-Optimized GeoTIFF"""
+
+    def setUp(self):
+        """Striped float GeoTIFF larger than one COG block"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tile = Path(self.tmp.name).joinpath('SVDNB_npp_20160101-20160131_75N180W_vcmcfg_v10_c201603132032.avg_rade9h.tif')
+        self.data = np.random.default_rng(0).random((1100, 1300), dtype='float32')
+        with rasterio.open(str(self.tile), 'w', driver='GTiff', width=1300, height=1100, count=1, dtype='float32',
+                           crs='EPSG:4326', transform=from_origin(-180, 75, 1 / 240, 1 / 240)) as dst:
+            dst.write(self.data, 1)
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def test_convert_once(self):
+        """Tile becomes a tiled COG with overviews and the same values, and a second run leaves it alone"""
+        self.assertTrue(cog_driver_available())
+        manifest = DownloadManifest(Path(self.tmp.name).joinpath('manifest.json'))
+        ConvertToCOG([self.tile], manifest=manifest, url='url').convert_all()
+        with rasterio.open(str(self.tile)) as src:
+            self.assertEqual(src.tags(ns='IMAGE_STRUCTURE')['LAYOUT'], 'COG')
+            self.assertEqual(src.block_shapes, [(512, 512)])
+            self.assertEqual(src.overviews(1), [2, 4])
+            np.testing.assert_array_equal(src.read(1), self.data)
+        self.assertEqual(manifest.get('url')['cog'], [str(self.tile)])
+        mtime = self.tile.stat().st_mtime_ns
+        ConvertToCOG([self.tile], manifest=manifest, url='url').convert_all()
+        self.assertEqual(self.tile.stat().st_mtime_ns, mtime)
+        self.assertEqual({x.name for x in Path(self.tmp.name).iterdir()}, {'manifest.json', self.tile.name})
+
+    def test_missing_driver(self):
+        """Without the COG driver conversion fails before touching any tile"""
+        with mock.patch('convert_tiles.cog_driver_available', return_value=False):
+            with self.assertRaisesRegex(RuntimeError, 'COG driver'):
+                ConvertToCOG([self.tile]).convert_all()
+        with rasterio.open(str(self.tile)) as src:
+            self.assertNotIn('LAYOUT', src.tags(ns='IMAGE_STRUCTURE'))
+
+
+class Catalog(TestCase):
+    """Unittests for the local NOAA catalog"""
+
+    def test_parse_href(self):
+        """Fields of monthly and annual NOAA file names"""
+        base = 'https://data.ngdc.noaa.gov/instruments/remote-sensing/passive/spectrometers-radiometers/imaging/viirs/dnb_composites/v10/'
+        monthly = base + '/201601/vcmslcfg/SVDNB_npp_20160101-20160131_75N180W_vcmslcfg_v10_c201603152010.tgz'
+        annual = base + '/2016/vcmcfg/SVDNB_npp_20160101-20161231_00N060W_vcm-orm-ntl_v10_c201807311200.tgz'
+        self.assertEqual(parse_href(monthly), {'year': 2016, 'month': 1, 'extent': '75N180W', 'product': 'SVDNB', 'config': 'vcmslcfg', 'annual': 0, 'url': monthly})
+        self.assertEqual(parse_href(annual), {'year': 2016, 'month': None, 'extent': '00N060W', 'product': 'SVDNB', 'config': 'vcmcfg', 'annual': 1, 'url': annual})
+
+    def test_query_without_network(self):
+        """Fresh catalog answers queries from SQLite and ignores already known hrefs"""
+        base = 'https://data.ngdc.noaa.gov/instruments/remote-sensing/passive/spectrometers-radiometers/imaging/viirs/dnb_composites/v10/'
+        hrefs = [base + '/201601/vcmcfg/SVDNB_npp_20160101-20160131_75N180W_vcmcfg_v10_c201603132032.tgz',
+                 base + '/201601/vcmslcfg/SVDNB_npp_20160101-20160131_75N180W_vcmslcfg_v10_c201603132032.tgz',
+                 base + '/2016/vcmcfg/SVDNB_npp_20160101-20161231_75N180W_vcm-orm-ntl_v10_c201807311200.tgz',
+                 base + '/201501/vcmcfg/SVDNB_npp_20150101-20150131_00N060W_vcmcfg_v10_c201505111709.tgz']
+        with tempfile.TemporaryDirectory() as tmp:
+            catalog = NOAACatalog(Path(tmp).joinpath('catalog.sqlite'), url='http://127.0.0.1:1/unreachable')
+            self.assertEqual(catalog.add_hrefs(hrefs), 4)
+            self.assertEqual(catalog.add_hrefs(hrefs), 0)
+            self.assertEqual(catalog.refresh(), 0)
+            self.assertEqual(catalog.query([2016], ['75N180W']), hrefs[:1])
+            self.assertEqual(len(catalog.query([2016], ['75N180W'], annual_composites=True)), 2)
+            catalog.close()
+
+
+if __name__ == "__main__":
+    testmain()
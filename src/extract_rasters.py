@@ -1,44 +1,157 @@
 """Extract data from VIIRS in_rasters using shapefiles as input."""
 from pathlib import Path
+from functools import lru_cache
+import math
 import subprocess
 import geopandas as gpd
 import numpy as np 
 import rasterio
+from rasterio import windows
+from rasterio.features import geometry_mask
+from rasterio.merge import merge
 from rasterio._fill import _fillnodata
+from output_profiles import output_profile, finalise
 
 class ExtractFromTiles:
     """Class to extract VIIRS data from in_rasters using shapefiles as input"""
 
-    def __init__(self, in_raster, shp, out_raster):
+    def __init__(self, in_raster, shp, out_raster, engine='rasterio', preset='fast-scratch'):
         """Initialisation function
 
         in_raster --> Input VIIRS in_raster
         shp --> Shapefile from which to extract raster
         out_raster --Output file name
+        engine --> 'rasterio' clips in process with a window read and cutline mask. 'gdalwarp' shells out to gdalwarp. Default is 'rasterio'
+        preset --> Output profile preset of rasterio engine (see output_profiles). Default is 'fast-scratch'
 
         returns None
         """
         self.in_raster = in_raster
         self.shp = shp
         self.out_raster = out_raster
+        self.engine = engine
+        self.preset = preset
+        self.gdf = read_shapes(self.shp)
         self.bounding_box = self.get_extent()
-        self.clip_raster(self.bounding_box)
+        if self.engine == 'gdalwarp':
+            self.clip_raster(self.bounding_box)
+        elif self.engine == 'rasterio':
+            self.clip_window(self.bounding_box)
+        else:
+            raise ValueError(f'engine should be rasterio or gdalwarp, not {self.engine}')
 
     def get_extent(self):
         """Get bounding box of shapefile to specify extent of extracted raster.
-		returns bounding box of shapefile
+		returns union bounding box of all features in shapefile
 		"""
-        gdf = gpd.read_file(str(self.shp))
-        extent = gdf['geometry'].bounds
+        minx, miny, maxx, maxy = self.gdf.total_bounds
         bounding_box = {}
-        bounding_box['minx'] = extent.loc[0]['minx']
-        bounding_box['miny'] = extent.loc[0]['miny']
-        bounding_box['maxx'] = extent.loc[0]['maxx']
-        bounding_box['maxy'] = extent.loc[0]['maxy']
+        bounding_box['minx'] = minx
+        bounding_box['miny'] = miny
+        bounding_box['maxx'] = maxx
+        bounding_box['maxy'] = maxy
         return bounding_box
 
     def clip_raster(self, bounding_box):
+        """Clips in_raster to bounding box and cutline with gdalwarp subprocess"""
         minx, miny, maxx, maxy = bounding_box['minx'], bounding_box['miny'], bounding_box['maxx'], bounding_box['maxy']
         gdal_cmd = f'gdalwarp --config GDALWARP_IGNORE_BAD_CUTLINE YES -te {minx} {miny} {maxx} {maxy} -crop_to_cutline -cutline {str(self.shp)} {str(self.in_raster)} {str(self.out_raster)}'
         subprocess.call(gdal_cmd, shell=True)
 
+    def clip_window(self, bounding_box):
+        """Clips in_raster in process. See clip_to_shapes"""
+        with rasterio.open(str(self.in_raster)) as src:
+            clip_to_shapes(src, self.gdf, bounding_box, self.out_raster, self.preset)
+
+class ExtractCountriesFromTile:
+    """Class to cut every requested country out of one tile while the tile is open once"""
+
+    def __init__(self, tile, targets, cache_mb=1024, preset='fast-scratch', index=None):
+        """Initialisation function
+
+        tile --> Input VIIRS tile
+        targets --> Dictionary of {out_raster: shp} for every country in the tile
+        cache_mb --> GDAL block cache shared by all countries so overlapping windows are decoded once. Default is 1024
+        preset --> Output profile preset (see output_profiles). Default is 'fast-scratch'
+        index --> TileIndex. If given, only the window of each country's part inside the tile footprint is read. Default is None (bounding box of country)
+
+        returns None
+        """
+        self.tile = tile
+        self.targets = targets
+        self.cache_mb = cache_mb
+        self.preset = preset
+        self.index = index
+        self.extract_all()
+
+    def extract_all(self):
+        """Opens tile once and clips window and cutline of each target"""
+        with rasterio.Env(GDAL_CACHEMAX=self.cache_mb), rasterio.open(str(self.tile)) as src:
+            for out_raster, shp in self.targets.items():
+                gdf = read_shapes(shp)
+                minx, miny, maxx, maxy = gdf.total_bounds
+                bounding_box = {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
+                window = self.index.window_for_shapes(gdf, src) if self.index is not None else None
+                clip_to_shapes(src, gdf, bounding_box, out_raster, self.preset, window)
+
+def read_shapes(shp):
+    """Returns GeoDataFrame of shapefile, read once per path until the file changes.
+    Each call gets its own copy, so callers may change it without changing the cached one
+    """
+    return _read_shapes(str(shp), Path(shp).stat().st_mtime_ns).copy()
+
+@lru_cache(maxsize=64)
+def _read_shapes(shp, mtime_ns):
+    """Cached reader behind read_shapes"""
+    return gpd.read_file(shp)
+
+def clip_to_shapes(src, gdf, bounding_box, out_raster, preset='fast-scratch', window=None):
+    """Reads only the window of open dataset src covering bounding box and masks pixels outside gdf in memory.
+    Window is snapped outwards to source pixels so values are never resampled.
+    Pixels outside cutline get source nodata, or 0 like gdalwarp if source has none
+    window --> Window to read instead of the one covering bounding box, e.g. from TileIndex.window_for_shapes. Default is None
+    """
+    if gdf.crs is not None and src.crs is not None:
+        gdf = gdf.to_crs(src.crs)
+    if window is None:
+        window = bounds_to_window(bounding_box, src.transform, src.width, src.height)
+    data = src.read(window=window)
+    transform = src.window_transform(window)
+    outside = geometry_mask(gdf['geometry'], out_shape=data.shape[-2:], transform=transform)
+    data[:, outside] = src.nodata if src.nodata is not None else 0
+    profile = dict(src.profile, height=data.shape[1], width=data.shape[2], transform=transform)
+    with rasterio.open(str(out_raster), 'w', **output_profile(profile, preset, nodata=src.nodata)) as dst:
+        dst.write(data)
+    finalise(out_raster, preset)
+
+def bounds_to_window(bounding_box, transform, width, height):
+    """Returns window of whole pixels covering bounding box, limited to raster size"""
+    window = windows.from_bounds(bounding_box['minx'], bounding_box['miny'], bounding_box['maxx'], bounding_box['maxy'], transform=transform)
+    col_off = math.floor(round(window.col_off, 6))
+    row_off = math.floor(round(window.row_off, 6))
+    col_stop = math.ceil(round(window.col_off + window.width, 6))
+    row_stop = math.ceil(round(window.row_off + window.height, 6))
+    col_off, row_off = max(col_off, 0), max(row_off, 0)
+    col_stop, row_stop = min(col_stop, width), min(row_stop, height)
+    return windows.Window(col_off, row_off, max(col_stop - col_off, 0), max(row_stop - row_off, 0))
+
+def mosaic_parts(parts, out_raster, delete=True, preset='fast-scratch'):
+    """Merges rasters clipped from neighbouring tiles (which share the global VIIRS grid) into out_raster
+    parts --> List of rasters to merge
+    delete --> Remove parts once merged. Default is True
+    preset --> Output profile preset (see output_profiles). Default is 'fast-scratch'
+    """
+    sources = [rasterio.open(str(x)) for x in parts]
+    try:
+        data, transform = merge(sources)
+        profile = sources[0].profile
+    finally:
+        for src in sources:
+            src.close()
+    profile = dict(profile, height=data.shape[1], width=data.shape[2], transform=transform)
+    with rasterio.open(str(out_raster), 'w', **output_profile(profile, preset, nodata=profile['nodata'])) as dst:
+        dst.write(data)
+    finalise(out_raster, preset)
+    if delete:
+        for part in parts:
+            Path(part).unlink()
@@ -0,0 +1,42 @@
+"""Module to rasterize admin units into an integer label grid on the grid of a raster, so all units can be reduced in one pass"""
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio import features
+
+class LabelGrid:
+    """Label raster of admin units: 0 outside all units, i + 1 inside the unit in row i of the shapefile"""
+
+    def __init__(self, shp, transform, shape, name_field='ADM1', crs=None):
+        """Initialisation function
+        shp --> Shapefile of admin units
+        transform --> Affine transform of raster grid
+        shape --> (rows, cols) of raster grid
+        name_field --> Column holding admin unit names. Default is 'ADM1'
+        crs --> crs of raster grid. Shapes are reprojected if it differs
+        """
+        self.shp = shp
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.name_field = name_field
+        gdf = gpd.read_file(str(self.shp))
+        if crs is not None and gdf.crs is not None:
+            gdf = gdf.to_crs(crs)
+        self.names = list(gdf[self.name_field])
+        self.labels = self.rasterize(gdf)
+
+    @classmethod
+    def from_raster(cls, shp, raster, name_field='ADM1'):
+        """Returns LabelGrid on the grid of raster"""
+        with rasterio.open(str(raster)) as src:
+            return cls(shp, src.transform, src.shape, name_field=name_field, crs=src.crs)
+
+    @property
+    def n_labels(self):
+        """Number of admin units (labels run 1..n_labels)"""
+        return len(self.names)
+
+    def rasterize(self, gdf):
+        """Returns int32 label array. Pixel centres decide membership, as in rasterstats"""
+        shapes = ((geometry, index + 1) for index, geometry in enumerate(gdf['geometry']))
+        return features.rasterize(shapes, out_shape=self.shape, transform=self.transform, fill=0, dtype='int32')
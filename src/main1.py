@@ -1,15 +1,17 @@
 """Main module for new (15/05/2019) method to extract VIIRS, find optimal threshold, baseline NTL month from which to compare other months, and calculate zonal stats"""
 from pathlib import Path
-import shutil
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from extract_rasters import ExtractFromTiles
-from reclass_rasters import SetThreshold, NormaliseAdminUnits, ReclassByThreshold
+from extract_rasters import ExtractFromTiles, mosaic_parts
+from reclass_rasters import SetThreshold, NormaliseAdminUnits
 from split_admin_units import SplitAdminUnits, MergeAdminUnits
 from smooth_outliers import SmoothOutliers
-from viirs_zonal_stats import VIIRSZonalStats, PPPZonalStats, ThresholdZonalStats
+from viirs_zonal_stats import VIIRSZonalStats, PPPZonalStats
+from threshold_sweep import ThresholdSweep, pearson_rows
+from results_store import ResultsStore
 from graphs_maps import GraphMaps
+from tile_index import TileIndex
 
 class GetOptimalThresholdValue:
     """Class to loop through range of radiance values to find optimal threshold that best correlates with population raster of year. Uses annual average composite (VIIRS) and 2016 ppp (WorldPop)"""
@@ -29,47 +31,32 @@ class GetOptimalThresholdValue:
         self.rad_max = rad_max
         self.rad_interval = rad_interval
         self.rad_raster = rad_raster
-        self.temp_rad_raster = self.rad_raster.parent.joinpath(f'{self.country}_tmp_rad.tif')
         self.thresholds_csv = self.rad_raster.parent.joinpath(f'{self.country}_thresholds.csv')
-        shutil.copy(self.rad_raster, self.temp_rad_raster)
-        PPPZonalStats(self.country, self.level, self.ppp, self.shp, self.thresholds_csv)
+        self.store = ResultsStore(self.rad_raster.parent.joinpath('results'))
+        PPPZonalStats(self.country, self.level, self.ppp, self.shp, self.thresholds_csv, engine='coverage')
         self.loop_through_thresholds()
 
     def loop_through_thresholds(self):
-        """Function to loop throught iterations and call functions to extract raster according to thresholds, run zonal stats and check correlation"""
-        for i in np.arange(self.rad_min, self.rad_max + self.rad_interval, self.rad_interval):
-            self.reclass_to_threshold(i)
-            self.radiance_zonal_stats(i)
+        """Function to get zonal stats of radiance at every threshold in one pass (see threshold_sweep), append them to results store and check correlation"""
+        self.thresholds = np.arange(self.rad_min, self.rad_max + self.rad_interval, self.rad_interval)
+        sweep = ThresholdSweep(self.rad_raster, self.shp, self.thresholds, fields=['GID'], coverage=True)
+        self.store.append_wide(sweep.table(), self.country, self.level, 'GID', month='annual')
         self.get_max_threshold()
 
-
-    def reclass_to_threshold(self, i):
-        """Reclass raster to threshold"""
-        ReclassByThreshold(self.rad_raster, i, self.rad_raster.parent.joinpath(f'{self.country}_tmp_rad.tif'))
-
-    def radiance_zonal_stats(self, i):
-        """Function to get zonal stats of radiance when classified to threshold value"""
-        ThresholdZonalStats(self.temp_rad_raster, self.shp, self.level, i, self.thresholds_csv)
-
     def get_max_threshold(self):
         """Get maximum correlation between radiance threshold and ppp"""
-        df = pd.read_csv(self.thresholds_csv)
-        sums = [x for x in df.columns.values if x.startswith('sum')]
-        sums.remove('sum')
-        df_final = dict()
-        for column in sums:
-            df_corr = df[['sum', column]]
-            df_corr = df_corr.corr(method='pearson')
-            df_final[column] = [df_corr[column][0]]
-        df_sums = pd.DataFrame.from_dict(df_final)
-        max_corr = df_sums.max(axis=1)
-        max_threshold = df.idxmax(axis=1)
+        sums = [f'sum{threshold}' for threshold in self.thresholds]
+        df = pd.read_csv(self.thresholds_csv)[['GID', 'sum']]
+        df['zone'] = df['GID'].astype(str)
+        df = df.merge(self.store.wide(country=self.country, level=self.level, month='annual', metric=sums), on='zone')
+        correlations = pearson_rows(df['sum'].values, df[sums].values.T)
+        df_sums = pd.DataFrame({'Threshold': correlations}, index=sums)
+        max_threshold = df_sums['Threshold'].idxmax()
+        max_corr = df_sums['Threshold'].max()
         print(f'maximum threshold is {max_threshold} with correlation of {max_corr}')
-        df_sums = df_sums.transpose()
-        df_sums.columns = ['Threshold']
         line = df_sums.plot.line(figsize=(12,12),title=f'{self.country} lights correlation with ppp')
         line.set_ylabel('Radiance')
-        plt.savefig(self.temp_rad_raster.parent.joinpath(f'{self.country}_lights_corr_with_ppp.png'))
+        plt.savefig(self.rad_raster.parent.joinpath(f'{self.country}_lights_corr_with_ppp.png'))
         plt.close()
 
         
@@ -82,20 +69,28 @@ class GetOptimalThresholdValue:
 if __name__ == "__main__":
     BASEDIR = Path(__file__).resolve().parent.parent
     #countries = {'HTI': '75N180W', 'GHA': '75N060W', 'MOZ': '00N060W', 'NAM': '00N060W', 'NPL': '75N060E'}
-    countries = {'HTI': {'location': '75N180W', 'admin_level': 4}}
+    countries = {'HTI': {'admin_level': 4}}
     print(BASEDIR)
     TILESDIR = sorted([x for x in Path('/home/david/Documents/work/VIIRS/download_viirs/datain/2016').iterdir() if x.name == 'ANNUAL_Composite_2016'])[0]
+    index = TileIndex()
     for country, info in countries.items():
-        rad_tile = TILESDIR.joinpath(f'SVDNB_npp_20160101-20161231_{info["location"]}_vcm-orm-ntl_v10_c201807311200.avg_rade9.tif')
-        cvg_tile = TILESDIR.joinpath(f'SVDNB_npp_20160101-20161231_{info["location"]}_vcm_v10_c201807311200.cvg.tif')
+        shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm{info["admin_level"]}.shp')
+        extents = index.tiles_for(shp)
         threshold_selection = BASEDIR.joinpath(f'datain/{country}/threshold_selection')
         if not threshold_selection.exists():
             threshold_selection.mkdir(parents=True, exist_ok=True)
         ppp = BASEDIR.joinpath(f'datain/{country}/ppp_2016/{country.lower()}_ppp_2016.tif')
-        shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm{info["admin_level"]}.shp')
         out_raster_rad = BASEDIR.joinpath(f'datain/{country}/threshold_selection/{country}_ann_rad.tif')
         if not out_raster_rad.exists():
-            ExtractFromTiles(rad_tile, shp, out_raster_rad)
+            #Countries crossing a tile edge are clipped from each tile and mosaicked
+            parts = []
+            for extent in extents:
+                rad_tile = TILESDIR.joinpath(f'SVDNB_npp_20160101-20161231_{extent}_vcm-orm-ntl_v10_c201807311200.avg_rade9.tif')
+                part = out_raster_rad.with_name(f'{out_raster_rad.stem}_{extent}.tif') if len(extents) > 1 else out_raster_rad
+                ExtractFromTiles(rad_tile, shp, part)
+                parts.append(part)
+            if len(extents) > 1:
+                mosaic_parts(parts, out_raster_rad)
         threshold = GetOptimalThresholdValue(country, info['admin_level'], out_raster_rad, shp, ppp, 0, 5, rad_interval=0.05)
         
         
\ No newline at end of file
@@ -1,108 +1,71 @@
 """Main module to call all classes and functions associated with downloading, preprocessing and analysing VIIRS NTL"""
 from pathlib import Path
-from extract_rasters import ExtractFromTiles
-from reclass_rasters import SetThreshold, NormaliseAdminUnits
-from split_admin_units import SplitAdminUnits, MergeAdminUnits
-from smooth_outliers import SmoothOutliers
-from viirs_zonal_stats import VIIRSZonalStats
+from tile_index import TileIndex
+from national_rasters import extract_national_rasters
+from reclass_rasters import NormaliseAdminViews
+from admin_views import AdminViews
+from preprocess import PreprocessRadiance
+from results_store import ResultsStore
+from time_series import ZonalTimeSeries, find_periods
 from graphs_maps import GraphMaps
-
-def extract_national_rasters(TILESDIR, countries):
-    """Extract national rasters from tiles"""
-    for month in TILESDIR:
-        for country, extent in countries.items():
-            shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm1.shp')
-            tiles = [x for x in month.iterdir() if extent in x.name if x.name.endswith('.tif')]
-            for tile in tiles:
-                tile_folder = BASEDIR.joinpath(f'datain/{country}/{month.name}')
-                if not tile_folder.exists():
-                    tile_folder.mkdir(parents=True, exist_ok=True)
-                if tile.name.endswith('rade9h.tif'):
-                    outfile = tile_folder.joinpath(f'{country}_{month.name}_rad_tmp.tif')
-                else:
-                    outfile = tile_folder.joinpath(f'{country}_{month.name}_cvg.tif')
-                if not outfile.exists():
-                    ExtractFromTiles(tile, shp, outfile)
-
-
-
-def explode_shapefiles(iso):
-    """Explode national shapefiles into admin units"""
-    shp = BASEDIR.joinpath(f'datain/shps/{iso}/{iso}_adm1.shp')
-    adm_shp_folder = shp.parent.joinpath('adm_units')
-    if not adm_shp_folder.exists():
-        adm_shp_folder.mkdir(parents=True, exist_ok=True)
-    SplitAdminUnits(shp, adm_shp_folder)
-
-
-
-def set_threshold(country):
-    """Set threshold value of coverages seen by satellite"""
-    months = [x for x in BASEDIR.joinpath(f'datain/{country}').iterdir()]
-    for month in months:
-        rad = [x for x in month.iterdir() if x.name.endswith('rad_tmp.tif')][0]
-        cvg = [x for x in month.iterdir() if x.name.endswith('cvg.tif')][0]
-        out_rad = Path(str(rad)[:-11] + 'rad_thrsh_set.tif')
-        SetThreshold(rad, cvg, out_rad, cvg_threshold=5, rad_threshold=2) #Reclassifies based on threshold value and deletes tmp file
-
-
-def remove_outliers_outside_capital(country):
-    """Remove values higher than highest in capital. This iteration does not interpolate or change values --> only makes NoData"""
+from pipeline import Pipeline
+
+def preprocess_months(country, debug=False, cvg_threshold=5, rad_threshold=2, overwrite=False):
+    """Set coverage and radiance thresholds and remove values higher than capital max in one pass per month
+    debug --> Also write the intermediate rad_thrsh_set raster. Default is False
+    cvg_threshold, rad_threshold --> See PreprocessRadiance. Defaults are 5 and 2
+    overwrite --> Preprocess months whose output already exists again. Default is False
+    """
     capital_shp = BASEDIR.joinpath(f'datain/shps/capitals/{country}_capital.shp')
     months = [x for x in BASEDIR.joinpath(f'datain/{country}').iterdir()]
     for month in months:
-        rad_raster = [x for x in month.iterdir() if x.name.endswith('rad_thrsh_set.tif')][0]
+        rad = month.joinpath(f'{country}_{month.name}_rad_tmp.tif')
+        cvg = month.joinpath(f'{country}_{month.name}_cvg.tif')
         out_raster = month.joinpath(f'{country}_{month.name}_rad_cap_smth.tif')
-        if not out_raster.exists():
-            cap_smth = SmoothOutliers(rad_raster, capital_shp, out_raster)
-            cap_max = cap_smth.get_max_in_capital()
-            cap_smth.remove_cap_max(cap_max)
-
-def extract_admin_rasters(country):
-    """Extract admin unit rasters from national-level raster"""
-    months = sorted([x for x in BASEDIR.joinpath(f'datain/{country}').iterdir()])
-    admin_units = [x for x in BASEDIR.joinpath(f'datain/shps/{country}/adm_units').iterdir() if x.name.endswith('.shp')]
-    for month in months:
-        subnational_raster_folder = month.joinpath('subnational')
-        if not subnational_raster_folder.exists():
-            subnational_raster_folder.mkdir(parents=True, exist_ok=True)
-        for admin_unit in admin_units:
-            national_rasters = [x for x in month.iterdir() if x.name.endswith('rad_cap_smth.tif')]
-            for raster in national_rasters:
-                outfile = subnational_raster_folder.joinpath(f'{admin_unit.name[:-4]}_{month.name}_rad.tif')
-                if not outfile.exists():
-                    ExtractFromTiles(raster, admin_unit, outfile)
-
-def normalise_admin_level_rasters_temporally(country):
-    """Rescale admin unit level rasters between 0 and 1. Lowest value in year will become 0 and highest will become 1, others will be rescaled in between"""
-    months = sorted([x for x in BASEDIR.joinpath(f'datain/{country}').iterdir()])
-    names = sorted([x.name.split('_')[0] for x in months[0].joinpath('subnational').iterdir() if x.name.endswith('rad.tif')])
-    NormaliseAdminUnits(names, months, country)
+        debug_thrsh_set = month.joinpath(f'{country}_{month.name}_rad_thrsh_set.tif') if debug else None
+        if overwrite or not out_raster.exists():
+            PreprocessRadiance(rad, cvg, capital_shp, out_raster, cvg_threshold=cvg_threshold, rad_threshold=rad_threshold, debug_thrsh_set=debug_thrsh_set)
 
-def merge_admin_units(country):
-    """Merge monthly admin unit rasters to national-level raster"""
+def normalise_admin_views(country):
+    """Rescale admin units between 0 and 1 over the year straight from national rasters, using in-memory admin views instead of per admin unit rasters"""
     months = sorted([x for x in BASEDIR.joinpath(f'datain/{country}').iterdir()])
-    if not months[0].joinpath(f'01/{country}/{country}_01_normalised.tif').exists():
-        MergeAdminUnits(country, months)
+    shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm1.shp')
+    raster = months[0].joinpath(f'{country}_{months[0].name}_rad_cap_smth.tif')
+    views = AdminViews.from_raster(shp, raster, name_field='ADM1')
+    NormaliseAdminViews(views, months, country)
 
-def do_zonal_stats(country):
-    """Calculate zonal stats for each admin unit"""
+def zonal_stats_outputs(country, years):
+    """Returns {year: (out_shp, out_csv)} of zonal stats tables of country. Tables of YYYY/MM folders get a _{year} suffix"""
+    outfolder = BASEDIR.joinpath(f'dataout/{country}')
+    outputs = {}
+    for year in years:
+        suffix = f'_{year}' if year else ''
+        outputs[year] = (outfolder.joinpath(f'{country}_zonal_stats_norm{suffix}.shp'), outfolder.joinpath(f'{country}_zonal_stats_norm{suffix}.csv'))
+    return outputs
+
+def do_zonal_stats(country, overwrite=False):
+    """Calculate zonal stats for each admin unit. Only months that are new or changed are computed, then tables are exported per year
+    overwrite --> Export tables even if no month changed and they exist. Default is False
+    """
     outfolder = BASEDIR.joinpath(f'dataout/{country}')
     if not outfolder.exists():
         outfolder.mkdir(parents=True, exist_ok=True)
-    months = sorted([x for x in BASEDIR.joinpath(f'datain/{country}').iterdir()])
     shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm1.shp')
-    out_shp = outfolder.joinpath(f'{country}_zonal_stats_norm.shp')
-    out_csv = outfolder.joinpath(f'{country}_zonal_stats_norm.csv')
-    if not out_shp.exists():
-        VIIRSZonalStats(country, months, shp, out_shp, out_csv, raster_type='_normalised.tif') ### Change this according to zonal stats to be done (normalised OR seasonality coefficient) ###
+    periods = find_periods(BASEDIR.joinpath(f'datain/{country}'), country, '_normalised.tif') ### Change this according to zonal stats to be done (normalised OR seasonality coefficient) ###
+    series = ZonalTimeSeries(country, 1, shp, periods, ResultsStore(outfolder.joinpath('results')))
+    updated = series.update()
+    for year, (out_shp, out_csv) in zonal_stats_outputs(country, sorted({year for year, _ in periods})).items():
+        if overwrite or updated or not out_shp.exists() or not out_csv.exists():
+            series.export(year, out_shp, out_csv)
 
 
 def make_graphs_maps(country):
+    """Graphs and maps of every year's zonal stats table, in mapsgraphs (or mapsgraphs_{year} for YYYY/MM folders)"""
     shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm1.shp')
-    csv = BASEDIR.joinpath(f'dataout/{country}/{country}_zonal_stats_norm.csv')
-    outpath = BASEDIR.joinpath(f'dataout/{country}/mapsgraphs')
-    GraphMaps(country, shp, csv, outpath)
+    periods = find_periods(BASEDIR.joinpath(f'datain/{country}'), country, '_normalised.tif')
+    for year, (_, csv) in zonal_stats_outputs(country, sorted({year for year, _ in periods})).items():
+        outpath = BASEDIR.joinpath(f'dataout/{country}/mapsgraphs{"_" + year if year else ""}')
+        GraphMaps(country, shp, csv, outpath)
 
     
 
@@ -112,45 +75,48 @@ def make_graphs_maps(country):
 
 
 
-def main():
-    #extract national_rasters    
+def build_pipeline(TILESDIR, countries):
+    """Returns Pipeline of all stages. Each stage reruns only when its inputs or parameters change (see pipeline)"""
+    months = [x.name for x in TILESDIR]
+    shps = {country: BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm1.shp') for country in countries}
+    index = TileIndex()
+    extents = {x for shp in shps.values() for x in index.tiles_for(shp)}
+    tiles = [x for month in TILESDIR for x in sorted(month.iterdir()) if x.name.endswith('.tif') if index.extent_of(x) in extents]
+    def month_rasters(country, raster_type):
+        return [BASEDIR.joinpath(f'datain/{country}/{month}/{country}_{month}{raster_type}') for month in months]
+    #tiles sit in datain/{year}/{month} next to the download manifest (see download_viirs)
+    pipeline = Pipeline(manifest=TILESDIR[0].parent.parent.joinpath('download_manifest.json'))
+    #extract national_rasters. Tiles are fingerprinted by size, time and manifest checksum instead of being read
+    extracted = [x for country in countries for x in month_rasters(country, '_rad_tmp.tif') + month_rasters(country, '_cvg.tif')]
+    pipeline.add('extract', extract_national_rasters, inputs=list(shps.values()), raw_inputs=tiles, outputs=extracted,
+                 params={'basedir': BASEDIR, 'tiles_dirs': TILESDIR, 'countries': countries, 'overwrite': True})
+    for country in countries:
+        shp = shps[country]
+        capital_shp = BASEDIR.joinpath(f'datain/shps/capitals/{country}_capital.shp')
+        outfolder = BASEDIR.joinpath(f'dataout/{country}')
+        #set threshold and remove values greater than capital max
+        pipeline.add(f'preprocess_{country}', preprocess_months,
+                     inputs=month_rasters(country, '_rad_tmp.tif') + month_rasters(country, '_cvg.tif') + [capital_shp],
+                     outputs=month_rasters(country, '_rad_cap_smth.tif'),
+                     params={'country': country, 'cvg_threshold': 5, 'rad_threshold': 2, 'overwrite': True})
+        #normalise admin units over time from in-memory views of national rasters
+        pipeline.add(f'normalise_{country}', normalise_admin_views, inputs=month_rasters(country, '_rad_cap_smth.tif') + [shp],
+                     outputs=month_rasters(country, '_normalised.tif'), params={'country': country})
+        #zonal stats. Extracted months sit in MM folders, so there is one table without a year suffix
+        out_shp, out_csv = zonal_stats_outputs(country, [''])['']
+        pipeline.add(f'zonal_stats_{country}', do_zonal_stats, inputs=month_rasters(country, '_normalised.tif') + [shp],
+                     outputs=[out_csv, out_shp], params={'country': country, 'overwrite': True})
+        #graphs and maps
+        pipeline.add(f'graphs_maps_{country}', make_graphs_maps, inputs=[out_csv, shp],
+                     outputs=[outfolder.joinpath('mapsgraphs')], params={'country': country})
+    return pipeline
+
+def main(argv=None):
+    """Runs stages that are out of date. --dry-run lists them without running, --from-stage NAME forces NAME and all stages after it"""
     TILESDIR = sorted([x for x in Path('/home/david/Documents/work/VIIRS/download_viirs/datain/2016').iterdir() if not x.name == 'ANNUAL_Composite_2016'])
-    #countries = {'HTI': '75N180W', 'GHA': '75N060W', 'MOZ': '00N060W', 'NAM': '00N060W', 'NPL': '75N060E'}
-    countries = {'HTI': '75N180W'}    
-    extract_national_rasters(TILESDIR, countries)
-
-    #explode shapefiles
-    for iso, _ in countries.items():
-        explode_shapefiles(iso)
-
-    #set threshold
-    for country, _ in countries.items():
-        set_threshold(country)
-
-    #remove values greater than capital max
-    for country, _ in countries.items():
-        remove_outliers_outside_capital(country)
-
-    #Extract admin-level from national-level
-    for country, _ in countries.items():
-        extract_admin_rasters(country)
-
-    #normalise admin-level rasters over time
-    for country, _ in countries.items():
-        normalise_admin_level_rasters_temporally(country)
-
-    #### CHECK IF NORMALISING WAS THE BEST CHOICE ###
-    #merge normalised rasters (try setting extent to fix shift)
-    for country, _ in countries.items():
-        merge_admin_units(country)
-
-    #zonal stats
-    for country, _ in countries.items():
-        do_zonal_stats(country)
-
-    #graphs and maps.
-    for country, _ in countries.items():
-        make_graphs_maps(country)
+    #countries = ['HTI', 'GHA', 'MOZ', 'NAM', 'NPL']
+    countries = ['HTI']
+    build_pipeline(TILESDIR, countries).command_line(argv, description=__doc__)
 
 if __name__ == "__main__":
     BASEDIR = Path(__file__).resolve().parent.parent
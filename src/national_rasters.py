@@ -0,0 +1,45 @@
+"""Extract national rasters of every country from monthly VIIRS tiles. Shared by the main scripts"""
+from extract_rasters import ExtractCountriesFromTile, mosaic_parts
+from tile_index import TileIndex
+
+def extract_national_rasters(basedir, tiles_dirs, countries, overwrite=False, index=None):
+    """Extract national rasters from tiles into basedir/datain/{country}/{month}. Tiles each country needs and the pixel windows read
+    from them come from the tile index, and each tile is opened once for all its countries. Countries covering several tiles are clipped
+    from each and mosaicked
+    basedir --> Project folder holding datain
+    tiles_dirs --> Month folders of downloaded tiles
+    countries --> List of ISO codes. Boundaries are read from datain/shps/{country}/{country}_adm1.shp
+    overwrite --> Extract rasters that already exist again. Default is False
+    index --> TileIndex shared by all countries and tiles. Default is a new one of the six VIIRS tiles
+    """
+    index = index or TileIndex()
+    shps = {country: basedir.joinpath(f'datain/shps/{country}/{country}_adm1.shp') for country in countries}
+    country_tiles = {country: index.tiles_for(shp) for country, shp in shps.items()}
+    for month in tiles_dirs:
+        tiles = sorted(x for x in month.iterdir() if x.name.endswith('.tif'))
+        parts = {}
+        for tile in tiles:
+            extent = index.extent_of(tile)
+            targets = {}
+            for country, extents in country_tiles.items():
+                if extent not in extents:
+                    continue
+                tile_folder = basedir.joinpath(f'datain/{country}/{month.name}')
+                if not tile_folder.exists():
+                    tile_folder.mkdir(parents=True, exist_ok=True)
+                if tile.name.endswith('rade9h.tif'):
+                    outfile = tile_folder.joinpath(f'{country}_{month.name}_rad_tmp.tif')
+                else:
+                    outfile = tile_folder.joinpath(f'{country}_{month.name}_cvg.tif')
+                if outfile.exists() and not overwrite:
+                    continue
+                if len(extents) > 1:
+                    part = outfile.with_name(f'{outfile.stem}_{extent}.tif')
+                    parts.setdefault(outfile, []).append(part)
+                    targets[part] = shps[country]
+                else:
+                    targets[outfile] = shps[country]
+            if targets:
+                ExtractCountriesFromTile(tile, targets, index=index)
+        for outfile, part_files in parts.items():
+            mosaic_parts(part_files, outfile)
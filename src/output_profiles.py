@@ -0,0 +1,86 @@
+"""Named output profiles for every raster written by the pipeline
+
+fast-scratch --> Intermediate rasters read back once. Light ZSTD, small tiles
+archival --> Rasters kept as results. Strong DEFLATE
+cog --> Rasters read by windows or served. DEFLATE with overviews, rewritten as Cloud-Optimized GeoTIFF by finalise()
+
+Predictor is chosen from dtype: 3 (floating point) for float rasters, 2 (horizontal differencing) for integer rasters.
+"""
+from pathlib import Path
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+NODATA = -99999
+
+PRESETS = {'fast-scratch': {'compress': 'zstd', 'zstd_level': 1, 'tiled': True, 'blockxsize': 256, 'blockysize': 256},
+           'archival': {'compress': 'deflate', 'zlevel': 9, 'tiled': True, 'blockxsize': 512, 'blockysize': 512},
+           'cog': {'compress': 'deflate', 'zlevel': 6, 'tiled': True, 'blockxsize': 512, 'blockysize': 512}}
+
+#Used when GDAL was built without ZSTD
+FALLBACK = {'compress': 'deflate', 'zlevel': 1}
+
+_available = {}
+
+def codec_available(codec):
+    """Returns True if GDAL can write GeoTIFFs with compression codec"""
+    if codec not in _available:
+        try:
+            with MemoryFile() as memfile:
+                with memfile.open(driver='GTiff', width=16, height=16, count=1, dtype='uint8', crs='EPSG:4326', transform=from_origin(0, 16, 1, 1), compress=codec) as dst:
+                    dst.write(np.zeros((1, 16, 16), dtype='uint8'))
+                #GDAL only warns about codecs it does not know, so check what was written
+                with memfile.open() as src:
+                    _available[codec] = src.compression is not None and src.compression.name == codec.lower()
+        except (rasterio.errors.RasterioError, ValueError):
+            _available[codec] = False
+    return _available[codec]
+
+def predictor_for(dtype):
+    """Returns GeoTIFF predictor suited to dtype"""
+    return 3 if np.dtype(dtype).kind == 'f' else 2
+
+def output_profile(base_profile, preset='archival', dtype=None, nodata=NODATA, **overrides):
+    """Returns copy of base_profile (e.g. src.profile of the input already open) with creation options of preset.
+    base_profile --> Profile giving grid, crs and dtype
+    preset --> One of PRESETS. Default is 'archival'
+    dtype --> Output dtype. Default is dtype of base_profile
+    nodata --> Output nodata. Default is -99999
+    overrides --> Any other profile or creation option, e.g. zlevel=1
+    """
+    if preset not in PRESETS:
+        raise ValueError(f'preset should be one of {list(PRESETS)}, not {preset}')
+    profile = dict(base_profile)
+    for key in ['blockxsize', 'blockysize', 'tiled', 'compress', 'predictor', 'interleave', 'zlevel', 'zstd_level']:
+        profile.pop(key, None)
+    options = dict(PRESETS[preset])
+    if not codec_available(options['compress']):
+        options = dict(options, **FALLBACK)
+        options.pop('zstd_level', None)
+    dtype = dtype or profile['dtype']
+    profile.update(options)
+    profile.update(driver='GTiff',
+                   count=1,
+                   dtype=dtype,
+                   predictor=predictor_for(dtype),
+                   bigtiff='if_safer',
+                   nodata=nodata)
+    if profile['width'] < profile['blockxsize'] or profile['height'] < profile['blockysize']:
+        profile.update(tiled=False)
+        profile.pop('blockxsize')
+        profile.pop('blockysize')
+    profile.update(overrides)
+    return profile
+
+def finalise(raster, preset):
+    """Rewrites raster as Cloud-Optimized GeoTIFF when preset is 'cog'. Other presets are left as written"""
+    if preset != 'cog':
+        return
+    raster = Path(raster)
+    tmp_raster = raster.with_suffix('.cog.tmp')
+    with rasterio.open(str(raster)) as src:
+        rasterio.shutil.copy(src, str(tmp_raster), driver='COG', compress='DEFLATE',
+                             predictor=predictor_for(src.dtypes[0]), blocksize=512, overview_resampling='average')
+    tmp_raster.replace(raster)
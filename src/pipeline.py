@@ -0,0 +1,162 @@
+"""Incremental pipeline of stages run in dependency order
+
+Each stage declares its input files, parameters and output files. A stage runs only when it has never run, an output
+is missing, or the contents of its inputs or its parameters changed since its last run. Inputs are compared by content
+hash (see cache_utils), so a stage rerun upstream that writes identical files does not trigger the stages below it.
+Raw inputs, such as downloaded multi-GB tiles, are never rewritten by a stage, so they are compared by size, modification
+time and the sha256 the download manifest records for them instead of being read.
+"""
+from pathlib import Path
+import argparse
+import json
+from cache_utils import CACHE_DIR, JSONCache, file_hash
+
+class Stage:
+    """One step of a pipeline"""
+
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, after=(), raw_inputs=()):
+        """Initialisation function
+        name --> Unique name of stage
+        func --> Called with params as keyword arguments to run stage
+        inputs --> Files read by stage. Stages writing any of them run first
+        outputs --> Files (or folders) written by stage
+        params --> Dictionary of keyword arguments of func. Part of the fingerprint. Default is None (no arguments)
+        after --> Names of stages that must run first although no file links them. Their fingerprints are part of this one
+        raw_inputs --> Files read by stage that no stage writes, e.g. downloaded tiles. Fingerprinted without reading them (see Pipeline.raw_fingerprint)
+        """
+        self.name = name
+        self.func = func
+        self.inputs = [str(x) for x in inputs]
+        self.raw_inputs = [str(x) for x in raw_inputs]
+        self.outputs = [str(x) for x in outputs]
+        self.params = params or {}
+        self.after = list(after)
+
+class Pipeline:
+    """Directed acyclic graph of stages with their last fingerprints kept in a JSONCache"""
+
+    def __init__(self, state=None, manifest=None):
+        """
+        state --> json file of stage fingerprints. Default is datain/cache/pipeline.json
+        manifest --> json download manifest (see download_viirs/manifest) holding sha256 of raw inputs. Default is None (size and time only)
+        """
+        self.state = JSONCache(state or CACHE_DIR.joinpath('pipeline.json'))
+        self.manifest = manifest
+        self.stages = {}
+        self._manifest_hashes = None
+
+    def add(self, name, func, inputs=(), outputs=(), params=None, after=(), raw_inputs=()):
+        """Adds stage (see Stage) and returns it"""
+        if name in self.stages:
+            raise ValueError(f'stage {name} already exists')
+        self.stages[name] = Stage(name, func, inputs, outputs, params, after, raw_inputs)
+        return self.stages[name]
+
+    def upstream(self, stage):
+        """Returns names of stages stage directly depends on"""
+        producers = {output: x.name for x in self.stages.values() for output in x.outputs}
+        names = [producers[x] for x in stage.inputs if x in producers] + stage.after
+        missing = [x for x in names if x not in self.stages]
+        if missing:
+            raise ValueError(f'stage {stage.name} runs after unknown stages {missing}')
+        return list(dict.fromkeys(x for x in names if x != stage.name))
+
+    def order(self):
+        """Returns stages sorted so every stage comes after those it depends on, otherwise in the order they were added"""
+        parents = {name: self.upstream(stage) for name, stage in self.stages.items()}
+        ordered, done = [], set()
+        while len(ordered) < len(self.stages):
+            ready = [name for name in self.stages if name not in done and all(x in done for x in parents[name])]
+            if not ready:
+                raise ValueError(f'stages {sorted(set(self.stages) - done)} depend on each other')
+            ordered.append(self.stages[ready[0]])
+            done.add(ready[0])
+        return ordered
+
+    def downstream(self, name):
+        """Returns names of stage name and every stage depending on it, directly or not"""
+        names = {name}
+        for stage in self.order():
+            if any(x in names for x in self.upstream(stage)):
+                names.add(stage.name)
+        return names
+
+    def manifest_hashes(self):
+        """Returns dictionary of {resolved path: sha256} of downloaded archives and of the tiles extracted from them, read once from manifest"""
+        if self._manifest_hashes is None:
+            self._manifest_hashes = {}
+            if self.manifest is not None and _exists(self.manifest):
+                with open(self.manifest) as src:
+                    entries = json.load(src)
+                for entry in entries.values():
+                    for path in [entry.get('file')] + list(entry.get('members') or []):
+                        if path is not None:
+                            self._manifest_hashes[str(Path(path).resolve())] = entry.get('sha256')
+        return self._manifest_hashes
+
+    def raw_fingerprint(self, path):
+        """Returns (size, modification time, manifest sha256) of raw input, or None if it is missing. The file is not read"""
+        if not _exists(path):
+            return None
+        stat = Path(path).stat()
+        return stat.st_size, stat.st_mtime_ns, self.manifest_hashes().get(str(Path(path).resolve()))
+
+    def fingerprint(self, stage):
+        """Returns hash of stage parameters, contents of its inputs, fingerprints of its raw inputs and fingerprints of its after stages"""
+        inputs = [(x, file_hash(x) if _exists(x) else None) for x in stage.inputs]
+        raw_inputs = [(x, self.raw_fingerprint(x)) for x in stage.raw_inputs]
+        after = [self.state.get(x) for x in stage.after]
+        return JSONCache.key(stage.name, sorted(stage.params.items()), inputs, raw_inputs, after)
+
+    def reason(self, stage):
+        """Returns why stage should run, or None if it is up to date"""
+        if self.state.get(stage.name) is None:
+            return 'never run'
+        missing = [x for x in stage.outputs if not _exists(x)]
+        if missing:
+            return f'{len(missing)} missing outputs'
+        if self.state.get(stage.name) != self.fingerprint(stage):
+            return 'inputs or parameters changed'
+        return None
+
+    def run(self, dry_run=False, from_stage=None):
+        """Runs stages that are out of date in dependency order and returns {name: reason} of stages run
+        dry_run --> Only report what would run. Stages below one that would run are reported as they may change. Default is False
+        from_stage --> Run this stage and every stage downstream of it whatever their state, and nothing else. Default is None
+        """
+        if from_stage is not None and from_stage not in self.stages:
+            raise ValueError(f'from_stage should be one of {list(self.stages)}, not {from_stage}')
+        forced = self.downstream(from_stage) if from_stage is not None else set()
+        ran = {}
+        for stage in self.order():
+            if from_stage is not None:
+                reason = 'forced' if stage.name in forced else None
+            elif dry_run and any(x in ran for x in self.upstream(stage)):
+                reason = 'upstream would run'
+            else:
+                reason = self.reason(stage)
+            if reason is None:
+                print(f'skip {stage.name}')
+                continue
+            print(f'{"would run" if dry_run else "run"} {stage.name} ({reason})')
+            ran[stage.name] = reason
+            if dry_run:
+                continue
+            stage.func(**stage.params)
+            missing = [x for x in stage.outputs if not _exists(x)]
+            if missing:
+                raise FileNotFoundError(f'stage {stage.name} did not write {missing}')
+            self.state.set(stage.name, self.fingerprint(stage))
+        return ran
+
+    def command_line(self, argv=None, description=None):
+        """Parses --dry-run and --from-stage from argv (default sys.argv) and runs pipeline"""
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--dry-run', action='store_true', help='List stages that would run and why, without running them')
+        parser.add_argument('--from-stage', choices=list(self.stages), help='Run this stage and all stages downstream of it')
+        args = parser.parse_args(argv)
+        return self.run(dry_run=args.dry_run, from_stage=args.from_stage)
+
+def _exists(path):
+    """Returns True if path exists"""
+    return Path(path).exists()
@@ -0,0 +1,63 @@
+"""Area in km2 of every pixel of a raster grid, for area-normalised metrics without reprojecting shapes
+
+On geographic grids each pixel is an ellipsoidal quadrangle on WGS84 and its area is exact, so it only depends on the row.
+Areas are kept per grid as a column of row areas broadcast to the full grid.
+"""
+from functools import lru_cache
+import numpy as np
+from pyproj import Geod
+import rasterio
+from rasterio.crs import CRS
+
+#WGS84 ellipsoid
+SEMI_MAJOR = 6378137.0
+FLATTENING = 1 / 298.257223563
+ECCENTRICITY = np.sqrt(FLATTENING * (2 - FLATTENING))
+
+def authalic_term(lat):
+    """Returns q(lat) of ellipsoidal area formula. Area between latitudes lat1 and lat2 over dlon radians is a2(1 - e2) dlon (q2 - q1) / 2"""
+    sin_lat = np.sin(np.radians(lat))
+    e_sin = ECCENTRICITY * sin_lat
+    return sin_lat / (1 - e_sin ** 2) + np.log((1 + e_sin) / (1 - e_sin)) / (2 * ECCENTRICITY)
+
+def quadrangle_area(lat1, lat2, dlon):
+    """Returns area in km2 between latitudes lat1 and lat2 (degrees) over dlon degrees of longitude"""
+    area = SEMI_MAJOR ** 2 * (1 - ECCENTRICITY ** 2) * np.radians(dlon) / 2 * np.abs(authalic_term(lat2) - authalic_term(lat1))
+    return area / 1e6
+
+@lru_cache(maxsize=32)
+def _row_areas(transform, height, crs_wkt):
+    """Returns (height, 1) array of pixel areas in km2 for north-up grid. Geographic (or unknown) crs are taken as WGS84 degrees,
+    projected crs are taken as planar with linear units in metres
+    """
+    a, _, _, _, e, f = transform[:6]
+    if crs_wkt and not CRS.from_wkt(crs_wkt).is_geographic:
+        areas = np.full(height, abs(a * e) / 1e6)
+    else:
+        top = f + e * np.arange(height)
+        areas = quadrangle_area(top, top + e, abs(a))
+    areas.flags.writeable = False
+    return areas[:, None]
+
+def pixel_areas(transform, shape, crs=None):
+    """Returns read-only float64 array of pixel areas in km2 with given shape. Cached per grid
+    transform --> Affine transform of raster grid (north-up)
+    shape --> (rows, cols) of raster grid
+    crs --> crs of raster grid. Default is None (WGS84)
+    """
+    crs_wkt = crs.to_wkt() if crs is not None else ''
+    return np.broadcast_to(_row_areas(tuple(transform), shape[0], crs_wkt), tuple(shape))
+
+def raster_pixel_areas(raster):
+    """Returns pixel areas in km2 on the grid of raster (see pixel_areas)"""
+    with rasterio.open(str(raster)) as src:
+        return pixel_areas(src.transform, src.shape, src.crs)
+
+def geodesic_areas(gdf):
+    """Returns float64 array of geodesic area in km2 of every geometry of GeoDataFrame on WGS84. Used for zones too small
+    to hold a pixel centre. Geometries without crs are taken as WGS84 degrees
+    """
+    if gdf.crs is not None:
+        gdf = gdf.to_crs(epsg=4326)
+    geod = Geod(ellps='WGS84')
+    return np.array([abs(geod.geometry_area_perimeter(x)[0]) / 1e6 for x in gdf['geometry']], dtype='float64')
@@ -1,29 +1,46 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import pandas as pd
 from viirs_zonal_stats import PPPZonalStats, VIIRSZonalStats
 
-def main(BASEDIR, country, level):
+def month_stats(country, level, raster, shp, out_csv, engine='coverage', cache_dir=None):
+    """Writes zonal stats csv of one month and returns it as DataFrame. Used by worker processes"""
+    PPPZonalStats(country, level, raster, shp, out_csv, engine=engine, cache_dir=cache_dir)
+    return pd.read_csv(str(out_csv))
+
+def main(BASEDIR, country, level, workers=None, engine='coverage', cache_dir=None):
+    """
+    workers --> If given, months are run in a pool of this many processes. Default is None (serial)
+    engine --> Zonal engine of PPPZonalStats. Default is 'coverage' (exact coverage fractions, suited to small admin units)
+    cache_dir --> Folder of zonal engine caches. Default is None (datain/cache)
+    """
     raster = BASEDIR.joinpath(f'datain/{country}/ppp_2016/{country.lower()}_ppp_2016.tif')
     shp = BASEDIR.joinpath(f'datain/shps/{country}/{country}_adm{level}.shp')
     out_csv = BASEDIR.joinpath(f'dataout/{country}/{country}_ppp_stats.csv')
-    ppp_stats = PPPZonalStats(country, level, raster, shp, out_csv)
+    out_csv.parent.mkdir(parents=True, exist_ok=True)
+    ppp_stats = PPPZonalStats(country, level, raster, shp, out_csv, engine=engine, cache_dir=cache_dir)
 
-    months = [x for x in BASEDIR.joinpath(f'datain/{country}').iterdir() if not x.name == 'ppp_2016' if not x.name.endswith('csv')]
+    months = sorted([x for x in BASEDIR.joinpath(f'datain/{country}').iterdir() if not x.name == 'ppp_2016' if not x.name.endswith('csv')])
+    jobs = []
     for month in months:
         raster = month.joinpath(f'{country}_{month.name}_rad_cap_smth.tif')
         #out_shp = BASEDIR.joinpath(f'dataout/{country}/{country}_viirs_L{level}.shp')
         out_csv2 = BASEDIR.joinpath(f'dataout/{country}/{country}_viirs_L{level}_{month.name}.csv')
         #light_stats = VIIRSZonalStats(country, months, shp, out_shp, out_csv2, level, raster_type='_rad_cap_smth.tif')
-        light_stats = PPPZonalStats(country, level, raster, shp, out_csv2)
-    df_to_concat = []
-    for month in months:
-        csv = BASEDIR.joinpath(f'dataout/{country}/{country}_viirs_L{level}_{month.name}.csv')
-        df = pd.read_csv(str(csv))
-        df_to_concat.append(df)
-    
+        jobs.append((country, level, raster, shp, out_csv2, engine, cache_dir))
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            df_to_concat = list(executor.map(month_stats, *zip(*jobs)))
+    else:
+        df_to_concat = [month_stats(*job) for job in jobs]
+    keys = ['GID', f'NAME{level}']
+    df = pd.concat([x.set_index(keys) for x in df_to_concat], axis=1, keys=[x.name for x in months])
+    df.columns = [f'{stat}{month}' for month, stat in df.columns]
+    df.reset_index().to_csv(str(BASEDIR.joinpath(f'dataout/{country}/{country}_viirs_L{level}.csv')), index=False)
 
 
 if __name__ == "__main__":
     countries = {'HTI': 4}
     for country, level in countries.items():
         BASEDIR = Path(__file__).resolve().parent.parent
-        main(BASEDIR, country, level)
\ No newline at end of file
+        main(BASEDIR, country, level, workers=4)
@@ -0,0 +1,91 @@
+"""Fused monthly preprocessing: coverage threshold, radiance floor and capital maximum cap in one read and one write
+
+Gives the same result as SetThreshold followed by SmoothOutliers.get_max_in_capital and SmoothOutliers.remove_cap_max
+"""
+from pathlib import Path
+import numpy as np
+import rasterio
+from reclass_rasters import strip_windows
+from output_profiles import output_profile, finalise
+from capital_stats import capital_max
+
+def preprocess_month(month, country, capital_shp, cvg_threshold=1, rad_threshold=0, debug=False):
+    """Writes {country}_{MM}_rad_cap_smth.tif in month folder from its rad_tmp and cvg rasters, unless it exists, and returns it.
+    Module level so months can run in scheduler worker processes (see scheduler)
+    month --> Month folder, named MM
+    debug --> Also write the intermediate rad_thrsh_set raster. Default is False
+    """
+    month = Path(month)
+    rad = month.joinpath(f'{country}_{month.name}_rad_tmp.tif')
+    cvg = month.joinpath(f'{country}_{month.name}_cvg.tif')
+    out_raster = month.joinpath(f'{country}_{month.name}_rad_cap_smth.tif')
+    debug_thrsh_set = month.joinpath(f'{country}_{month.name}_rad_thrsh_set.tif') if debug else None
+    if not out_raster.exists():
+        PreprocessRadiance(rad, cvg, capital_shp, out_raster, cvg_threshold=cvg_threshold, rad_threshold=rad_threshold, debug_thrsh_set=debug_thrsh_set)
+    return out_raster
+
+class PreprocessRadiance:
+    """Class to make rad_cap_smth raster straight from rad and cvg rasters"""
+
+    def __init__(self, rad, cvg, capital_shp, out_raster, cvg_threshold=1, rad_threshold=0, memory_mb=None, debug_thrsh_set=None, preset='archival'):
+        """Initialisation function
+
+        rad --> Radiance raster clipped from tile
+        cvg --> Coverage raster clipped from tile
+        capital_shp --> Shapefile of capital region. Pixels above its maximum are made nodata
+        out_raster --> Output raster
+        cvg_threshold --> Pixels with coverage below this are made nodata. Default is 1
+        rad_threshold --> Pixels with radiance below this are made nodata. Default is 0
+        memory_mb --> If given, rasters are processed in strips using at most this many MB. Default is None (whole raster)
+        debug_thrsh_set --> If given, also writes this raster as SetThreshold would have (before capping). Default is None
+        preset --> Output profile preset (see output_profiles). Default is 'archival'
+        """
+        self.rad = rad
+        self.cvg = cvg
+        self.capital_shp = capital_shp
+        self.out_raster = out_raster
+        self.cvg_threshold = cvg_threshold
+        self.rad_threshold = rad_threshold
+        self.memory_mb = memory_mb
+        self.debug_thrsh_set = debug_thrsh_set
+        self.preset = preset
+        self.cap_max = self.get_max_in_capital()
+        self.preprocess()
+
+    def threshold(self, data_rad, data_cvg):
+        """Returns boolean array of pixels failing coverage or radiance threshold"""
+        return (data_cvg < self.cvg_threshold) | (data_rad < self.rad_threshold)
+
+    def get_max_in_capital(self):
+        """Returns maximum thresholded radiance inside capital, reading only the capital's window.
+        Cached by contents of rad and cvg, capital geometry and thresholds (see capital_stats)
+        """
+        cap_max = capital_max(self.rad, self.capital_shp, cvg=self.cvg, cvg_threshold=self.cvg_threshold, rad_threshold=self.rad_threshold)
+        if cap_max is None:
+            raise ValueError(f'No pixels in {self.capital_shp} pass the thresholds')
+        return cap_max
+
+    def preprocess(self):
+        """Applies thresholds and capital cap in one vectorised pass and writes out_raster (and optional debug raster)"""
+        with rasterio.open(str(self.rad)) as rad_src, rasterio.open(str(self.cvg)) as cvg_src:
+            profile = output_profile(rad_src.profile, self.preset)
+            if self.memory_mb is None:
+                blocks = [None]
+            else:
+                bytes_per_pixel = np.dtype(rad_src.dtypes[0]).itemsize * 2 + np.dtype(cvg_src.dtypes[0]).itemsize + 1
+                blocks = strip_windows(rad_src, bytes_per_pixel, self.memory_mb)
+            with rasterio.open(str(self.out_raster), 'w', **profile) as dst:
+                debug = rasterio.open(str(self.debug_thrsh_set), 'w', **output_profile(rad_src.profile, 'fast-scratch')) if self.debug_thrsh_set else None
+                try:
+                    for window in blocks:
+                        data_rad = rad_src.read(window=window)
+                        nodata = self.threshold(data_rad, cvg_src.read(window=window))
+                        data_rad[nodata] = -99999
+                        if debug is not None:
+                            debug.write(data_rad, window=window)
+                        data_rad[data_rad > self.cap_max] = -99999
+                        dst.write(data_rad, window=window)
+                finally:
+                    if debug is not None:
+                        debug.close()
+        finalise(self.out_raster, self.preset)
@@ -3,14 +3,31 @@
 SetThreshold --> Takes continuous and classified raster. Threshold is set to value higher than input in classified raster. Default threshold = 1.
 """
 from pathlib import Path
+import warnings
 import numpy as np
 import rasterio
+from rasterio import windows
 from rasterio._fill import _fillnodata
+from scipy import ndimage
+from tiled_fill import fill_nodata_tiled
+from output_profiles import output_profile, finalise
+
+def strip_windows(src, bytes_per_pixel, memory_mb):
+    """Yields full-width windows of whole block rows so that each strip needs at most memory_mb
+    src --> Open rasterio dataset
+    bytes_per_pixel --> Bytes held per pixel while processing a strip (all arrays read plus masks)
+    memory_mb --> Memory budget in MB. At least one block row is always read
+    """
+    block_height = src.block_shapes[0][0]
+    rows = int(memory_mb * 1024 * 1024 // (src.width * bytes_per_pixel))
+    rows = max(block_height, rows // block_height * block_height)
+    for row_off in range(0, src.height, rows):
+        yield windows.Window(0, row_off, src.width, min(rows, src.height - row_off))
 
 class SetThreshold:
     """Class to set threshold value from coverage raster where data in radiance raster will be kept"""
 
-    def __init__(self, rad, cvg, out_rad, cvg_threshold=1, rad_threshold=0, interpolate_nodata=False, remove_rad_threshold=True):
+    def __init__(self, rad, cvg, out_rad, cvg_threshold=1, rad_threshold=0, interpolate_nodata=False, remove_rad_threshold=True, memory_mb=None, max_search_distance=20, tile_size=1024, workers=None, preset='fast-scratch'):
         """Initialisation function
         
         rad --> Continuous temporary radiance raster. Values will be removed        from this raster will be removed if coveraged is below                threshold value and made nodata
@@ -18,31 +35,40 @@ class SetThreshold:
         out_rad --> name of output raster
         cvg_threshold --> Threshold value for cvg raster. Default is 1
         rad_threshold --> The radiance values above which will be kept. Default=0
-        interpolate --> Interpolate nodata pixels. Default is false
+        interpolate_nodata --> Interpolate pixels below cvg threshold from surrounding pixels. Default is false
         remove_rad_threshold --> Remove values in rad below threshold. Default is true 
+        memory_mb --> If given, rad and cvg are processed and written in strips of blocks using at most this many MB. Default is None (whole raster)
+                      Can not be combined with interpolate_nodata, which searches across strip edges and so needs the whole raster (ValueError)
+        max_search_distance --> Furthest distance in pixels searched when interpolating. Default is 20
+        tile_size --> Size in pixels of tiles interpolated in parallel. Default is 1024
+        workers --> Threads used to interpolate. Default is number of cpus
+        preset --> Output profile preset (see output_profiles). Default is 'fast-scratch'
         """
         self.rad = rad
         self.cvg = cvg
         self.out_rad = out_rad
         self.cvg_threshold = cvg_threshold
         self.rad_threshold = rad_threshold
-        self.interpolate_nodata = interpolate_nodata
+        self.interpolate = interpolate_nodata
         self.remove_rad_threshold = remove_rad_threshold
+        self.memory_mb = memory_mb
+        self.max_search_distance = max_search_distance
+        self.tile_size = tile_size
+        self.workers = workers
+        self.preset = preset
+        self.profile = None
 
-        self.template = rasterio.open(str(self.rad))
-        self.profile = self.template.profile
-        self.profile.update(count=1,
-				        compress='lzw',
-				        predictor=2,
-				        bigtiff='yes',
-				        nodata=-99999)
-        self.template.close()
+        if self.memory_mb is not None and self.interpolate:
+            raise ValueError('memory_mb can not be used with interpolate_nodata, which needs the whole raster')
+        if self.memory_mb is not None:
+            self.set_threshold_blocks()
+            return
         reclass_data = self.set_threshold()
+        #Interpolate before removing low radiance so dim pixels still count as neighbours
+        if self.interpolate:
+            reclass_data = self.interpolate_nodata(reclass_data)
         if self.remove_rad_threshold:
             reclass_data = self.remove_rad_threshold_values(reclass_data, self.rad_threshold)
-        #TO DO TO DO TO DO
-        if self.interpolate_nodata:
-            reclass_data = self.interpolate_nodata(reclass_data)
         self.save_output(reclass_data)
 
     def set_threshold(self):
@@ -50,27 +76,54 @@ class SetThreshold:
         Returns reclassed array
         """
         with rasterio.open(str(self.rad)) as rad_src, rasterio.open(str(self.cvg)) as cvg_src:
+            self.profile = output_profile(rad_src.profile, self.preset)
             data_rad = rad_src.read()
             data_cvg = cvg_src.read()
-            data_rad[np.where(data_cvg < self.cvg_threshold)] = -99999
+            data_rad[data_cvg < self.cvg_threshold] = -99999
             return data_rad 
 
+    def set_threshold_blocks(self):
+        """Applies cvg and rad thresholds strip by strip, writing each strip before reading the next"""
+        with rasterio.open(str(self.rad)) as rad_src, rasterio.open(str(self.cvg)) as cvg_src:
+            self.profile = output_profile(rad_src.profile, self.preset)
+            with rasterio.open(str(self.out_rad), 'w', **self.profile) as dst:
+                self.write_threshold_blocks(rad_src, cvg_src, dst)
+        finalise(self.out_rad, self.preset)
+
+    def write_threshold_blocks(self, rad_src, cvg_src, dst):
+        """Reads, thresholds and writes each strip"""
+        bytes_per_pixel = np.dtype(rad_src.dtypes[0]).itemsize + np.dtype(cvg_src.dtypes[0]).itemsize + 1
+        for window in strip_windows(rad_src, bytes_per_pixel, self.memory_mb):
+            data_rad = rad_src.read(window=window)
+            nodata = cvg_src.read(window=window) < self.cvg_threshold
+            if self.remove_rad_threshold:
+                nodata |= data_rad < self.rad_threshold
+            data_rad[nodata] = -99999
+            dst.write(data_rad, window=window)
+
     def interpolate_nodata(self, reclass_data):
-        """TO DO --> function to interpolate nodata
+        """Fills nodata pixels from valid pixels within max_search_distance, tile by tile in a thread pool.
+        Pixels with nothing valid in reach stay nodata
         Returns reclassed array
         """
-        pass
+        for band in range(reclass_data.shape[0]):
+            reclass_data[band] = fill_nodata_tiled(reclass_data[band],
+                                                   reclass_data[band] != -99999,
+                                                   max_search_distance=self.max_search_distance,
+                                                   tile_size=self.tile_size,
+                                                   workers=self.workers)
+        return reclass_data
 
     def remove_negative_values(self, reclass_data):
         """Returns data with negative values as nodata
         Returns reclassed array
         """
-        reclass_data[np.where((reclass_data < 0) & (reclass_data != -99999))] = -99999
+        reclass_data[(reclass_data < 0) & (reclass_data != -99999)] = -99999
         return reclass_data
 
     def remove_rad_threshold_values(self, reclass_data, rad_threshold):
         """Remove values below certain threshold"""
-        reclass_data[np.where(reclass_data < rad_threshold)] = -99999
+        reclass_data[reclass_data < rad_threshold] = -99999
         return reclass_data
 
     def save_output(self, reclass_data):
@@ -78,18 +131,22 @@ class SetThreshold:
         profile = self.profile
         with rasterio.open(str(self.out_rad), 'w', **profile) as dst:
             dst.write(reclass_data)
+        finalise(self.out_rad, self.preset)
         #self.rad.unlink()
 
 class NormaliseAdminUnits:
     """Class to normalise rasters temporally --> lowest = 0; highest = 1"""
-    def __init__(self, names, months, country):
+    def __init__(self, names, months, country, preset='archival'):
         """Initialisation expects a list of admin unit names from which to normalise and a list of folders in which temporal data sets are kept to be normalised. Class will loop through each name, collect the rasters for that name in each month, normalise (0-1) and save a raster. Will then mosaic the raster.
         names --> List of admin unit names
         month --> list of folders representing temporal time periods
+        preset --> Output profile preset (see output_profiles). Default is 'archival'
         """
         self.names = names
         self.months = months
         self.country = country
+        self.preset = preset
+        self.profile = None
         for name in self.names:
             #for_normalising = self.extract_rasters_to_stacked_array(name)
             for admin_unit in self.extract_rasters_to_stacked_array(name):
@@ -106,13 +163,14 @@ class NormaliseAdminUnits:
             with rasterio.open(raster) as src:
                 data = src.read()
                 for_normalising[array_name] = data
+                self.profile = output_profile(src.profile, self.preset)
         yield for_normalising
 
     def stack_arrays(self, admin_unit):
         """Returns stacked array for admin units over a time period
         admin_unit --> dictionary of admin_units np.arrays over a time period
         """
-        result = (admin_unit[x] for x, _ in admin_unit.items())
+        result = [admin_unit[x] for x, _ in admin_unit.items()]
         stacked_arrays = np.stack(result)
         stack2 = np.ma.masked_array(stacked_arrays, stacked_arrays == -99999)
         stack2 = (stacked_arrays - stacked_arrays.min())/(stacked_arrays.max() - stacked_arrays.min())
@@ -123,42 +181,165 @@ class NormaliseAdminUnits:
         """Save subsection of stacked array"""
         data = stack[int(month.name) -1]
         out_name = month.joinpath(f'subnational/{name}_{month.name}_norm.tif')
-        raster = month.joinpath(f'subnational/{name}_{month.name}_rad.tif')
-        template = rasterio.open(str(raster))
-        profile = template.profile
-        profile.update(count=1,
-				        compress='lzw',
-				        predictor=2,
-				        bigtiff='yes',
-				        nodata=-99999)
-        template.close()
-        with rasterio.open(out_name, 'w', **profile) as dst:
-            dst.write(data)
+        with rasterio.open(out_name, 'w', **self.profile) as dst:
+            dst.write(data.astype(self.profile['dtype']))
+        finalise(out_name, self.preset)
+
+class NormaliseAdminViews:
+    """Class to normalise admin units temporally (lowest = 0; highest = 1) straight from the national monthly rasters, without writing a raster per admin unit"""
+    def __init__(self, views, months, country, raster_type='_rad_cap_smth.tif', preset='archival'):
+        """
+        views --> AdminViews of admin units on the grid of the national rasters
+        months --> list of folders representing temporal time periods
+        country --> ISO of country
+        raster_type --> ending of national raster in each month folder. Default is '_rad_cap_smth.tif'
+        preset --> Output profile preset (see output_profiles). Default is 'archival'
+        Writes {country}_{month}_normalised.tif in each month folder
+        """
+        self.views = views
+        self.months = months
+        self.country = country
+        self.raster_type = raster_type
+        self.preset = preset
+        stack, profile = self.read_national_stack()
+        normalised = self.normalise_views(stack)
+        self.write_normalised_rasters(normalised, profile)
+
+    def read_national_stack(self):
+        """Returns 3D array (month, rows, cols) of national rasters and profile of first month"""
+        arrays = []
+        for month in self.months:
+            raster = month.joinpath(f'{self.country}_{month.name}{self.raster_type}')
+            with rasterio.open(str(raster)) as src:
+                arrays.append(src.read(1))
+                profile = src.profile
+        return np.stack(arrays), profile
+
+    def normalise_views(self, stack):
+        """Returns stack normalised per admin unit over time. Pixels outside units or nodata are -99999"""
+        normalised = np.full(stack.shape, -99999, dtype='float32')
+        for view in self.views:
+            unit = self.views.read(stack, view.name)
+            if unit.count() == 0:
+                continue
+            unit_min, unit_max = unit.min(), unit.max()
+            scaled = (unit - unit_min) / (unit_max - unit_min) if unit_max > unit_min else unit * 0
+            rows, cols = view.window.toslices()
+            out = normalised[:, rows, cols]
+            inside = ~np.ma.getmaskarray(scaled)
+            out[inside] = scaled.data[inside]
+        return normalised
+
+    def write_normalised_rasters(self, normalised, profile):
+        """Save each month of normalised stack"""
+        profile = output_profile(profile, self.preset, dtype='float32')
+        for index, month in enumerate(self.months):
+            out_name = month.joinpath(f'{self.country}_{month.name}_normalised.tif')
+            with rasterio.open(str(out_name), 'w', **profile) as dst:
+                dst.write(normalised[index], 1)
+            finalise(out_name, self.preset)
+
+class NormaliseLabels:
+    """Class to normalise all admin units temporally (lowest = 0; highest = 1) at once from the national monthly stack and a label grid"""
+    def __init__(self, label_grid, months, country, raster_type='_rad_cap_smth.tif', preset='archival'):
+        """
+        label_grid --> LabelGrid of admin units on the grid of the national rasters
+        months --> list of folders representing temporal time periods
+        country --> ISO of country
+        raster_type --> ending of national raster in each month folder. Default is '_rad_cap_smth.tif'
+        preset --> Output profile preset (see output_profiles). Default is 'archival'
+        Writes {country}_{month}_normalised.tif in each month folder
+        """
+        self.label_grid = label_grid
+        self.months = months
+        self.country = country
+        self.raster_type = raster_type
+        self.preset = preset
+        stack, profile = self.read_national_stack()
+        self.normalise_stack(stack)
+        self.write_normalised_rasters(stack, profile)
+
+    def read_national_stack(self):
+        """Returns float32 3D array (month, rows, cols) of national rasters with nodata as NaN, and profile of first month"""
+        rows, cols = self.label_grid.shape
+        stack = np.empty((len(self.months), rows, cols), dtype='float32')
+        for index, month in enumerate(self.months):
+            raster = month.joinpath(f'{self.country}_{month.name}{self.raster_type}')
+            with rasterio.open(str(raster)) as src:
+                src.read(1, out=stack[index])
+                if index == 0:
+                    profile = src.profile
+                    nodata = src.nodata if src.nodata is not None else -99999
+            stack[index][stack[index] == nodata] = np.nan
+        return stack, profile
+
+    def label_min_max(self, stack):
+        """Returns arrays (indexed by label) of minimum and maximum over all months and pixels of each unit.
+        Months are reduced per pixel first so the label reduction runs on 2D arrays
+        """
+        labels = self.label_grid.labels
+        index = np.arange(self.label_grid.n_labels + 1)
+        with warnings.catch_warnings():
+            #All-NaN pixels (nodata in every month) are expected
+            warnings.simplefilter('ignore', RuntimeWarning)
+            pixel_min = np.nanmin(stack, axis=0)
+            pixel_max = np.nanmax(stack, axis=0)
+        valid = ~np.isnan(pixel_min)
+        pixel_min[~valid] = np.inf
+        pixel_max[~valid] = -np.inf
+        label_min = np.asarray(ndimage.minimum(pixel_min, labels, index), dtype='float32')
+        label_max = np.asarray(ndimage.maximum(pixel_max, labels, index), dtype='float32')
+        return label_min, label_max
+
+    def normalise_stack(self, stack):
+        """Normalises stack in place. Pixels outside units or nodata become -99999"""
+        labels = self.label_grid.labels
+        label_min, label_max = self.label_min_max(stack)
+        label_range = label_max - label_min
+        label_range[~(label_range > 0)] = 1
+        label_min[~np.isfinite(label_min)] = 0
+        stack -= label_min[labels]
+        stack /= label_range[labels]
+        stack[:, labels == 0] = np.nan
+        stack[np.isnan(stack)] = -99999
+
+    def write_normalised_rasters(self, stack, profile):
+        """Save each month of normalised stack"""
+        profile = output_profile(profile, self.preset, dtype='float32')
+        for index, month in enumerate(self.months):
+            out_name = month.joinpath(f'{self.country}_{month.name}_normalised.tif')
+            with rasterio.open(str(out_name), 'w', **profile) as dst:
+                dst.write(stack[index], 1)
+            finalise(out_name, self.preset)
 
 class ReclassByThreshold:
     """Class to extract rad raster above certain input value"""
-    def __init__(self, rad_raster, threshold_value, outname):
+    def __init__(self, rad_raster, threshold_value, outname, memory_mb=None, preset='fast-scratch'):
         """
         rad_raster -> radiance input raster
         threshold_value -> values above which will be extracted from raster
         outname -> output file name
+        memory_mb -> If given, raster is reclassified in strips of blocks using at most this many MB. Default is None (whole raster)
+        preset -> Output profile preset (see output_profiles). Default is 'fast-scratch'
         """
         self.rad_raster = rad_raster
         self.threshold_value = threshold_value
         self.outname = outname
+        self.memory_mb = memory_mb
+        self.preset = preset
         self.reclass_raster()
+        finalise(self.outname, self.preset)
 
     def reclass_raster(self):
         """Function to reclassify raster"""
-        template = rasterio.open(str(self.rad_raster))
-        profile = template.profile
-        profile.update(count=1,
-				        compress='lzw',
-				        predictor=2,
-				        bigtiff='yes',
-				        nodata=-99999)
-        template.close()
-        with rasterio.open(self.rad_raster) as src, rasterio.open(self.outname, 'w', **profile) as dst:
-            data = src.read()
-            data[np.where(data < self.threshold_value)] = -99999
-            dst.write(data)
+        with rasterio.open(self.rad_raster) as src, rasterio.open(self.outname, 'w', **output_profile(src.profile, self.preset)) as dst:
+            if self.memory_mb is None:
+                data = src.read()
+                data[data < self.threshold_value] = -99999
+                dst.write(data)
+                return
+            bytes_per_pixel = np.dtype(src.dtypes[0]).itemsize + 1
+            for window in strip_windows(src, bytes_per_pixel, self.memory_mb):
+                data = src.read(window=window)
+                data[data < self.threshold_value] = -99999
+                dst.write(data, window=window)
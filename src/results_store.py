@@ -0,0 +1,126 @@
+"""Append-only store of zonal statistics in long format, kept as Parquet part files
+
+Each row is one value keyed by country, level, zone, year, month and metric (year is '' for single-year runs). Appends add a part file and never rewrite earlier
+ones. When a key is written more than once, reads return the latest value. CSV and shapefile tables are only made by
+to_csv() and to_shapefile().
+"""
+from pathlib import Path
+import os
+import re
+import time
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+KEYS = ['country', 'level', 'zone', 'year', 'month', 'metric']
+COLUMNS = KEYS + ['value']
+SCHEMA = pa.schema([('country', pa.string()), ('level', pa.int32()), ('zone', pa.string()), ('year', pa.string()), ('month', pa.string()),
+                    ('metric', pa.string()), ('value', pa.float64()), ('written', pa.int64())])
+
+#Wide columns ending in a two digit month, e.g. sum01 or diff12
+MONTH_COLUMN = re.compile(r'^(?P<metric>.*\D)(?P<month>0[1-9]|1[0-2])$')
+
+def split_column(column):
+    """Returns (metric, month) of wide column name. Columns without a month suffix are 'annual'"""
+    match = MONTH_COLUMN.match(column)
+    if match:
+        return match.group('metric'), match.group('month')
+    return column, 'annual'
+
+class ResultsStore:
+    """Folder of Parquet part files holding long-format zonal statistics"""
+
+    def __init__(self, root):
+        """
+        root --> Folder of part files. Created on first append
+        """
+        self.root = Path(root)
+
+    def append(self, df):
+        """Writes long-format DataFrame (columns country, level, zone, year, month, metric, value) as a new part file and returns its path.
+        year may be left out for single-year results
+        """
+        missing = set(COLUMNS) - set(df.columns) - {'year'}
+        if missing:
+            raise ValueError(f'Results are missing columns {sorted(missing)}')
+        written = time.time_ns()
+        df = pd.DataFrame({'country': df['country'].astype(str),
+                           'level': df['level'].astype('int32'),
+                           'zone': df['zone'].astype(str),
+                           'year': df['year'].astype(str) if 'year' in df.columns else '',
+                           'month': df['month'].astype(str),
+                           'metric': df['metric'].astype(str),
+                           'value': df['value'].astype('float64'),
+                           'written': written})
+        self.root.mkdir(parents=True, exist_ok=True)
+        part = self.root.joinpath(f'part-{written}-{os.getpid()}.parquet')
+        tmp_part = part.with_suffix('.tmp')
+        pq.write_table(pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False), str(tmp_part))
+        tmp_part.replace(part)
+        return part
+
+    def append_wide(self, df, country, level, zone_field, month=None, year=''):
+        """Appends wide table with one row per zone.
+        df --> DataFrame with zone_field column and one column per metric
+        country --> ISO of country
+        level --> Admin level
+        zone_field --> Column identifying zones, e.g. 'GID' or 'NAME1'
+        month --> Month of all metric columns. Default is None (month read from column names, e.g. sum01, see split_column)
+        year --> Year of all metric columns. Default is '' (single-year results)
+        """
+        long_df = pd.DataFrame(df).drop(columns='geometry', errors='ignore').melt(id_vars=[zone_field], var_name='column', value_name='value')
+        if month is None:
+            split = [split_column(column) for column in long_df['column']]
+            long_df['metric'] = [metric for metric, _ in split]
+            long_df['month'] = [column_month for _, column_month in split]
+        else:
+            long_df['metric'] = long_df['column']
+            long_df['month'] = month
+        long_df = long_df.rename(columns={zone_field: 'zone'})
+        long_df['country'] = country
+        long_df['level'] = level
+        long_df['year'] = year
+        return self.append(long_df[COLUMNS])
+
+    def read(self, columns=None, **filters):
+        """Returns long-format DataFrame of latest value for every key
+        columns --> Columns to return. Default is all of country, level, zone, year, month, metric, value
+        filters --> Key column values to keep, e.g. country='HTI' or metric=['sum01', 'sum02']
+        """
+        columns = columns or COLUMNS
+        parts = sorted(str(x) for x in self.root.glob('part-*.parquet')) if self.root.exists() else []
+        if not parts:
+            return pd.DataFrame(columns=columns)
+        dataset = ds.dataset(parts, format='parquet', schema=SCHEMA)
+        expression = None
+        for key, value in filters.items():
+            if key not in KEYS:
+                raise ValueError(f'Can only filter on {KEYS}, not {key}')
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            condition = ds.field(key).isin(list(values))
+            expression = condition if expression is None else expression & condition
+        table = dataset.to_table(columns=KEYS + ['value', 'written'], filter=expression)
+        df = table.to_pandas()
+        df = df.sort_values('written', kind='stable').drop_duplicates(KEYS, keep='last')
+        return df[columns].reset_index(drop=True)
+
+    def wide(self, **filters):
+        """Returns one row per zone with a column per metric, year and month (e.g. sum01 or sum201601, or area for 'annual' values)"""
+        df = self.read(**filters)
+        df['column'] = df['metric'] + df['year'] + df['month'].where(df['month'] != 'annual', '')
+        wide = df.pivot_table(index='zone', columns='column', values='value', aggfunc='last', dropna=False)
+        wide.columns.name = None
+        return wide.reset_index()
+
+    def to_csv(self, out_csv, **filters):
+        """Exports wide table (see wide()) to csv"""
+        self.wide(**filters).to_csv(str(out_csv), index=False)
+
+    def to_shapefile(self, shp, zone_field, out_shp, **filters):
+        """Exports wide table (see wide()) joined to the zones of shp on zone_field"""
+        gdf = gpd.read_file(str(shp))
+        gdf['zone'] = gdf[zone_field].astype(str)
+        gdf = gdf.merge(self.wide(**filters), on='zone').drop(columns='zone')
+        gdf.to_file(str(out_shp))
@@ -0,0 +1,116 @@
+"""Runs independent tasks, such as one country and month each, in a pool of processes
+
+A task starts only when the tasks it runs after have finished, its estimated memory fits in what the running tasks leave
+of the memory budget, and every disk it reads or writes has fewer than io_per_disk tasks using it. Tasks that do not fit
+yet are passed over for later tasks that do, so small months fill the gaps left next to a large country.
+"""
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import os
+import numpy as np
+import rasterio
+
+def raster_mb(*rasters):
+    """Returns size in MB of the arrays read from rasters (all bands, in their own dtypes)"""
+    total = 0
+    for raster in rasters:
+        with rasterio.open(str(raster)) as src:
+            total += src.width * src.height * sum(np.dtype(x).itemsize for x in src.dtypes)
+    return total / 1024 / 1024
+
+def available_mb():
+    """Returns physical memory currently available in MB, or None where the system does not report it"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def disk_of(path):
+    """Returns device id of disk holding path, or of its nearest existing parent"""
+    path = Path(path).resolve()
+    while not path.exists():
+        path = path.parent
+    return path.stat().st_dev
+
+class Task:
+    """Function call with the memory and disks it needs"""
+
+    def __init__(self, name, func, args=(), kwargs=None, memory_mb=0, paths=(), after=()):
+        """Initialisation function
+        name --> Unique name of task
+        func --> Module level function (it is sent to a worker process)
+        args, kwargs --> Arguments of func
+        memory_mb --> Estimated peak memory of func in MB, e.g. from raster_mb. Default is 0
+        paths --> Files or folders read or written. One I/O slot is taken on the disk of each. Default is none
+        after --> Names of tasks that must finish first. Default is none
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.memory_mb = memory_mb
+        self.disks = {disk_of(x) for x in paths}
+        self.after = list(after)
+
+class Scheduler:
+    """Process pool that starts tasks in the order they were added as far as dependencies, memory and disks allow"""
+
+    def __init__(self, workers=None, memory_mb=None, io_per_disk=2):
+        """Initialisation function
+        workers --> Number of processes. Default is number of cpus
+        memory_mb --> Memory budget in MB shared by running tasks. Default is memory available when run() starts
+        io_per_disk --> Most tasks using one disk at once. Default is 2
+        """
+        self.workers = workers or os.cpu_count()
+        self.memory_mb = memory_mb
+        self.io_per_disk = io_per_disk
+        self.budget = memory_mb
+        self.tasks = {}
+
+    def add(self, name, func, args=(), kwargs=None, memory_mb=0, paths=(), after=()):
+        """Adds task (see Task) and returns it"""
+        if name in self.tasks:
+            raise ValueError(f'task {name} already exists')
+        missing = [x for x in after if x not in self.tasks]
+        if missing:
+            raise ValueError(f'task {name} runs after unknown tasks {missing}')
+        self.tasks[name] = Task(name, func, args, kwargs, memory_mb, paths, after)
+        return self.tasks[name]
+
+    def fits(self, task, memory_used, disks_used):
+        """Returns True if task fits next to running tasks using memory_used MB and {disk: tasks} disks_used"""
+        if self.budget is not None and memory_used + task.memory_mb > self.budget:
+            return False
+        return all(disks_used.get(x, 0) < self.io_per_disk for x in task.disks)
+
+    def run(self):
+        """Runs all tasks and returns {name: result}. The first exception raised by a task is raised once running tasks finish"""
+        self.budget = self.memory_mb if self.memory_mb is not None else available_mb()
+        waiting = list(self.tasks.values())
+        results, running = {}, {}
+        memory_used, disks_used = 0, {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while waiting or running:
+                for task in list(waiting):
+                    if len(running) >= self.workers:
+                        break
+                    if any(x not in results for x in task.after):
+                        continue
+                    #A task larger than the budget runs once nothing else is running
+                    if running and not self.fits(task, memory_used, disks_used):
+                        continue
+                    waiting.remove(task)
+                    running[executor.submit(task.func, *task.args, **task.kwargs)] = task
+                    memory_used += task.memory_mb
+                    for disk in task.disks:
+                        disks_used[disk] = disks_used.get(disk, 0) + 1
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    memory_used -= task.memory_mb
+                    for disk in task.disks:
+                        disks_used[disk] -= 1
+                        if not disks_used[disk]:
+                            del disks_used[disk]
+                    results[task.name] = future.result()
+        return results
@@ -1,55 +1,65 @@
 import rasterio
 import numpy as np 
-import rasterstats
 from pathlib import Path
 from rasterio._fill import _fillnodata
+from output_profiles import output_profile, finalise
+from tiled_fill import fill_nodata_tiled
+from capital_stats import capital_max
 
 
 class SmoothOutliers(object):
     """Calculates maximum NTL value in capital region of country (defined by input shapefile. Any other pixels >= this value are made NoData and then interpolated (IDW) using values from surrounding pixels. This reduces the effect of outliers caused by snow, gas flairs and dry river beds"""
-    def __init__(self, rad_raster, capital_shp, out_raster):
+    def __init__(self, rad_raster, capital_shp, out_raster, preset='archival'):
+        """
+        rad_raster --> Thresholded radiance raster
+        capital_shp --> Shapefile of capital region
+        out_raster --> Output raster
+        preset --> Output profile preset (see output_profiles). Default is 'archival'
+        """
         self.rad_raster = rad_raster
         self.capital_shp = capital_shp
         self.out_raster = out_raster
+        self.preset = preset
 
-    def get_max_in_capital(self):
-        """Returns maximum of zonal statistics of NTL in capital region defined by input shapefile"""
-        stats = rasterstats.zonal_stats(str(self.capital_shp), str(self.rad_raster), stats=['max'])
-        return stats[0]['max']
+    def get_max_in_capital(self, use_cache=True):
+        """Returns maximum NTL in capital region defined by input shapefile. Only the capital's window is read and the
+        result is cached by raster contents and capital geometry (see capital_stats)
+        use_cache --> Default is True
+        """
+        return capital_max(self.rad_raster, self.capital_shp, use_cache=use_cache)
 
-    def interpolate_high_values(self, max_value):
-        """Creates raster with smoothed outliers"""
-        template = rasterio.open(self.rad_raster)
-        profile = template.profile
-        profile.update(count=1,
-                        compress='lzw',
-                        predictor=2,
-                        bigtiff='yes',
-                        nodata=-99999)
-        template.close()
-        with rasterio.open(str(self.rad_raster)) as src, rasterio.open(str(self.out_raster), 'w', **profile) as dst:
-            rad_data = src.read()
-            mask = np.full((rad_data.shape), 1)
-            mask[np.where(rad_data > max_value)] = 0
-            print(mask[np.where(mask == 0)])
-            rad_data[np.where(rad_data > max_value)] = -99999
-            result = _fillnodata(rad_data, mask=mask)
-            dst.write(result)
+    def interpolate_high_values(self, max_value, tiled=False, max_search_distance=100, tile_size=1024, workers=None):
+        """Creates raster with smoothed outliers. Pixels above max_value are interpolated from surrounding valid pixels.
+        Existing nodata pixels are neither used for interpolation nor filled
+        max_value --> Value returned from self.get_max_in_capital()
+        tiled --> Interpolate overlapping tiles in a process pool instead of the whole raster at once. Default is False
+        max_search_distance --> Furthest distance in pixels searched. Default is 100 (GDAL default)
+        tile_size --> Size in pixels of tile cores when tiled. Default is 1024
+        workers --> Processes used when tiled. Default is number of cpus
+        """
+        with rasterio.open(str(self.rad_raster)) as src, rasterio.open(str(self.out_raster), 'w', **output_profile(src.profile, self.preset)) as dst:
+            rad_data = src.read(1)
+            nodata = rad_data == -99999
+            outliers = rad_data > max_value
+            print(f'Interpolating {outliers.sum()} pixels above {max_value}')
+            rad_data[outliers] = -99999
+            valid = ~(nodata | outliers)
+            if tiled:
+                result = fill_nodata_tiled(rad_data, valid, max_search_distance=max_search_distance,
+                                           tile_size=tile_size, workers=workers, use_processes=True)
+            else:
+                result = _fillnodata(rad_data, valid.astype('uint8'), max_search_distance)
+            result[nodata] = -99999
+            dst.write(result, 1)
+        finalise(self.out_raster, self.preset)
 
 
     def remove_cap_max(self, cap_max):
         """Function max values over capital maximum ND, instead of interpolating into these pixels
         cap_max --> Value returned from self.get_max_in_captal()
         """
-        template = rasterio.open(self.rad_raster)
-        profile = template.profile
-        profile.update(count=1,
-                        compress='lzw',
-                        predictor=2,
-                        bigtiff='yes',
-                        nodata=-99999)
-        template.close()
-        with rasterio.open(str(self.rad_raster)) as src, rasterio.open(str(self.out_raster), 'w', **profile) as dst:
+        with rasterio.open(str(self.rad_raster)) as src, rasterio.open(str(self.out_raster), 'w', **output_profile(src.profile, self.preset)) as dst:
             rad_data = src.read()
             rad_data[np.where(rad_data > cap_max)] = -99999
             dst.write(rad_data)
+        finalise(self.out_raster, self.preset)
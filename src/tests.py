@@ -1,7 +1,50 @@
 """Unittests for VIIRS processing scripts"""
 
 from unittest import TestCase, main as testmain
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from unittest import skipUnless
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+import rasterio
+from rasterio._fill import _fillnodata
+from rasterio.features import geometry_mask
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+import shapely
+from shapely.geometry import box, Polygon
 import main
+import cache_utils
+import capital_stats
+from zonal_engine import ZonalEngine
+from threshold_sweep import ThresholdSweep, pearson_rows
+from results_store import ResultsStore, split_column
+from pixel_area import pixel_areas, quadrangle_area, geodesic_areas
+from time_series import ZonalTimeSeries
+from viirs_zonal_stats import VIIRSZonalStats
+from pipeline import Pipeline
+from scheduler import Scheduler, raster_mb
+from preprocess import preprocess_month
+from tiled_fill import fill_nodata_tiled
+from reclass_rasters import strip_windows, SetThreshold, ReclassByThreshold, NormaliseAdminViews, NormaliseLabels
+from admin_views import AdminViews
+import output_profiles
+import ppp_zonal_stats
+from label_grid import LabelGrid
+from tile_index import TileIndex
+from extract_rasters import ExtractFromTiles, read_shapes
+from national_rasters import extract_national_rasters
+
+def set_entries(path, process, count):
+    """Sets count entries of process in JSONCache at path. Used by worker processes"""
+    cache = cache_utils.JSONCache(path)
+    for index in range(count):
+        cache.set(f'{process}-{index}', index)
 
 class ViirsProcessing(TestCase):
     """Unittests for VIIRS processing scripts"""
@@ -19,5 +62,734 @@ class ViirsProcessing(TestCase):
         self.assertEqual('DavidHyekyung', 'DavidHyekyung')
         
 
+class TiledFill(TestCase):
+    """Tiled interpolation should match interpolating the whole raster at once"""
+
+    def setUp(self):
+        """Random radiance with gaps"""
+        rng = np.random.default_rng(0)
+        self.data = rng.gamma(0.5, 4, (300, 350)).astype('float32')
+        self.valid = rng.random(self.data.shape) > 0.2
+        self.data[~self.valid] = -99999
+
+    def test_tiled_matches_monolithic(self):
+        """Threads and processes give the monolithic result"""
+        expected = _fillnodata(self.data.copy(), self.valid.astype('uint8'), 10, 0)
+        for use_processes in [False, True]:
+            result = fill_nodata_tiled(self.data, self.valid, max_search_distance=10, tile_size=64, workers=2, use_processes=use_processes)
+            np.testing.assert_allclose(result, expected, atol=1e-5)
+
+
+class StripProcessing(TestCase):
+    """Rasters processed in strips under a memory budget should be identical to rasters processed whole"""
+
+    def setUp(self):
+        """Tiled radiance and coverage rasters three block rows high"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        rad = rng.random((600, 700), dtype='float32') * 10
+        rad[rng.random((600, 700)) < 0.1] = -99999
+        self.rad, self.cvg = self.folder.joinpath('rad.tif'), self.folder.joinpath('cvg.tif')
+        for raster, data in [(self.rad, rad), (self.cvg, rng.integers(0, 10, (600, 700), dtype='uint8'))]:
+            with rasterio.open(str(raster), 'w', driver='GTiff', width=700, height=600, count=1, dtype=data.dtype, crs='EPSG:4326',
+                               transform=from_origin(0, 10, 0.01, 0.01), nodata=-99999 if data.dtype.kind == 'f' else None,
+                               tiled=True, blockxsize=256, blockysize=256) as dst:
+                dst.write(data, 1)
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def assertSameRasters(self, rasters):
+        """Asserts rasters have the same profile and bytes of data"""
+        outputs = []
+        for raster in rasters:
+            with rasterio.open(str(raster)) as src:
+                outputs.append((src.profile, src.read().tobytes()))
+        for profile, data in outputs[1:]:
+            self.assertEqual(profile, outputs[0][0])
+            self.assertTrue(data == outputs[0][1])
+
+    def test_strip_windows(self):
+        """Strips are whole block rows within budget, at least one block row, and cover the raster once"""
+        with rasterio.open(str(self.rad)) as src:
+            strips = lambda memory_mb: [(x.row_off, x.height) for x in strip_windows(src, 9, memory_mb)]
+            self.assertEqual(strips(0.01), [(0, 256), (256, 256), (512, 88)])
+            self.assertEqual(strips(530 * 700 * 9 / 1024 / 1024), [(0, 512), (512, 88)])
+            self.assertEqual(strips(1000), [(0, 600)])
+            self.assertTrue(all(x.col_off == 0 and x.width == 700 for x in strip_windows(src, 9, 0.01)))
+
+    def test_set_threshold_blocks(self):
+        """Strips smaller than one block row and larger than the raster write the same output as the whole raster"""
+        outputs = [self.folder.joinpath(f'thrsh_{x}.tif') for x in ['whole', 'small', 'large']]
+        for out_rad, memory_mb in zip(outputs, [None, 0.01, 1000]):
+            SetThreshold(self.rad, self.cvg, out_rad, cvg_threshold=3, rad_threshold=2, memory_mb=memory_mb)
+        self.assertSameRasters(outputs)
+
+    def test_reclass_by_threshold(self):
+        """ReclassByThreshold writes the same output whatever memory_mb"""
+        outputs = [self.folder.joinpath(f'reclass_{x}.tif') for x in ['whole', 'small', 'large']]
+        for outname, memory_mb in zip(outputs, [None, 0.01, 1000]):
+            ReclassByThreshold(self.rad, 4.5, outname, memory_mb=memory_mb)
+        self.assertSameRasters(outputs)
+
+    def test_memory_with_interpolation(self):
+        """Interpolation needs the whole raster, so a memory budget is refused"""
+        with self.assertRaises(ValueError):
+            SetThreshold(self.rad, self.cvg, self.folder.joinpath('out.tif'), interpolate_nodata=True, memory_mb=10)
+
+
+class NormaliseEngines(TestCase):
+    """Label grid normalisation should match the admin views engine"""
+
+    def setUp(self):
+        """Three months of a national raster with nodata, four units (one constant, one without valid pixels) and pixels outside all units"""
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        rng = np.random.default_rng(0)
+        self.months = [tmp.joinpath(x) for x in ['01', '02', '03']]
+        for month in self.months:
+            month.mkdir()
+            data = (rng.random((20, 30)) * 50).astype('float32')
+            data[rng.random((20, 30)) < 0.2] = -99999
+            data[10:20, 0:10] = 7
+            data[0:10, 10:20] = -99999
+            with rasterio.open(str(month.joinpath(f'XXX_{month.name}_rad_cap_smth.tif')), 'w', driver='GTiff', width=30, height=20, count=1,
+                               dtype='float32', crs='EPSG:4326', transform=from_origin(0, 20, 1, 1), nodata=-99999) as dst:
+                dst.write(data, 1)
+        self.shp = tmp.joinpath('units.shp')
+        gpd.GeoDataFrame({'ADM1': ['a', 'b', 'c', 'd']},
+                         geometry=[box(0, 10, 10, 20), box(10, 10, 20, 20), box(0, 0, 10, 10), box(10, 0, 20, 10)],
+                         crs='EPSG:4326').to_file(str(self.shp))
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def read_normalised(self):
+        """Returns stack of normalised months"""
+        arrays = []
+        for month in self.months:
+            with rasterio.open(str(month.joinpath(f'XXX_{month.name}_normalised.tif'))) as src:
+                arrays.append(src.read(1))
+        return np.stack(arrays)
+
+    def test_labels_match_views(self):
+        """Unit min and max and normalised months agree on valid pixels, and nodata stays nodata"""
+        raster = self.months[0].joinpath('XXX_01_rad_cap_smth.tif')
+        views = AdminViews.from_raster(self.shp, raster)
+        NormaliseAdminViews(views, self.months, 'XXX')
+        by_views = self.read_normalised()
+        labels = NormaliseLabels(LabelGrid.from_raster(self.shp, raster), self.months, 'XXX')
+        by_labels = self.read_normalised()
+        stack, _ = labels.read_national_stack()
+        label_min, label_max = labels.label_min_max(stack)
+        national = np.where(np.isnan(stack), -99999, stack)
+        for label, name in enumerate(['a', 'b', 'c', 'd'], 1):
+            unit = views.read(national, name)
+            if unit.count():
+                self.assertEqual((label_min[label], label_max[label]), (unit.min(), unit.max()))
+            else:
+                self.assertEqual((label_min[label], label_max[label]), (np.inf, -np.inf))
+        np.testing.assert_array_equal(by_labels == -99999, by_views == -99999)
+        self.assertTrue((by_labels[national == -99999] == -99999).all())
+        self.assertTrue((by_labels[:, :, 20:] == -99999).all())
+        valid = by_views != -99999
+        np.testing.assert_allclose(by_labels[valid], by_views[valid], rtol=1e-6)
+        self.assertTrue((by_labels[:, 10:20, 0:10] == 0).all())
+
+
+class OutputProfiles(TestCase):
+    """Output profiles should pick predictor from dtype, fall back from ZSTD and let overrides win"""
+
+    def setUp(self):
+        """Base profile of a grid larger than one block"""
+        self.base = {'driver': 'GTiff', 'width': 600, 'height': 600, 'count': 1, 'dtype': 'float32', 'crs': 'EPSG:4326',
+                     'transform': from_origin(0, 60, 0.1, 0.1), 'nodata': None, 'compress': 'lzw', 'blockxsize': 128, 'blockysize': 128}
+
+    def tearDown(self):
+        """Forget codec availability set by tests"""
+        output_profiles._available.clear()
+
+    def test_predictor_from_dtype(self):
+        """Predictor 3 for floats and 2 for integers, whatever the base profile dtype"""
+        self.assertEqual(output_profiles.output_profile(self.base)['predictor'], 3)
+        self.assertEqual(output_profiles.output_profile(self.base, dtype='float64')['predictor'], 3)
+        for dtype in ['uint8', 'int16', 'int32']:
+            self.assertEqual(output_profiles.output_profile(self.base, dtype=dtype)['predictor'], 2)
+
+    def test_presets(self):
+        """Preset options replace the creation options of the base profile"""
+        profile = output_profiles.output_profile(self.base, 'archival')
+        self.assertEqual((profile['compress'], profile['zlevel'], profile['blockxsize']), ('deflate', 9, 512))
+        self.assertEqual(profile['nodata'], -99999)
+        small = output_profiles.output_profile(dict(self.base, width=100, height=100), 'archival')
+        self.assertFalse(small['tiled'])
+        self.assertNotIn('blockxsize', small)
+        with self.assertRaises(ValueError):
+            output_profiles.output_profile(self.base, 'fastest')
+
+    def test_zstd_fallback(self):
+        """Without ZSTD, fast-scratch writes light DEFLATE and drops zstd_level"""
+        output_profiles._available['zstd'] = True
+        self.assertEqual(output_profiles.output_profile(self.base, 'fast-scratch')['compress'], 'zstd')
+        output_profiles._available['zstd'] = False
+        profile = output_profiles.output_profile(self.base, 'fast-scratch')
+        self.assertEqual((profile['compress'], profile['zlevel']), ('deflate', 1))
+        self.assertNotIn('zstd_level', profile)
+        self.assertEqual(profile['blockxsize'], 256)
+
+    def test_overrides_win(self):
+        """Keyword overrides replace preset values"""
+        profile = output_profiles.output_profile(self.base, 'archival', zlevel=1, blockxsize=1024, predictor=1, bigtiff='yes')
+        self.assertEqual((profile['zlevel'], profile['blockxsize'], profile['predictor'], profile['bigtiff']), (1, 1024, 1, 'yes'))
+
+    def test_finalise_cog(self):
+        """finalise rewrites rasters of the cog preset as COG with overviews and leaves other presets alone"""
+        with tempfile.TemporaryDirectory() as tmp:
+            data = np.random.default_rng(0).random((600, 600), dtype='float32')
+            for preset in ['cog', 'archival']:
+                raster = Path(tmp).joinpath(f'{preset}.tif')
+                with rasterio.open(str(raster), 'w', **output_profiles.output_profile(self.base, preset)) as dst:
+                    dst.write(data, 1)
+                output_profiles.finalise(raster, preset)
+                with rasterio.open(str(raster)) as src:
+                    layout = src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT')
+                    np.testing.assert_array_equal(src.read(1), data)
+                    if preset == 'cog':
+                        self.assertEqual(layout, 'COG')
+                        self.assertEqual(src.overviews(1), [2])
+                    else:
+                        self.assertIsNone(layout)
+                        self.assertEqual(src.overviews(1), [])
+            self.assertEqual(sorted(x.name for x in Path(tmp).iterdir()), ['archival.tif', 'cog.tif'])
+
+
+class SharedJSONCache(TestCase):
+    """JSONCache written by several processes at once should keep every entry"""
+
+    def test_concurrent_set(self):
+        """8 processes each setting 50 entries leave all 400 in the file"""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name).joinpath('cache.json')
+        with ProcessPoolExecutor(max_workers=8) as executor:
+            list(executor.map(set_entries, [path] * 8, range(8), [50] * 8))
+        entries = cache_utils.JSONCache(path).entries
+        self.assertEqual(len(entries), 400)
+        self.assertEqual(entries['7-49'], 49)
+        self.assertEqual([x.name for x in Path(tmp.name).iterdir() if x.suffix == '.tmp'], [])
+
+
+class ClipToShapes(TestCase):
+    """In-process clip should snap to source pixels and mask by pixel centre like gdalwarp -crop_to_cutline"""
+
+    def setUp(self):
+        """Quarter degree raster with nodata and a triangle"""
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        self.data = np.arange(100 * 100, dtype='float32').reshape(100, 100)
+        self.raster = tmp.joinpath('tile.tif')
+        with rasterio.open(str(self.raster), 'w', driver='GTiff', width=100, height=100, count=1, dtype='float32',
+                           crs='EPSG:4326', transform=from_origin(0, 25, 0.25, 0.25), nodata=-99999) as dst:
+            dst.write(self.data, 1)
+        self.shp = tmp.joinpath('triangle.shp')
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def clip(self, geometry, engine='rasterio'):
+        """Returns (array, transform) of raster clipped to geometry with engine"""
+        gpd.GeoDataFrame(geometry=[geometry], crs='EPSG:4326').to_file(str(self.shp))
+        out_raster = self.shp.with_name(f'{engine}.tif')
+        ExtractFromTiles(self.raster, self.shp, out_raster, engine=engine)
+        with rasterio.open(str(out_raster)) as src:
+            return src.read(1), src.transform
+
+    def test_window_snapping_and_cutline(self):
+        """Bounds off the grid are snapped outwards to source pixels and pixels with centres outside are nodata"""
+        triangle = Polygon([(2.1, 5.1), (11.9, 5.1), (2.1, 19.9)])
+        data, transform = self.clip(triangle)
+        self.assertEqual(transform, from_origin(2, 20, 0.25, 0.25))
+        self.assertEqual(data.shape, (60, 40))
+        rows, cols = np.mgrid[20:80, 8:48]
+        inside = shapely.contains_xy(triangle, cols * 0.25 + 0.125, 25 - rows * 0.25 - 0.125)
+        np.testing.assert_array_equal(data, np.where(inside, self.data[20:80, 8:48], -99999))
+
+    @skipUnless(shutil.which('gdalwarp'), 'gdalwarp is not installed')
+    def test_matches_gdalwarp(self):
+        """rasterio engine writes the same grid and values as gdalwarp"""
+        triangle = Polygon([(2, 5), (12, 5), (2, 20)])
+        data, transform = self.clip(triangle)
+        gdal_data, gdal_transform = self.clip(triangle, engine='gdalwarp')
+        self.assertTrue(transform.almost_equals(gdal_transform))
+        np.testing.assert_array_equal(data, gdal_data)
+
+    def test_read_shapes_copies(self):
+        """Changing a GeoDataFrame from read_shapes leaves the cached one as it was"""
+        gpd.GeoDataFrame(geometry=[box(2, 5, 12, 20)], crs='EPSG:4326').to_file(str(self.shp))
+        gdf = read_shapes(self.shp)
+        gdf['geometry'] = gdf.translate(1, 1)
+        gdf['name'] = 'changed'
+        self.assertEqual(tuple(read_shapes(self.shp).total_bounds), (2, 5, 12, 20))
+        self.assertNotIn('name', read_shapes(self.shp).columns)
+
+
+class TileWindows(TestCase):
+    """Tile index should find tiles from their bounds and read only the pixels of each tile a country covers"""
+
+    def setUp(self):
+        """Two neighbouring 1 degree tiles with names that do not give their extent, and an L shaped country crossing them"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.basedir = Path(self.tmp.name)
+        self.month = self.basedir.joinpath('tiles/01')
+        self.month.mkdir(parents=True)
+        self.data = np.arange(75 * 240, dtype='float32').reshape(75, 240)
+        self.tiles = []
+        for name, west, data in [('a', -180, self.data[:, :120]), ('b', -60, self.data[:, 120:])]:
+            tile = self.month.joinpath(f'{name}.avg_rade9h.tif')
+            with rasterio.open(str(tile), 'w', driver='GTiff', width=120, height=75, count=1, dtype='float32',
+                               crs='EPSG:4326', transform=from_origin(west, 75, 1, 1), nodata=-99999) as dst:
+                dst.write(data, 1)
+            self.tiles.append(tile)
+        self.country = gpd.GeoDataFrame(geometry=[box(-70, 10, -65, 20).union(box(-70, 10, -50, 12))], crs='EPSG:4326')
+        self.shp = self.basedir.joinpath('datain/shps/XXX/XXX_adm1.shp')
+        self.shp.parent.mkdir(parents=True)
+        self.country.to_file(str(self.shp))
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def test_windows_for(self):
+        """Window in each tile covers only the part of the country inside it"""
+        index = TileIndex()
+        self.assertEqual([index.extent_of(x) for x in self.tiles], ['75N180W', '75N060W'])
+        self.assertEqual(index.tiles_for(self.shp), ['75N060W', '75N180W'])
+        self.assertEqual(index.windows_for(self.shp, self.tiles), {'75N180W': Window(110, 55, 10, 10), '75N060W': Window(0, 63, 10, 2)})
+
+    def test_extract_national_rasters(self):
+        """Parts clipped with tile windows mosaic to the country cut from both tiles at once"""
+        extract_national_rasters(self.basedir, [self.month], ['XXX'])
+        out_raster = self.basedir.joinpath('datain/XXX/01/XXX_01_rad_tmp.tif')
+        with rasterio.open(str(out_raster)) as src:
+            result = src.read(1)
+            self.assertEqual(tuple(src.bounds), (-70, 10, -50, 20))
+        expected = self.data[55:65, 110:130].copy()
+        expected[geometry_mask(self.country['geometry'], out_shape=expected.shape, transform=from_origin(-70, 20, 1, 1))] = -99999
+        np.testing.assert_array_equal(result, expected)
+        self.assertEqual(sorted(x.name for x in out_raster.parent.iterdir()), ['XXX_01_rad_tmp.tif'])
+
+
+class CapitalMax(TestCase):
+    """Windowed capital maximum should ignore pixels outside capital and nodata, and be reused from cache"""
+
+    def setUp(self):
+        """Raster with a bright pixel outside capital and nodata inside it"""
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        cache_utils._hashes = cache_utils.JSONCache(tmp.joinpath('file_hashes.json'))
+        capital_stats._cache = cache_utils.JSONCache(tmp.joinpath('capital_max.json'))
+        data = np.arange(100, dtype='float32').reshape(10, 10)
+        data[0, 9] = 1000
+        data[6, 3] = -99999
+        self.raster = tmp.joinpath('rad.tif')
+        with rasterio.open(str(self.raster), 'w', driver='GTiff', width=10, height=10, count=1, dtype='float32',
+                           crs='EPSG:4326', transform=from_origin(0, 10, 1, 1), nodata=-99999) as dst:
+            dst.write(data, 1)
+        self.capital_shp = tmp.joinpath('capital.shp')
+        gpd.GeoDataFrame(geometry=[box(2, 2, 5, 5)], crs='EPSG:4326').to_file(str(self.capital_shp))
+
+    def tearDown(self):
+        """Remove temporary files and caches"""
+        cache_utils._hashes = None
+        capital_stats._cache = None
+        self.tmp.cleanup()
+
+    def test_capital_max(self):
+        """Maximum is taken over pixel centres inside capital, then read from cache"""
+        self.assertEqual(capital_stats.capital_max(self.raster, self.capital_shp), 74)
+        self.assertEqual(len(capital_stats._cache.entries), 1)
+        self.assertEqual(capital_stats.capital_max(self.raster, self.capital_shp), 74)
+        self.assertEqual(len(capital_stats._cache.entries), 1)
+
+
+class ZoneRaster:
+    """Fixture of a 20 x 20 raster with two zones on it and one zone outside it. Mixed into test cases that use it"""
+
+    def setUp(self):
+        """Two zones and one zone outside the raster"""
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        rng = np.random.default_rng(1)
+        self.data = rng.gamma(1, 5, (20, 20)).astype('float32')
+        self.data[3, 3] = -99999
+        self.raster = tmp.joinpath('rad.tif')
+        with rasterio.open(str(self.raster), 'w', driver='GTiff', width=20, height=20, count=1, dtype='float32',
+                           crs='EPSG:4326', transform=from_origin(0, 20, 1, 1), nodata=-99999) as dst:
+            dst.write(self.data, 1)
+        self.shp = tmp.joinpath('zones.shp')
+        gpd.GeoDataFrame({'GID': [1, 2, 3], 'NAME1': ['a', 'b', 'c']}, geometry=[box(0, 10, 10, 20), box(10, 0, 20, 20), box(30, 30, 31, 31)],
+                         crs='EPSG:4326').to_file(str(self.shp))
+        self.cache_dir = tmp.joinpath('cache')
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+
+class LabelZonalStats(ZoneRaster, TestCase):
+    """Label grid statistics should match reducing each zone's pixels separately"""
+
+    def test_label_stats_match_numpy(self):
+        """All statistics match numpy per zone, empty zones are NaN, and label grid is cached"""
+        df = ZonalEngine(self.shp, fields=['GID'], cache_dir=self.cache_dir).zonal_stats(self.raster)
+        for row, zone in [(0, self.data[:10, :10]), (1, self.data[:, 10:])]:
+            values = zone[zone != -99999].astype('float64')
+            self.assertEqual(df['count'][row], values.size)
+            for stat, func in [('sum', np.sum), ('mean', np.mean), ('std', np.std), ('min', np.min), ('max', np.max)]:
+                self.assertAlmostEqual(df[stat][row], func(values), places=4)
+        self.assertEqual(df['count'][2], 0)
+        self.assertTrue(np.isnan(df['sum'][2]))
+        self.assertEqual(len(list(self.cache_dir.joinpath('labels').iterdir())), 1)
+
+    def test_zones_without_pixels_get_polygon_area(self):
+        """Zones holding no pixel centre, inside or outside the raster, get their geodesic polygon area"""
+        shp = Path(tempfile.mkdtemp(dir=self.tmp.name)).joinpath('small.shp')
+        gpd.GeoDataFrame({'GID': [1, 2, 3]}, geometry=[box(0, 10, 10, 20), box(0.1, 18.1, 0.4, 18.4), box(30, 30, 31, 31)],
+                         crs='EPSG:4326').to_file(str(shp))
+        for coverage in [False, True]:
+            areas = ZonalEngine(shp, fields=['GID'], cache_dir=self.cache_dir, coverage=coverage).zone_areas(self.raster)['area']
+            self.assertAlmostEqual(areas[0] / quadrangle_area(10, 20, 10), 1, places=6)
+            self.assertAlmostEqual(areas[2] / quadrangle_area(30, 31, 1), 1, places=3)
+            self.assertAlmostEqual(areas[2], geodesic_areas(gpd.read_file(str(shp)))[2])
+        labels = ZonalEngine(shp, fields=['GID'], cache_dir=self.cache_dir).zone_areas(self.raster)['area']
+        self.assertAlmostEqual(labels[1] / quadrangle_area(18.1, 18.4, 0.3), 1, places=3)
+
+
+class ThresholdSweepStats(ZoneRaster, TestCase):
+    """Sweep over thresholds should match reducing each zone's pixels at or above each threshold"""
+
+    def test_sweep_matches_numpy(self):
+        """Sums, means and stds match numpy for every threshold, and correlation matches pandas"""
+        thresholds = [0, 2.5, 5, 100]
+        sweep = ThresholdSweep(self.raster, self.shp, thresholds, cache_dir=self.cache_dir)
+        for row, zone in [(0, self.data[:10, :10]), (1, self.data[:, 10:])]:
+            for index, threshold in enumerate(thresholds):
+                values = zone[(zone != -99999) & (zone >= threshold)].astype('float64')
+                self.assertEqual(sweep.count[index, row], values.size)
+                if values.size:
+                    self.assertAlmostEqual(sweep.sum[index, row], values.sum(), places=3)
+                    self.assertAlmostEqual(sweep.std[index, row], values.std(), places=4)
+                else:
+                    self.assertTrue(np.isnan(sweep.sum[index, row]))
+        other = np.array([1.0, 3.0, 2.0])
+        Y = np.array([[1.0, 2.0, 4.0], [np.nan, 1.0, 0.5]])
+        for row in range(2):
+            expected = pd.Series(other).corr(pd.Series(Y[row]))
+            self.assertAlmostEqual(pearson_rows(other, Y)[row], expected)
+
+    def test_std_of_large_values(self):
+        """Stds stay exact when the mean is far larger than the spread, with labels and with coverage weights"""
+        raster = self.raster.with_name('offset.tif')
+        data = np.where(self.data == -99999, -99999, self.data.astype('float64') + 1e7)
+        with rasterio.open(str(self.raster)) as src:
+            profile = dict(src.profile, dtype='float64')
+        with rasterio.open(str(raster), 'w', **profile) as dst:
+            dst.write(data, 1)
+        values = data[:10, :10][data[:10, :10] != -99999]
+        for coverage in [False, True]:
+            sweep = ThresholdSweep(raster, self.shp, [0, 1e7 + 5], cache_dir=self.cache_dir, coverage=coverage)
+            self.assertAlmostEqual(sweep.std[0, 0], values.std(), places=6)
+            self.assertAlmostEqual(sweep.std[1, 0], values[values >= 1e7 + 5].std(), places=6)
+
+
+class CoverageFractions(ZoneRaster, TestCase):
+    """Coverage weights should count partly covered pixels by the fraction covered"""
+
+    def test_fractions_of_cut_pixels(self):
+        """Zone on pixel edges matches label stats, zone cutting pixels in half weighs them by half"""
+        labels = ZonalEngine(self.shp, fields=['GID'], cache_dir=self.cache_dir).zonal_stats(self.raster)
+        coverage = ZonalEngine(self.shp, fields=['GID'], cache_dir=self.cache_dir, coverage=True).zonal_stats(self.raster)
+        for stat in ['count', 'sum', 'mean', 'std', 'min', 'max']:
+            np.testing.assert_allclose(coverage[stat], labels[stat], rtol=1e-6)
+        half = tempfile.mkdtemp(dir=self.tmp.name)
+        shp = Path(half).joinpath('half.shp')
+        gpd.GeoDataFrame({'GID': [1]}, geometry=[box(0.5, 18, 2.5, 19)], crs='EPSG:4326').to_file(str(shp))
+        with rasterio.open(str(self.raster)) as src:
+            df = ZonalEngine(shp, fields=['GID'], cache_dir=self.cache_dir, coverage=True).coverage_weights(src).reduce(self.data)
+        self.assertAlmostEqual(df['count'][0], 2)
+        self.assertAlmostEqual(df['sum'][0], 0.5 * self.data[1, 0] + self.data[1, 1] + 0.5 * self.data[1, 2], places=4)
+
+
+class ParallelZonalStats(ZoneRaster, TestCase):
+    """Months summed in a process pool should give the same table as summing them one at a time"""
+
+    def write_months(self):
+        """Returns month folders 01 and 02 holding the raster times 1 and 2"""
+        months = []
+        for month, factor in [('01', 1), ('02', 2)]:
+            folder = Path(self.tmp.name).joinpath(f'HTI/{month}')
+            folder.mkdir(parents=True)
+            with rasterio.open(str(self.raster)) as src:
+                profile = src.profile
+            with rasterio.open(str(folder.joinpath(f'HTI_{month}_rad.tif')), 'w', **profile) as dst:
+                dst.write(np.where(self.data == -99999, -99999, self.data * factor), 1)
+            months.append(folder)
+        return months
+
+    def test_parallel_matches_serial(self):
+        """Every engine, including views which leave out the unit outside the raster, joins sums to the right units"""
+        months = self.write_months()
+        for engine in ['rasterstats', 'views', 'labels']:
+            tables = [pd.DataFrame(VIIRSZonalStats('HTI', months, self.shp, None, None, 1, raster_type='_rad.tif', engine=engine,
+                                                   workers=workers, export=False, cache_dir=self.cache_dir).gdf).drop('geometry', axis=1)
+                      for workers in [None, 2]]
+            pd.testing.assert_frame_equal(tables[1], tables[0])
+            first = tables[0].set_index('NAME1')
+            self.assertAlmostEqual(first.loc['b', 'sum02'], 2 * self.data[:, 10:][self.data[:, 10:] != -99999].astype('float64').sum(), places=2)
+
+    def test_ppp_months_joined(self):
+        """Monthly ppp tables computed in a pool are joined into one row per unit with sum, mean and std columns per month"""
+        basedir = Path(self.tmp.name)
+        for folder, raster in [('ppp_2016', 'hti_ppp_2016.tif'), ('01', 'HTI_01_rad_cap_smth.tif'), ('02', 'HTI_02_rad_cap_smth.tif')]:
+            basedir.joinpath(f'datain/HTI/{folder}').mkdir(parents=True)
+            with rasterio.open(str(self.raster)) as src:
+                profile = src.profile
+            with rasterio.open(str(basedir.joinpath(f'datain/HTI/{folder}/{raster}')), 'w', **profile) as dst:
+                dst.write(np.where(self.data == -99999, -99999, self.data * (2 if folder == '02' else 1)), 1)
+        basedir.joinpath('datain/shps/HTI').mkdir(parents=True)
+        gpd.read_file(str(self.shp)).to_file(str(basedir.joinpath('datain/shps/HTI/HTI_adm1.shp')))
+        out_csv = basedir.joinpath('dataout/HTI/HTI_viirs_L1.csv')
+        tables = []
+        for workers in [None, 2]:
+            ppp_zonal_stats.main(basedir, 'HTI', 1, workers=workers, cache_dir=self.cache_dir)
+            tables.append(pd.read_csv(str(out_csv)))
+        pd.testing.assert_frame_equal(tables[1], tables[0])
+        df = tables[1].set_index('NAME1')
+        self.assertEqual(list(tables[1].columns), ['GID', 'NAME1', 'sum01', 'mean01', 'std01', 'sum02', 'mean02', 'std02'])
+        self.assertEqual(list(df.index), ['a', 'b', 'c'])
+        self.assertEqual(list(df['GID']), [1, 2, 3])
+        valid = self.data[:, 10:][self.data[:, 10:] != -99999].astype('float64')
+        self.assertAlmostEqual(df.loc['b', 'sum01'], valid.sum(), places=2)
+        self.assertAlmostEqual(df.loc['b', 'sum02'], 2 * valid.sum(), places=2)
+        self.assertAlmostEqual(df.loc['a', 'mean02'], 2 * df.loc['a', 'mean01'], places=4)
+
+    def test_store_replaces_export(self):
+        """With a store, tables are appended to it and out_shp and out_csv are not written unless asked for"""
+        out_shp, out_csv = Path(self.tmp.name).joinpath('out.shp'), Path(self.tmp.name).joinpath('out.csv')
+        store = ResultsStore(Path(self.tmp.name).joinpath('results'))
+        VIIRSZonalStats('HTI', self.write_months(), self.shp, out_shp, out_csv, 1, raster_type='_rad.tif', engine='labels',
+                        store=store, cache_dir=self.cache_dir)
+        self.assertFalse(out_shp.exists() or out_csv.exists())
+        self.assertIn('sum02', store.wide(country='HTI', level=1).columns)
+
+
+class PixelAreas(TestCase):
+    """Geodesic pixel areas should add up to ellipsoid areas"""
+
+    def test_areas(self):
+        """Whole WGS84 ellipsoid, and a one degree grid summing to its band"""
+        self.assertAlmostEqual(quadrangle_area(-90, 90, 360) / 510065621.724, 1, places=9)
+        areas = pixel_areas(from_origin(0, 10, 1 / 240, 1 / 240), (240, 240))
+        self.assertAlmostEqual(areas.sum() / quadrangle_area(9, 10, 1), 1, places=9)
+        self.assertGreater(areas[-1, 0], areas[0, 0])
+
+
+class ResultsStoreAppend(TestCase):
+    """Results store should append without rewriting parts and return the latest value of each key"""
+
+    def setUp(self):
+        """Empty store"""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ResultsStore(Path(self.tmp.name).joinpath('results'))
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def test_append_and_read(self):
+        """Wide tables round trip, later appends win and projections return only requested columns"""
+        self.assertEqual(split_column('sum01'), ('sum', '01'))
+        self.assertEqual(split_column('annual_ave'), ('annual_ave', 'annual'))
+        first = self.store.append_wide(pd.DataFrame({'NAME1': ['a', 'b'], 'sum01': [1.0, 2.0], 'area': [3.0, 4.0]}), 'HTI', 1, 'NAME1')
+        self.store.append_wide(pd.DataFrame({'NAME1': ['a'], 'sum01': [5.0]}), 'HTI', 1, 'NAME1')
+        self.assertTrue(first.exists())
+        self.assertEqual(len(list(self.store.root.iterdir())), 2)
+        wide = self.store.wide(country='HTI', level=1).set_index('zone')
+        self.assertEqual(list(wide.columns), ['area', 'sum01'])
+        self.assertEqual(wide.loc['a', 'sum01'], 5.0)
+        self.assertEqual(wide.loc['b', 'area'], 4.0)
+        values = self.store.read(columns=['zone', 'value'], metric='area')
+        self.assertEqual(list(values.columns), ['zone', 'value'])
+        self.assertEqual(sorted(values['value']), [3.0, 4.0])
+
+
+class IncrementalTimeSeries(ZoneRaster, TestCase):
+    """Time series should only compute periods that are new or whose raster changed"""
+
+    def test_only_stale_periods_recomputed(self):
+        """Second update computes nothing, rewriting one raster recomputes only its period"""
+        cache_utils._hashes = cache_utils.JSONCache(self.cache_dir.joinpath('file_hashes.json'))
+        self.addCleanup(setattr, cache_utils, '_hashes', None)
+        second = self.raster.with_name('rad2.tif')
+        with rasterio.open(str(self.raster)) as src:
+            profile = src.profile
+        with rasterio.open(str(second), 'w', **profile) as dst:
+            dst.write(np.where(self.data == -99999, -99999, self.data * 2), 1)
+        periods = {('2016', '01'): self.raster, ('2016', '02'): second}
+        store = ResultsStore(self.cache_dir.joinpath('results'))
+        series = ZonalTimeSeries('HTI', 1, self.shp, periods, store, cache_dir=self.cache_dir)
+        self.assertEqual(series.update(), list(periods))
+        self.assertEqual(series.update(), [])
+        with rasterio.open(str(second), 'w', **profile) as dst:
+            dst.write(np.where(self.data == -99999, -99999, self.data * 3), 1)
+        self.assertEqual(series.update(), [('2016', '02')])
+        table = series.table().set_index(['zone', 'month'])
+        expected = self.data[:10, :10][self.data[:10, :10] != -99999].astype('float64').sum() * 3
+        self.assertAlmostEqual(table.loc[('a', '02'), 'value'] / expected, 1, places=5)
+
+
+class PipelineReruns(TestCase):
+    """Pipeline stages should rerun only when inputs, parameters or upstream outputs change"""
+
+    def setUp(self):
+        """Two stages, double reads source and writes doubled, copy reads doubled and writes copied"""
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        cache_utils._hashes = cache_utils.JSONCache(tmp.joinpath('file_hashes.json'))
+        self.addCleanup(setattr, cache_utils, '_hashes', None)
+        self.source, self.doubled, self.copied = tmp.joinpath('source.txt'), tmp.joinpath('doubled.txt'), tmp.joinpath('copied.txt')
+        self.source.write_text('2')
+        def double(factor):
+            self.doubled.write_text(str(int(self.source.read_text()) * factor))
+        def copy():
+            self.copied.write_text(self.doubled.read_text())
+        self.pipeline = Pipeline(tmp.joinpath('pipeline.json'))
+        self.pipeline.add('copy', copy, inputs=[self.doubled], outputs=[self.copied])
+        self.pipeline.add('double', double, inputs=[self.source], outputs=[self.doubled], params={'factor': 2})
+
+    def tearDown(self):
+        """Remove temporary files"""
+        self.tmp.cleanup()
+
+    def test_reruns(self):
+        """Stages run in dependency order, then only when something they read changed"""
+        self.assertEqual(list(self.pipeline.run(dry_run=True)), ['double', 'copy'])
+        self.assertFalse(self.doubled.exists())
+        self.assertEqual(list(self.pipeline.run()), ['double', 'copy'])
+        self.assertEqual(self.copied.read_text(), '4')
+        self.assertEqual(self.pipeline.run(), {})
+        self.pipeline.stages['double'].params['factor'] = 3
+        self.assertEqual(list(self.pipeline.run()), ['double', 'copy'])
+        self.assertEqual(self.copied.read_text(), '6')
+        self.pipeline.stages['double'].params['factor'] = 2
+        self.source.write_text('3')
+        self.assertEqual(list(self.pipeline.run()), ['double'])
+        self.copied.unlink()
+        self.assertEqual(self.pipeline.run(), {'copy': '1 missing outputs'})
+        self.assertEqual(list(self.pipeline.run(from_stage='copy')), ['copy'])
+
+    def test_missing_output_of_skipping_stage(self):
+        """A stage whose function skips existing files rewrites them only when run with overwrite"""
+        first, second = self.source.with_name('first.txt'), self.source.with_name('second.txt')
+        def write_pair(overwrite=False):
+            for path in [first, second]:
+                if overwrite or not path.exists():
+                    path.write_text(self.source.read_text())
+        pipeline = Pipeline(self.source.with_name('pair.json'))
+        stage = pipeline.add('pair', write_pair, inputs=[self.source], outputs=[first, second])
+        pipeline.run()
+        second.unlink()
+        self.assertEqual(pipeline.run(), {'pair': '1 missing outputs'})
+        self.source.write_text('5')
+        pipeline.run()
+        self.assertEqual(first.read_text(), '2')
+        stage.params['overwrite'] = True
+        self.assertEqual(pipeline.run(), {'pair': 'inputs or parameters changed'})
+        self.assertEqual([first.read_text(), second.read_text()], ['5', '5'])
+
+    def test_raw_inputs_not_read(self):
+        """Raw inputs rerun a stage when their size, time or manifest checksum change, but not when only their bytes do"""
+        tile = self.source.with_name('tile.tif')
+        tile.write_bytes(b'0' * 100)
+        manifest = self.source.with_name('download_manifest.json')
+        manifest.write_text(json.dumps({'url': {'file': None, 'sha256': 'a', 'members': [str(tile)]}}))
+        runs = []
+        def pipeline():
+            pipeline = Pipeline(self.source.with_name('raw.json'), manifest=manifest)
+            pipeline.add('extract', lambda: runs.append(tile.read_bytes()), raw_inputs=[tile])
+            return pipeline.run()
+        pipeline()
+        stat = tile.stat()
+        tile.write_bytes(b'1' * 100)
+        os.utime(tile, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(pipeline(), {})
+        self.assertEqual(cache_utils._hashes.entries, {})
+        manifest.write_text(json.dumps({'url': {'file': None, 'sha256': 'b', 'members': [str(tile)]}}))
+        self.assertEqual(pipeline(), {'extract': 'inputs or parameters changed'})
+        os.utime(tile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(pipeline(), {'extract': 'inputs or parameters changed'})
+        self.assertEqual(len(runs), 3)
+
+
+class ScheduledTasks(TestCase):
+    """Scheduler should respect dependencies, memory budget and disk slots"""
+
+    def test_budget_and_order(self):
+        """Tasks fit only within memory and disk limits, and dependent tasks get results of finished ones"""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        scheduler = Scheduler(workers=2, memory_mb=100, io_per_disk=1)
+        big = scheduler.add('big', pow, args=(2, 3), memory_mb=80)
+        small = scheduler.add('small', pow, args=(3, 2), memory_mb=20, paths=[tmp.name])
+        scheduler.add('after', pow, args=(2, 2), memory_mb=200, after=['big', 'small'])
+        scheduler.budget = 100
+        self.assertTrue(scheduler.fits(small, 80, {}))
+        self.assertFalse(scheduler.fits(big, 40, {}))
+        self.assertFalse(scheduler.fits(small, 0, {next(iter(small.disks)): 1}))
+        self.assertEqual(scheduler.run(), {'big': 8, 'small': 9, 'after': 4})
+
+    def test_preprocess_months_in_parallel(self):
+        """Preprocessing two countries x three months at once matches numpy and keeps every shared cache entry"""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        tmp = Path(tmp.name)
+        cache_utils._hashes = cache_utils.JSONCache(tmp.joinpath('file_hashes.json'))
+        capital_stats._cache = cache_utils.JSONCache(tmp.joinpath('capital_max.json'))
+        self.addCleanup(setattr, cache_utils, '_hashes', None)
+        self.addCleanup(setattr, capital_stats, '_cache', None)
+        capital_shp = tmp.joinpath('capital.shp')
+        gpd.GeoDataFrame(geometry=[box(2, 2, 8, 8)], crs='EPSG:4326').to_file(str(capital_shp))
+        profile = dict(driver='GTiff', width=10, height=10, count=1, crs='EPSG:4326', transform=from_origin(0, 10, 1, 1))
+        rng = np.random.default_rng(2)
+        scheduler = Scheduler(workers=4, memory_mb=1, io_per_disk=4)
+        expected = {}
+        for country in ['AAA', 'BBB']:
+            for month in ['01', '02', '03']:
+                folder = tmp.joinpath(f'{country}/{month}')
+                folder.mkdir(parents=True)
+                rad = rng.gamma(1, 5, (10, 10)).astype('float32')
+                cvg = rng.integers(0, 4, (10, 10)).astype('uint8')
+                with rasterio.open(str(folder.joinpath(f'{country}_{month}_rad_tmp.tif')), 'w', dtype='float32', nodata=-99999, **profile) as dst:
+                    dst.write(rad, 1)
+                with rasterio.open(str(folder.joinpath(f'{country}_{month}_cvg.tif')), 'w', dtype='uint8', **profile) as dst:
+                    dst.write(cvg, 1)
+                kept = (cvg >= 1) & (rad >= 2)
+                cap_max = rad[2:8, 2:8][kept[2:8, 2:8]].max()
+                expected[(country, month)] = np.where(kept & (rad <= cap_max), rad, -99999)
+                scheduler.add(f'{country}_{month}', preprocess_month, args=(folder, country, capital_shp),
+                              kwargs={'cvg_threshold': 1, 'rad_threshold': 2}, memory_mb=2 * raster_mb(folder.joinpath(f'{country}_{month}_rad_tmp.tif')),
+                              paths=[folder])
+        results = scheduler.run()
+        for (country, month), data in expected.items():
+            with rasterio.open(str(results[f'{country}_{month}'])) as src:
+                np.testing.assert_array_equal(src.read(1), data)
+        self.assertEqual(len(cache_utils.JSONCache(tmp.joinpath('capital_max.json')).entries), 6)
+        self.assertEqual(len(cache_utils.JSONCache(tmp.joinpath('file_hashes.json')).entries), 12)
+
+
 if __name__ == "__main__":
     testmain()
@@ -0,0 +1,118 @@
+"""Zonal statistics of a radiance raster for every radiance threshold in one pass
+
+Each zone's pixel values are sorted once. Cumulative sums then give, for any threshold, the count, sum and sum of squares
+of the values kept (values >= threshold, as ReclassByThreshold keeps them) as a difference of two entries. Values are
+shifted by their zone's minimum before summing, so variances of zones with a large mean do not cancel away.
+With coverage weights (see coverage_weights) each threshold is instead one sparse matrix-vector product per statistic,
+and variances are summed about each zone's mean.
+"""
+import numpy as np
+import pandas as pd
+import rasterio
+from zonal_engine import ZonalEngine
+
+def pearson_rows(x, Y):
+    """Returns Pearson correlation of x (n) with every row of Y (m x n). Pairs where x or Y is NaN are left out, as in DataFrame.corr"""
+    x = np.asarray(x, dtype='float64')
+    Y = np.asarray(Y, dtype='float64')
+    valid = ~np.isnan(Y) & ~np.isnan(x)
+    n = valid.sum(axis=1)
+    X = np.where(valid, x, 0)
+    Y = np.where(valid, Y, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = np.where(valid, X - (X.sum(axis=1) / n)[:, None], 0)
+        dy = np.where(valid, Y - (Y.sum(axis=1) / n)[:, None], 0)
+        return (dx * dy).sum(axis=1) / np.sqrt((dx ** 2).sum(axis=1) * (dy ** 2).sum(axis=1))
+
+class ThresholdSweep:
+    """Per-zone count, sum, mean and std of radiance at or above each threshold, as arrays of shape (thresholds, zones)"""
+
+    def __init__(self, rad_raster, shp, thresholds, fields=('GID',), coverage=False, cache_dir=None):
+        """Initialisation function
+        rad_raster --> Radiance raster. Read once
+        shp --> Shapefile of zones
+        thresholds --> Radiance thresholds. Pixels below a threshold are left out of its statistics
+        fields --> Shapefile columns copied to table(). Default is ('GID',)
+        coverage --> Weight pixels by exact coverage fractions instead of labelling pixel centres. Default is False
+        cache_dir --> Folder of label grid and weight caches (see zonal_engine). Default is datain/cache
+        """
+        self.rad_raster = rad_raster
+        self.thresholds = np.asarray(thresholds)
+        self.zones = ZonalEngine(shp, fields=fields, cache_dir=cache_dir, coverage=coverage)
+        self.sweep()
+
+    def sweep(self):
+        """Sets count, sum, mean and std for every threshold and zone"""
+        with rasterio.open(str(self.rad_raster)) as src:
+            data = src.read(1)
+            nodata = src.nodata
+            if self.zones.coverage:
+                self.sweep_weights(data, nodata, self.zones.coverage_weights(src).matrix)
+                return
+            labels = self.zones.labels(src)
+        valid = labels > 0
+        if nodata is not None:
+            valid &= data != nodata
+        if np.issubdtype(data.dtype, np.floating):
+            valid &= ~np.isnan(data)
+        zone = labels[valid] - 1
+        values = data[valid].astype('float64')
+        order = np.lexsort((values, zone))
+        zone, values = zone[order], values[order]
+        n_zones = len(self.zones.gdf)
+        starts = np.searchsorted(zone, np.arange(n_zones), side='left')
+        ends = np.searchsorted(zone, np.arange(n_zones), side='right')
+        first = np.empty((len(self.thresholds), n_zones), dtype='int64')
+        for index, (start, end) in enumerate(zip(starts, ends)):
+            first[:, index] = start + np.searchsorted(values[start:end], self.thresholds, side='left')
+        shift = np.zeros(n_zones)
+        shift[starts < ends] = values[starts[starts < ends]]
+        shifted = values - shift[zone]
+        cum_sum = np.concatenate([[0], np.cumsum(shifted)])
+        cum_squares = np.concatenate([[0], np.cumsum(shifted ** 2)])
+        self.count = ends - first
+        empty = self.count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shifted_sum = cum_sum[ends] - cum_sum[first]
+            shifted_mean = shifted_sum / self.count
+            self.sum = np.where(empty, np.nan, shifted_sum + shift * self.count)
+            self.mean = shifted_mean + shift
+            variance = (cum_squares[ends] - cum_squares[first]) / self.count - shifted_mean ** 2
+            self.std = np.sqrt(np.clip(variance, 0, None))
+
+    def sweep_weights(self, data, nodata, matrix):
+        """Sets count, sum, mean and std for every threshold and zone from sparse coverage weight matrix (zones x pixels)"""
+        values = data.ravel().astype('float64')
+        valid = ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        values = np.where(valid, values, 0)
+        coo = matrix.tocoo()
+        shape = (len(self.thresholds), matrix.shape[0])
+        self.count, total, self.std = np.empty(shape), np.empty(shape), np.empty(shape)
+        for index, threshold in enumerate(self.thresholds):
+            kept = (valid & (values >= threshold)).astype('float64')
+            self.count[index] = matrix @ kept
+            total[index] = matrix @ (values * kept)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total[index] / self.count[index]
+                deviations = coo.data * kept[coo.col] * (values[coo.col] - np.nan_to_num(mean)[coo.row]) ** 2
+                self.std[index] = np.sqrt(np.bincount(coo.row, weights=deviations, minlength=shape[1]) / self.count[index])
+        empty = self.count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.sum = np.where(empty, np.nan, total)
+            self.mean = self.sum / self.count
+
+    def table(self):
+        """Returns DataFrame of fields and sum{threshold}, mean{threshold}, std{threshold} columns (as ThresholdZonalStats writes them)"""
+        columns = {}
+        for index, threshold in enumerate(self.thresholds):
+            columns[f'sum{threshold}'] = self.sum[index]
+            columns[f'mean{threshold}'] = self.mean[index]
+            columns[f'std{threshold}'] = self.std[index]
+        df = pd.DataFrame(self.zones.gdf[self.zones.fields]).reset_index(drop=True)
+        return pd.concat([df, pd.DataFrame(columns)], axis=1)
+
+    def correlation(self, other):
+        """Returns Series of Pearson correlation of zone sums with other (one value per zone, in shapefile order), indexed by threshold"""
+        return pd.Series(pearson_rows(other, self.sum), index=self.thresholds)
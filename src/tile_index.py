@@ -0,0 +1,75 @@
+"""Spatial index of VIIRS tile footprints, used to find which tiles and pixel windows an admin shapefile needs"""
+import rasterio
+import shapely
+from shapely import STRtree
+from shapely.geometry import box
+from extract_rasters import bounds_to_window, read_shapes
+
+#Upper left corner of each VIIRS DNB composite tile. Northern tiles span 75N-0N, southern 0N-65S, each 120 degrees wide
+TILES = {'75N180W': (-180, 75, 0),
+         '75N060W': (-60, 75, 0),
+         '75N060E': (60, 75, 0),
+         '00N180W': (-180, 0, -65),
+         '00N060W': (-60, 0, -65),
+         '00N060E': (60, 0, -65)}
+
+class TileIndex:
+    """R-tree (STRtree) of tile footprints queried with admin geometries"""
+
+    def __init__(self, tiles=TILES):
+        """Initialisation function
+        tiles --> Dictionary of {extent: (west, north, south)}. Default is the six VIIRS tiles
+        """
+        self.extents = list(tiles)
+        self.footprints = [box(west, south, west + 120, north) for west, north, south in tiles.values()]
+        self.tree = STRtree(self.footprints)
+
+    def tiles_for_shapes(self, gdf):
+        """Returns sorted list of tile extents intersected by any geometry in gdf"""
+        if gdf.crs is not None:
+            gdf = gdf.to_crs(epsg=4326)
+        _, tile_ids = self.tree.query(gdf['geometry'].values, predicate='intersects')
+        return sorted({self.extents[i] for i in tile_ids})
+
+    def tiles_for(self, shp):
+        """Returns sorted list of tile extents intersected by shapefile"""
+        return self.tiles_for_shapes(read_shapes(shp))
+
+    def extent_at(self, bounds):
+        """Returns extent of tile whose footprint holds the centre of bounds (left, bottom, right, top), or None"""
+        left, bottom, right, top = bounds
+        tile_ids = self.tree.query(shapely.Point((left + right) / 2, (bottom + top) / 2), predicate='intersects')
+        return self.extents[tile_ids[0]] if len(tile_ids) else None
+
+    def extent_of(self, tile):
+        """Returns extent of downloaded tile raster, found from its georeferenced bounds rather than its file name"""
+        with rasterio.open(str(tile)) as src:
+            return self.extent_at(src.bounds)
+
+    def window_for_shapes(self, gdf, src):
+        """Returns window of whole pixels of open tile src covering the part of gdf inside the tile footprint, or None if gdf misses the tile.
+        Countries crossing a tile edge therefore read only their own pixels from each tile, not the whole bounding box
+        """
+        extent = self.extent_at(src.bounds)
+        if extent is None:
+            return None
+        if gdf.crs is not None:
+            gdf = gdf.to_crs(epsg=4326)
+        parts = shapely.intersection(gdf['geometry'].values, self.footprints[self.extents.index(extent)])
+        parts = parts[~shapely.is_empty(parts)]
+        if not len(parts):
+            return None
+        minx, miny, maxx, maxy = shapely.total_bounds(parts)
+        bounding_box = {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
+        return bounds_to_window(bounding_box, src.transform, src.width, src.height)
+
+    def windows_for(self, shp, tiles):
+        """Returns dictionary of {extent: window} of pixels shapefile needs in each of the downloaded tiles it intersects"""
+        gdf = read_shapes(shp)
+        windows = {}
+        for tile in tiles:
+            with rasterio.open(str(tile)) as src:
+                window = self.window_for_shapes(gdf, src)
+                if window is not None:
+                    windows[self.extent_at(src.bounds)] = window
+        return windows
@@ -0,0 +1,50 @@
+"""Tiled nodata interpolation. Splits a raster into tiles with a halo of overlap, fills each tile with GDAL's FillNodata
+in a thread or process pool, and stitches tile cores back together so results are seamless
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import numpy as np
+from rasterio._fill import _fillnodata
+
+def tile_slices(height, width, tile_size, halo):
+    """Yields (core, padded) pairs of (row slice, col slice) covering array. padded extends core by halo pixels"""
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            row_stop, col_stop = min(row_off + tile_size, height), min(col_off + tile_size, width)
+            core = (slice(row_off, row_stop), slice(col_off, col_stop))
+            padded = (slice(max(row_off - halo, 0), min(row_stop + halo, height)),
+                      slice(max(col_off - halo, 0), min(col_stop + halo, width)))
+            yield core, padded
+
+def fill_tile(data, mask, core_in_padded, max_search_distance, smoothing_iterations):
+    """Fills one padded tile and returns its core"""
+    filled = _fillnodata(data, mask.astype('uint8'), max_search_distance, smoothing_iterations)
+    return filled[core_in_padded]
+
+def fill_nodata_tiled(data, mask, max_search_distance=100, smoothing_iterations=0, tile_size=1024, halo=None, workers=None, use_processes=False):
+    """Returns copy of 2D data with pixels where mask is False interpolated from valid pixels within max_search_distance.
+    data --> 2D array
+    mask --> 2D boolean array, True where data is valid
+    max_search_distance --> Furthest distance in pixels searched for valid values. Default is 100
+    smoothing_iterations --> 3x3 smoothing passes over filled pixels. Default is 0
+    tile_size --> Size in pixels of tile cores. Default is 1024
+    halo --> Overlap in pixels around each core. Default is max_search_distance + smoothing_iterations, which makes results seamless
+    workers --> Pool size. Default is number of cpus
+    use_processes --> Use a process pool instead of threads. Default is False
+    """
+    if halo is None:
+        halo = int(np.ceil(max_search_distance)) + smoothing_iterations
+    result = data.copy()
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers or os.cpu_count()) as executor:
+        futures = {}
+        for core, padded in tile_slices(data.shape[0], data.shape[1], tile_size, halo):
+            if mask[core].all():
+                continue
+            core_in_padded = (slice(core[0].start - padded[0].start, core[0].stop - padded[0].start),
+                              slice(core[1].start - padded[1].start, core[1].stop - padded[1].start))
+            future = executor.submit(fill_tile, data[padded].copy(), mask[padded], core_in_padded, max_search_distance, smoothing_iterations)
+            futures[future] = core
+        for future, core in futures.items():
+            result[core] = future.result()
+    return result
@@ -0,0 +1,115 @@
+"""Incremental zonal time series. Sums of any number of monthly rasters, over any admin level, kept in long format
+(zone, year, month, metric) in a ResultsStore. Only periods that are new or whose raster or zones changed are computed
+"""
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+import pandas as pd
+from cache_utils import JSONCache, file_hash, geometry_hash
+from viirs_zonal_stats import zone_sums, id_columns, add_derived_metrics
+from zonal_engine import ZonalEngine
+
+def find_periods(country_dir, country, raster_type):
+    """Returns {(year, month): raster} for month folders under country_dir holding {country}_{MM}{raster_type}.
+    Month folders are either MM (year '') or YYYY/MM
+    """
+    periods = {}
+    for folder in sorted(x for x in country_dir.iterdir() if x.is_dir()):
+        if len(folder.name) == 4 and folder.name.isdigit():
+            months, year = sorted(x for x in folder.iterdir() if x.is_dir()), folder.name
+        else:
+            months, year = [folder], ''
+        for month in months:
+            raster = month.joinpath(f'{country}_{month.name}{raster_type}')
+            if raster.exists():
+                periods[(year, month.name)] = raster
+    return periods
+
+class ZonalTimeSeries:
+    """Zone sums for every period, stored in long format and brought up to date by update()"""
+
+    def __init__(self, country, level, shp, periods, store, engine='labels', cache_dir=None):
+        """Initialisation function
+        country --> ISO of country
+        level --> Admin level. Zones are identified by NAME{level}
+        shp --> Shapefile of admin units
+        periods --> Dictionary of {(year, month): raster}, e.g. from find_periods
+        store --> ResultsStore holding the series. Input fingerprints are kept next to it in inputs.json
+        engine --> 'labels' (cached label grid) or 'coverage' (cached coverage fraction weights). Default is 'labels'
+        cache_dir --> Folder of label grid and weight caches (see zonal_engine). Default is datain/cache
+        """
+        self.country = country
+        self.level = level
+        self.shp = shp
+        self.periods = periods
+        self.store = store
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.zone_field = f'NAME{level}'
+        self.zones = ZonalEngine(self.shp, fields=[self.zone_field], cache_dir=cache_dir, coverage=engine == 'coverage')
+        self.inputs = JSONCache(self.store.root.joinpath('inputs.json'))
+
+    def input_key(self, period):
+        """Returns key of period's input fingerprint"""
+        return JSONCache.key(self.country, self.level, self.engine, *period)
+
+    def fingerprint(self, raster):
+        """Returns hash of raster contents, zone geometries and zone names"""
+        return JSONCache.key(file_hash(raster), geometry_hash(self.zones.gdf), list(self.zones.gdf[self.zone_field]), self.engine)
+
+    def stale(self):
+        """Returns periods missing from store or whose inputs changed since they were stored"""
+        return [period for period, raster in self.periods.items() if self.inputs.get(self.input_key(period)) != self.fingerprint(raster)]
+
+    def update(self, workers=None):
+        """Computes and stores sums of stale periods only and returns them
+        workers --> If given, periods are summed in a pool of this many processes. Default is None (serial)
+        """
+        stale = self.stale()
+        if not stale:
+            return stale
+        rasters = [self.periods[period] for period in stale]
+        if workers:
+            #Build the label grid or weights once here, so workers load them from the cache
+            self.zones.zonal_stats(rasters[0], ['sum'])
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                sums = list(executor.map(zone_sums, *zip(*[(self.shp, raster, self.zone_field, self.engine, self.cache_dir) for raster in rasters])))
+        else:
+            sums = [self.zones.zonal_stats(raster, ['sum']).set_index(self.zone_field)['sum'] for raster in rasters]
+        names = list(self.zones.gdf[self.zone_field])
+        sums = [values.reindex(names).values for values in sums]
+        long_df = pd.concat([pd.DataFrame({'zone': names, 'year': year, 'month': month, 'value': values})
+                             for (year, month), values in zip(stale, sums)], ignore_index=True)
+        long_df['country'] = self.country
+        long_df['level'] = self.level
+        long_df['metric'] = 'sum'
+        self.store.append(long_df)
+        for period, raster in zip(stale, rasters):
+            self.inputs.set(self.input_key(period), self.fingerprint(raster))
+        return stale
+
+    def table(self):
+        """Returns long-format DataFrame (zone, year, month, metric, value) of stored sums of the periods"""
+        years = sorted({year for year, _ in self.periods})
+        df = self.store.read(country=self.country, level=self.level, year=years, metric='sum')
+        df = df[[(year, month) in self.periods for year, month in zip(df['year'], df['month'])]]
+        return df[['zone', 'year', 'month', 'metric', 'value']].reset_index(drop=True)
+
+    def export(self, year, out_shp=None, out_csv=None):
+        """Returns GeoDataFrame of one year in the layout of VIIRSZonalStats (sum{MM}, area, annual_ave, annual_per_km, mean{MM}, diff{MM}),
+        writing it to out_shp and out_csv if given
+        """
+        df = self.table()
+        df = df[df['year'] == year]
+        months = sorted(df['month'].unique())
+        sums = df.pivot(index='zone', columns='month', values='value')
+        sums.columns = [f'sum{month}' for month in sums.columns]
+        gdf = gpd.read_file(str(self.shp))
+        gdf = gdf.merge(sums, left_on=self.zone_field, right_index=True)
+        first = self.periods[(year, months[0])]
+        gdf = gdf.merge(self.zones.zone_areas(first), on=self.zone_field)
+        gdf = add_derived_metrics(gdf[id_columns(gdf, self.level) + list(sums.columns) + ['area', 'geometry']], months)
+        if out_shp is not None:
+            gdf.to_file(str(out_shp))
+        if out_csv is not None:
+            pd.DataFrame(gdf).drop('geometry', axis=1).to_csv(str(out_csv))
+        return gdf
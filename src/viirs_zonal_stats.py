@@ -1,16 +1,52 @@
 """Module to carry out zonal stats on VIIRS rasters."""
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path 
 import geopandas as gpd 
 import numpy as np 
 import pandas as pd 
+import rasterio
 from rasterstats import zonal_stats
+from admin_views import AdminViews
+from zonal_engine import ZonalEngine
 from sklearn import preprocessing
 
+def zone_sums(shp, raster, name_field, engine, cache_dir=None):
+    """Returns float64 Series of raster sum of every admin unit of shp, indexed by name_field. Used by worker processes.
+    Units an engine leaves out (views skip units outside the raster) are missing, so results must be joined on name
+    cache_dir --> Folder of label grid and weight caches (see zonal_engine). Default is datain/cache
+    """
+    if engine in ('labels', 'coverage'):
+        df = ZonalEngine(shp, fields=[name_field], cache_dir=cache_dir, coverage=engine == 'coverage').zonal_stats(raster, ['sum'])
+    elif engine == 'views':
+        views = AdminViews.from_raster(shp, raster, name_field=name_field)
+        with rasterio.open(str(raster)) as src:
+            df = views.zonal_stats(src.read(1), ['sum'], nodata=src.nodata)
+    else:
+        df = gpd.GeoDataFrame.from_features(zonal_stats(str(shp), str(raster), stats=['sum'], geojson_out=True))
+    return df.set_index(name_field)['sum'].astype('float64')
+
+def id_columns(gdf, level):
+    """Returns admin unit identifier columns of gdf kept in zonal stats tables: ADM1 (if present) and NAME{level}"""
+    return [x for x in ['ADM1', f'NAME{level}'] if x in gdf.columns]
+
+def add_derived_metrics(gdf, periods):
+    """Returns gdf with annual_ave, annual_per_km, mean{period} and diff{period} columns added from sum{period} and area columns.
+    area is in km2, so annual_per_km and mean{period} are radiance per km2 (10x smaller than tables made before area was km2, see CHANGELOG)
+    periods --> Column suffixes of the periods, e.g. ['01', '02']. annual_ave is the sum over periods divided by their number
+    """
+    gdf = gdf.copy()
+    cols = [f'sum{period}' for period in periods]
+    gdf['annual_ave'] = gdf[cols].sum(axis=1)/len(cols)
+    gdf['annual_per_km'] = gdf['annual_ave']/gdf['area']
+    for period in periods:
+        gdf[f'mean{period}'] = gdf[f'sum{period}']/gdf['area']
+    for period in periods:
+        gdf[f'diff{period}'] = (gdf[f'sum{period}'] - gdf['annual_ave'])/gdf['annual_ave'] * 100
+    return gdf
+
 class VIIRSZonalStats:
     """Class to calculate zonal stats"""
-    UTMS = {'GHA': 2136, 'NPL': 32645, 'HTI':32618, 'MOZ': 4129, 'NAM': 32733}
-
-    def __init__(self, country, months, shp, out_shp, out_csv, level, raster_type=None):
+    def __init__(self, country, months, shp, out_shp, out_csv, level, raster_type=None, engine='rasterstats', workers=None, store=None, export=None, cache_dir=None):
         """Initialisation arguments:
         
         country --> ISO for input country
@@ -18,6 +54,12 @@ class VIIRSZonalStats:
         shp --> shape to use as zones
         out_shp --> Shapefile containing zonal stats table
         out_csv --> csv with zonal tables (missing geometry column from out_shp)
+        engine --> 'rasterstats', 'views' (in-memory AdminViews built once for all months), 'labels' (cached label grid, see zonal_engine)
+                   or 'coverage' (cached coverage fraction weights, see coverage_weights). Default is 'rasterstats'
+        workers --> If given, months are summed in a pool of this many processes and joined in one step. Default is None (serial)
+        store --> ResultsStore (see results_store). If given, the zonal stats table is appended to it keyed by NAME{level}. Default is None
+        export --> Write out_shp and out_csv. Default is None (write them only when there is no store)
+        cache_dir --> Folder of label grid and weight caches (see zonal_engine). Default is datain/cache
         """
         self.country = country
         self.months = months
@@ -26,48 +68,97 @@ class VIIRSZonalStats:
         self.out_csv = out_csv
         self.level = level
         self.raster_type = raster_type ##(normalised or seasonality coefficient) ##
-        self.utm = self.UTMS[self.country]
+        self.engine = engine
+        self.workers = workers
+        self.store = store
+        self.export = export if export is not None else store is None
+        self.cache_dir = cache_dir
+        self.views = None
+        self.zones = None
         self.gdf = self.zonal_stats_all_months()
 
     
     def zonal_stats_all_months(self):
         """Returns geodataframe containing summed zonal stats for all months"""
         gdf = gpd.read_file(str(self.shp))
+        if self.workers:
+            gdf = gdf.merge(self.parallel_sums(), left_on=f'NAME{self.level}', right_index=True)
+        else:
+            gdf = self.serial_sums(gdf)
+        gdf = gdf.merge(self.zone_areas(), on=f'NAME{self.level}')
+        sums = [f'sum{month.name}' for month in self.months]
+        gdf = add_derived_metrics(gdf[id_columns(gdf, self.level) + sums + ['area', 'geometry']], [month.name for month in self.months])
+        if self.store is not None:
+            metrics = [x for x in gdf.columns if x not in id_columns(gdf, self.level) + ['geometry']]
+            self.store.append_wide(gdf[[f'NAME{self.level}'] + metrics], self.country, self.level, f'NAME{self.level}')
+        if self.export:
+            gdf.to_file(str(self.out_shp))
+            df = pd.DataFrame(gdf)
+            df = df.drop('geometry', axis=1)
+            df.to_csv(str(self.out_csv))
+        return gdf
+
+    def zone_areas(self):
+        """Returns DataFrame of area (km2) of every admin unit from the label grid and geodesic pixel areas of the first month's grid"""
+        if self.zones is None:
+            self.zones = ZonalEngine(self.shp, fields=[f'NAME{self.level}'], cache_dir=self.cache_dir, coverage=self.engine == 'coverage')
+        month = self.months[0]
+        return self.zones.zone_areas(month.joinpath(f'{self.country}_{month.name}{self.raster_type}'))
+
+    def serial_sums(self, gdf):
+        """Returns gdf merged with sum{month} columns, one month at a time"""
         for month in self.months:
             raster = month.joinpath(f'{self.country}_{month.name}{self.raster_type}')
-            stats = zonal_stats(str(self.shp), raster, stats=['sum'], geojson_out=True)
-            stats_geojson = gpd.GeoDataFrame.from_features(stats)
+            if self.engine == 'views':
+                stats_geojson = self.view_stats(raster)
+            elif self.engine in ('labels', 'coverage'):
+                stats_geojson = self.label_stats(raster)
+            else:
+                stats = zonal_stats(str(self.shp), raster, stats=['sum'], geojson_out=True)
+                stats_geojson = gpd.GeoDataFrame.from_features(stats)
             stats_geojson = stats_geojson[[f'NAME{self.level}', 'sum']]
             stats_geojson =stats_geojson.rename(index=str, columns={f'NAME{self.level}':f'NAME{self.level}', 'sum': f'sum{month.name}'})
             gdf = gdf.merge(stats_geojson, on=f'NAME{self.level}')
-        temp = gdf.copy()
-        temp = temp.to_crs(epsg=self.utm)
-        temp['area'] = temp['geometry'].area * 0.0000001
-        temp = temp[['area', f'NAME{self.level}']]
-        gdf = gdf.merge(temp, on=f'NAME{self.level}')
-        gdf = gdf[['ADM1', f'NAME{self.level}', 'sum01', 'sum02', 'sum03', 'sum04', 'sum05', 'sum06', 'sum07', 'sum08', 'sum09', 'sum10', 'sum11', 'sum12', 'area', 'geometry']]
-        cols = [x for x in gdf.columns.values if x.startswith('sum')]
-        gdf['annual_ave'] = gdf[cols].sum(axis=1)/12
-        gdf['annual_per_km'] = gdf['annual_ave']/gdf['area']
-        cols = ['mean' + x[3:] for x in gdf.columns.values if x.startswith('sum')]
-        for col in cols:
-            gdf[col] = gdf['sum'+col[-2:]]/gdf['area']
-        cols = ['diff' + x[3:] for x in gdf.columns.values if x.startswith('sum')]
-        for col in cols:
-            gdf[col] = (gdf['sum' + col[-2:]] - gdf['annual_ave'])/gdf['annual_ave'] * 100
-        gdf.to_file(str(self.out_shp))
-        df = pd.DataFrame(gdf)
-        df = df.drop('geometry', axis=1)
-        df.to_csv(str(self.out_csv))
+        return gdf
+
+    def parallel_sums(self):
+        """Returns DataFrame of sum{month} columns indexed by NAME{level}, with months summed in a process pool.
+        Only units present in every month are kept, as serial_sums keeps them
+        """
+        rasters = [month.joinpath(f'{self.country}_{month.name}{self.raster_type}') for month in self.months]
+        if self.engine in ('labels', 'coverage') and rasters:
+            #Build the label grid or weights once here, so workers load them from the cache
+            self.label_stats(rasters[0])
+        name_field = f'NAME{self.level}'
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(zone_sums, self.shp, raster, name_field, self.engine, self.cache_dir) for raster in rasters]
+            sums = [future.result() for future in futures]
+        return pd.concat(sums, axis=1, join='inner', keys=[f'sum{month.name}' for month in self.months])
+
+    def view_stats(self, raster):
+        """Returns DataFrame of sum per admin unit from in-memory AdminViews, built on the first raster's grid"""
+        with rasterio.open(str(raster)) as src:
+            data = src.read(1)
+            if self.views is None:
+                self.views = AdminViews(self.shp, src.transform, src.shape, name_field=f'NAME{self.level}', crs=src.crs)
+            return self.views.zonal_stats(data, ['sum'], nodata=src.nodata)
+
+    def label_stats(self, raster):
+        """Returns DataFrame of sum per admin unit from the cached label grid (or coverage weights) of the raster's grid"""
+        if self.zones is None:
+            self.zones = ZonalEngine(self.shp, fields=[f'NAME{self.level}'], cache_dir=self.cache_dir, coverage=self.engine == 'coverage')
+        return self.zones.zonal_stats(raster, ['sum'])
 
 class PPPZonalStats:
     """Class for calculating zonal stats sums of input ppp raster and subnational shapefile"""
-    def __init__(self, country, level, raster, shp, out_csv, append_to_shp=False):
+    def __init__(self, country, level, raster, shp, out_csv, append_to_shp=False, engine='rasterstats', cache_dir=None):
         """
         raster --> Input ppp raster
         shp --> shapefile defining the zones
         out_csv --> out zonal stats table
         append_to_shp --> append zonal stats to shapefile as well
+        engine --> 'rasterstats', 'labels' (cached label grid, see zonal_engine) or 'coverage' (cached coverage fraction weights, see coverage_weights). Default is 'rasterstats'
+        cache_dir --> Folder of label grid and weight caches of the labels and coverage engines. Default is None (datain/cache)
         """
         self.country = country
         self.level = level
@@ -75,13 +166,18 @@ class PPPZonalStats:
         self.shp = shp
         self.out_csv = out_csv
         self.append_to_shp = append_to_shp
+        self.engine = engine
+        self.cache_dir = cache_dir
         self.ppp_zonal_stats()
 
     def ppp_zonal_stats(self):
         """Function to calculate zonal stats"""
         gdf = gpd.read_file(str(self.shp))
-        stats = zonal_stats(str(self.shp), self.raster, stats=['sum', 'mean', 'std'], geojson_out=True)
-        stats_geojson = gpd.GeoDataFrame.from_features(stats)
+        if self.engine in ('labels', 'coverage'):
+            stats_geojson = ZonalEngine(self.shp, fields=['GID', f'NAME{self.level}'], cache_dir=self.cache_dir, coverage=self.engine == 'coverage').zonal_stats(self.raster, ['sum', 'mean', 'std'])
+        else:
+            stats = zonal_stats(str(self.shp), self.raster, stats=['sum', 'mean', 'std'], geojson_out=True)
+            stats_geojson = gpd.GeoDataFrame.from_features(stats)
         stats_geojson = stats_geojson[['GID', f'NAME{self.level}', 'sum', 'mean', 'std']]
         if self.append_to_shp:
             gdf = gdf.merge(stats_geojson, on='ADM{self.level}_id')
@@ -91,26 +187,38 @@ class PPPZonalStats:
 
 class ThresholdZonalStats:
     """Calculates zonal stats of rad raster and appends to ppp zonal stats table"""
-    def __init__(self, raster, shp, level, threshold_value, csv_to_append):
+    def __init__(self, raster, shp, level, threshold_value, csv_to_append, engine='rasterstats', store=None, country=None):
         """
         raster -> radiance raster
         shp --> shapefiles defining zones
         csv_to_append --> ppp zonal table to append to
+        engine --> 'rasterstats', 'labels' (cached label grid, see zonal_engine) or 'coverage' (cached coverage fraction weights, see coverage_weights). Default is 'rasterstats'
+        store --> ResultsStore (see results_store). If given, stats are appended to it as month 'annual' instead of rewriting csv_to_append. Default is None
+        country --> ISO of country, used as key in store. Default is None
         """
         self.raster = raster
         self.shp = shp
         self.level = level
         self.threshold_value = threshold_value
         self.csv_to_append = csv_to_append
+        self.engine = engine
+        self.store = store
+        self.country = country
         self.threshold_zonal_stats()
 
     def threshold_zonal_stats(self):
         """Function to calculate zonal stats and append to table"""
-        df = pd.read_csv(self.csv_to_append)
-        stats = zonal_stats(str(self.shp), self.raster, stats=['sum', 'mean', 'std'], geojson_out=True)
-        stats_geojson = gpd.GeoDataFrame.from_features(stats)
+        if self.engine in ('labels', 'coverage'):
+            stats_geojson = ZonalEngine(self.shp, fields=['GID'], coverage=self.engine == 'coverage').zonal_stats(self.raster, ['sum', 'mean', 'std'])
+        else:
+            stats = zonal_stats(str(self.shp), self.raster, stats=['sum', 'mean', 'std'], geojson_out=True)
+            stats_geojson = gpd.GeoDataFrame.from_features(stats)
         stats_geojson = stats_geojson[['GID', 'sum', 'mean', 'std']]
         stats_geojson.columns = ['GID', f'sum{self.threshold_value}', f'mean{self.threshold_value}', f'std{self.threshold_value}']
+        if self.store is not None:
+            self.store.append_wide(stats_geojson, self.country, self.level, 'GID', month='annual')
+            return
+        df = pd.read_csv(self.csv_to_append)
         #stats_geojson = stats_geojson.groupby(f'NAME{self.level}').sum()
         #df = df.merge(stats_geojson, on=f'NAME{self.level}')
         df = df.merge(stats_geojson, on='GID')
@@ -0,0 +1,140 @@
+"""Zonal statistics from a cached label grid. The admin shapefile is rasterized once per raster grid (see label_grid) and
+every statistic for every zone then comes from a few bincount reductions over the raster
+"""
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from scipy import ndimage
+from cache_utils import CACHE_DIR, JSONCache, geometry_hash
+from extract_rasters import read_shapes
+from label_grid import LabelGrid
+from pixel_area import pixel_areas, geodesic_areas
+from coverage_weights import CoverageWeights
+
+STATS = ('count', 'sum', 'mean', 'std', 'min', 'max')
+
+class ZonalEngine:
+    """Computes zonal statistics of rasters for all zones of a shapefile at once.
+    Pixel centres decide membership, as in rasterstats. Zones are assumed not to overlap (each pixel belongs to one zone).
+    With coverage=True pixels are instead weighted by the fraction of their area inside each zone (see coverage_weights)
+    """
+
+    def __init__(self, shp, fields=('ADM1',), cache_dir=None, coverage=False):
+        """Initialisation function
+        shp --> Shapefile of zones
+        fields --> Shapefile columns copied to output tables. Default is ('ADM1',)
+        cache_dir --> Folder of caches. Label grids go in its labels and coverage weights in its coverage subfolder. Default is datain/cache
+        coverage --> Weight pixels by exact coverage fractions instead of labelling pixel centres. Default is False
+        """
+        self.shp = shp
+        self.fields = list(fields)
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.coverage = coverage
+        self.gdf = read_shapes(self.shp)
+        self.grids = {}
+        self.weights = {}
+
+    def grid_key(self, src):
+        """Returns key of label grid for shapefile on the grid of open raster src"""
+        return JSONCache.key(geometry_hash(self.gdf), tuple(src.transform), src.shape, str(src.crs))
+
+    def labels(self, src):
+        """Returns int32 label array (row i of shapefile is label i + 1) on the grid of open raster src.
+        Label grids are kept in memory and in cache_dir, so each grid is rasterized once
+        """
+        key = self.grid_key(src)
+        if key not in self.grids:
+            cached = self.cache_dir.joinpath(f'labels/{key}.npz')
+            if cached.exists():
+                self.grids[key] = np.load(str(cached))['labels']
+            else:
+                labels = LabelGrid(self.shp, src.transform, src.shape, name_field=self.fields[0], crs=src.crs).labels
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cached.with_suffix(f'.{os.getpid()}.tmp.npz')
+                np.savez_compressed(str(tmp_path), labels=labels)
+                tmp_path.replace(cached)
+                self.grids[key] = labels
+        return self.grids[key]
+
+    def coverage_weights(self, src):
+        """Returns CoverageWeights on the grid of open raster src. Kept in memory and cached on disk"""
+        key = self.grid_key(src)
+        if key not in self.weights:
+            self.weights[key] = CoverageWeights.from_src(self.shp, src, cache_dir=self.cache_dir.joinpath('coverage'))
+        return self.weights[key]
+
+    def reduce(self, data, labels, nodata=None, stats=STATS):
+        """Returns dict of {stat: float64 array with one value per zone} for 2D data and matching labels.
+        Nodata and NaN pixels are ignored. Zones without valid pixels get count 0 and NaN for other statistics.
+        std is the population standard deviation (ddof=0), as in rasterstats
+        """
+        n_zones = len(self.gdf)
+        valid = labels > 0
+        if nodata is not None:
+            valid &= data != nodata
+        if np.issubdtype(data.dtype, np.floating):
+            valid &= ~np.isnan(data)
+        zone = labels[valid] - 1
+        values = data[valid].astype('float64')
+        count = np.bincount(zone, minlength=n_zones)
+        empty = count == 0
+        result = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = np.bincount(zone, weights=values, minlength=n_zones)
+            mean = total / count
+            if 'count' in stats:
+                result['count'] = count
+            if 'sum' in stats:
+                result['sum'] = np.where(empty, np.nan, total)
+            if 'mean' in stats:
+                result['mean'] = mean
+            if 'std' in stats:
+                squares = np.bincount(zone, weights=(values - mean[zone]) ** 2, minlength=n_zones)
+                result['std'] = np.sqrt(squares / count)
+        index = np.arange(n_zones)
+        for stat, func in [('min', ndimage.minimum), ('max', ndimage.maximum)]:
+            if stat in stats:
+                extreme = np.asarray(func(values, zone, index), dtype='float64') if values.size else np.zeros(n_zones)
+                result[stat] = np.where(empty, np.nan, extreme)
+        return {stat: result[stat] for stat in stats}
+
+    def zonal_stats(self, raster, stats=STATS):
+        """Returns DataFrame of fields and stats for every zone, in shapefile row order
+        raster --> Raster (or path) to summarise
+        stats --> Any of 'count', 'sum', 'mean', 'std', 'min', 'max'. Default is all
+        """
+        unknown = set(stats) - set(STATS)
+        if unknown:
+            raise ValueError(f'stats should be in {STATS}, not {sorted(unknown)}')
+        with rasterio.open(str(raster)) as src:
+            data = src.read(1)
+            nodata = src.nodata
+            if self.coverage:
+                results = self.coverage_weights(src).reduce(data, nodata, stats)
+            else:
+                results = self.reduce(data, self.labels(src), nodata, stats)
+        df = pd.DataFrame(self.gdf[self.fields]).reset_index(drop=True)
+        for stat, values in results.items():
+            df[stat] = values
+        return df
+
+    def zone_areas(self, raster):
+        """Returns DataFrame of fields and area (km2) of every zone, summed over pixels whose centre is in the zone
+        (or weighted by coverage fractions), on the grid of raster. Zones without any pixel (smaller than a pixel or off
+        the grid) get the geodesic area of their polygon instead of 0
+        """
+        df = pd.DataFrame(self.gdf[self.fields]).reset_index(drop=True)
+        with rasterio.open(str(raster)) as src:
+            areas = pixel_areas(src.transform, src.shape, src.crs)
+            if self.coverage:
+                zone_areas = self.coverage_weights(src).matrix @ areas.ravel()
+            else:
+                labels = self.labels(src)
+                inside = labels > 0
+                zone_areas = np.bincount(labels[inside] - 1, weights=areas[inside], minlength=len(self.gdf))
+        empty = zone_areas == 0
+        if empty.any():
+            zone_areas[empty] = geodesic_areas(self.gdf[empty])
+        df['area'] = zone_areas
+        return df